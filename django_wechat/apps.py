@@ -1,7 +1,30 @@
 # -*- coding: utf-8 -*-
 
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class DjangoWeChatConfig(AppConfig):
     name = 'django_wechat'
+    default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        # 微信支付结果通知写入WeChatPayOrderNotification
+        from django_wechat.payments import handle_payment_notify
+        from django_wechat.signals import wechatpay_notify
+        wechatpay_notify.connect(handle_payment_notify, dispatch_uid='django_wechat_payment_notify')
+
+        # 通讯录回调事件自动更新本地镜像
+        if getattr(settings, 'WECHATWORK_CONTACT_MIRROR', False):
+            from django_wechat.contacts import handle_contact_event
+            from django_wechat.signals import wechatwork_contact_event
+            wechatwork_contact_event.connect(handle_contact_event, dispatch_uid='django_wechat_contact_mirror')
+        # 预先计算各应用的登录凭据
+        if getattr(settings, 'WECHAT_LOGIN_DEFAULT_CLIENT_LABELS', None):
+            from django_wechat.sdk.login import load_login_credentials
+            load_login_credentials()
+        # 后台线程提前续期各应用的access_token
+        from django_wechat.sdk.tokens import get_token_settings
+        if get_token_settings()['BACKGROUND_REFRESH']:
+            from django_wechat.sdk.token_registry import get_token_registry
+            get_token_registry().start()
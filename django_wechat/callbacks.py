@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+回调事件分发
+
+回调视图解密并校验事件后交给分发器，立即应答企业微信，事件处理在分发器中进行，不占用回调响应时间。
+企业微信5秒内收不到应答会重试，处理耗时长的事件如果在视图中同步处理会导致重复推送。
+
+企业微信应答慢时会重复推送同一事件，分发前用CallbackDeduplicator按消息标识去重。
+
+需要按顺序处理的事件（比如通讯录镜像中先更新后删除的成员）分发时传入ordering_key，
+同一ordering_key的事件在同一个单线程队列中按分发顺序处理。
+
+Django settings可以指定分发器类的导入路径和去重参数：
+WECHATWORK_CALLBACK_DISPATCHER = 'django_wechat.callbacks.ThreadPoolDispatcher'
+WECHATWORK_CALLBACK_MAX_WORKERS = 4
+WECHATWORK_CALLBACK_DEDUP_TIMEOUT = 300  # 去重记录保留的秒数
+WECHATWORK_CALLBACK_DEDUP_MAX_SIZE = 10000  # 进程内去重记录的最大条数
+"""
+
+import time
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+# 默认分发器类
+DEFAULT_DISPATCHER = 'django_wechat.callbacks.ThreadPoolDispatcher'
+
+
+class BaseDispatcher(object):
+    """
+    分发器基类
+    """
+    def dispatch(self, signal, ordering_key=None, **kwargs):
+        """
+        分发事件
+        :param signal: 事件对应的信号
+        :param ordering_key: 顺序键，同一顺序键的事件按分发顺序依次处理，None表示不要求顺序
+        :param kwargs: 信号参数
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def handle(signal, **kwargs):
+        """
+        发送信号，由接收函数处理事件
+        """
+        for receiver, response in signal.send_robust(sender=None, **kwargs):
+            if isinstance(response, Exception):
+                logger.error('回调事件处理失败：%r', receiver, exc_info=response)
+
+
+class SyncDispatcher(BaseDispatcher):
+    """
+    在回调请求中同步处理，仅用于测试和处理很快的场景
+    """
+    def dispatch(self, signal, ordering_key=None, **kwargs):
+        self.handle(signal, **kwargs)
+
+
+class ThreadPoolDispatcher(BaseDispatcher):
+    """
+    在进程内线程池中处理，有顺序键的事件在该顺序键专用的单线程执行器中处理
+
+    顺序键应为少量固定值（比如事件类别），每个顺序键占用一个线程。
+    """
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            max_workers = getattr(settings, 'WECHATWORK_CALLBACK_MAX_WORKERS', 4)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='wechat-callback')
+        # 顺序键 -> 单线程执行器
+        self._ordered_executors = {}
+        self._lock = threading.Lock()
+
+    def get_ordered_executor(self, ordering_key) -> ThreadPoolExecutor:
+        with self._lock:
+            executor = self._ordered_executors.get(ordering_key)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=1,
+                                              thread_name_prefix='wechat-callback-{}'.format(ordering_key))
+                self._ordered_executors[ordering_key] = executor
+            return executor
+
+    @classmethod
+    def handle_in_thread(cls, signal, **kwargs):
+        # 工作线程不经过请求周期，需要手动关闭失效的数据库连接
+        close_old_connections()
+        try:
+            cls.handle(signal, **kwargs)
+        finally:
+            close_old_connections()
+
+    def dispatch(self, signal, ordering_key=None, **kwargs):
+        executor = self.executor if ordering_key is None else self.get_ordered_executor(ordering_key)
+        return executor.submit(self.handle_in_thread, signal, **kwargs)
+
+
+@lru_cache(maxsize=None)
+def _load_dispatcher(path) -> BaseDispatcher:
+    return import_string(path)()
+
+
+def get_dispatcher() -> BaseDispatcher:
+    """
+    获取settings.WECHATWORK_CALLBACK_DISPATCHER指定的分发器，同一进程内共享
+    """
+    return _load_dispatcher(getattr(settings, 'WECHATWORK_CALLBACK_DISPATCHER', DEFAULT_DISPATCHER))
+
+
+# ----- 去重 -----
+
+class CallbackDeduplicator(object):
+    """
+    回调消息去重
+
+    先查进程内的LRU记录，未命中再用缓存add跨进程判断，保证同一消息在有效期内只被分发一次。
+    分发失败时调用forget删除记录，企业微信重试时可以再次分发。
+    """
+    def __init__(self, prefix='wechatwork_callback_seen_', timeout=None, max_size=None):
+        """
+        :param prefix: 缓存键前缀
+        :param timeout: 去重记录保留的秒数
+        :param max_size: 进程内去重记录的最大条数
+        """
+        if timeout is None:
+            timeout = getattr(settings, 'WECHATWORK_CALLBACK_DEDUP_TIMEOUT', 300)
+        if max_size is None:
+            max_size = getattr(settings, 'WECHATWORK_CALLBACK_DEDUP_MAX_SIZE', 10000)
+        self.prefix = prefix
+        self.timeout = timeout
+        self.max_size = max_size
+        # 消息标识 -> 过期时间，按插入顺序淘汰
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def message_key(data: dict) -> str:
+        """
+        计算消息标识：普通消息使用MsgId，事件使用完整的消息内容
+
+        同一秒内同一对象的两次变更事件除变更内容外字段都相同，只用部分字段会把后一次变更当作重复丢弃。
+        """
+        if data.get('MsgId'):
+            identity = 'MsgId:{}:{}'.format(data.get('ToUserName'), data['MsgId'])
+        else:
+            identity = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha1(identity.encode()).hexdigest()
+
+    def _seen_locally(self, key, now) -> bool:
+        with self._lock:
+            expires_at = self._seen.get(key)
+            if expires_at is not None and expires_at > now:
+                return True
+            self._seen[key] = now + self.timeout
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+            return False
+
+    def is_duplicate(self, data: dict) -> bool:
+        """
+        判断消息是否已经处理过，未处理过的消息同时记为已处理；分发失败时需要调用forget
+        :param data: 解密后的消息
+        :return:
+        """
+        key = self.message_key(data)
+        if self._seen_locally(key, time.time()):
+            return True
+        try:
+            return not cache.add(self.prefix + key, 1, timeout=self.timeout)
+        except Exception:
+            # 缓存不可用时删除进程内记录，企业微信重试时不会被当作重复消息
+            with self._lock:
+                self._seen.pop(key, None)
+            raise
+
+    def forget(self, data: dict):
+        """
+        删除消息的去重记录，用于分发失败的消息
+        :param data: 解密后的消息
+        """
+        key = self.message_key(data)
+        with self._lock:
+            self._seen.pop(key, None)
+        cache.delete(self.prefix + key)
+
+
+@lru_cache(maxsize=None)
+def get_deduplicator() -> CallbackDeduplicator:
+    """
+    获取进程内共享的回调消息去重器
+    """
+    return CallbackDeduplicator()
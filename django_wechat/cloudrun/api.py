@@ -1,6 +1,105 @@
+# -*- coding: utf-8 -*-
 """
 微信云托管容器内API，包括：
 - https://developers.weixin.qq.com/miniprogram/dev/wxcloudrun/src/guide/weixin/open.html
 - https://developers.weixin.qq.com/miniprogram/dev/wxcloudrun/src/guide/weixin/token.html
 - https://developers.weixin.qq.com/miniprogram/dev/wxcloudrun/src/guide/weixin/pay.html
+
+开放接口服务：容器内通过http://api.weixin.qq.com调用微信开放接口，由云托管在内网鉴权，不需要access_token，也不经过公网TLS。
+开放接口服务只代理云托管环境绑定的应用。在云托管环境中，WECHAT_APP_SECRETS中设置'cloudrun': True的应用
+或者AppID等于settings.WXCLOUDRUN_APPID的应用，WeChatSDK自动改用这个客户端，不再获取和续期access_token；
+其他应用仍然使用access_token调用公网API。
+
+企业微信接口（qyapi.weixin.qq.com）不在开放接口服务范围内，WeChatWorkSDK不受影响。
+
+Django settings可以修改开放接口服务的地址，便于本地测试：
+WXCLOUDRUN_OPENAPI_ROOT_URL = 'http://api.weixin.qq.com/'
 """
+
+from django.conf import settings
+
+from django_wechat.sdk.sessions import request_json
+from django_wechat.sdk.wechat import WeChatSdkException
+from django_wechat.cloudrun.settings import CBR_ENV_ID
+
+# 开放接口服务根URL，使用HTTP协议
+WXCLOUDRUN_OPENAPI_ROOT_URL = 'http://api.weixin.qq.com/'
+
+
+def get_openapi_root_url() -> str:
+    return getattr(settings, 'WXCLOUDRUN_OPENAPI_ROOT_URL', WXCLOUDRUN_OPENAPI_ROOT_URL)
+
+
+# ----- Exception -----
+
+class WXCloudRunAPIException(WeChatSdkException):
+    """
+    继承WeChatSdkException，调用方捕获WeChatSdkException时不需要区分是否在云托管环境
+    """
+    pass
+
+
+# ----- 开放接口服务 -----
+
+class WXCloudRunOpenAPIClient(object):
+    """
+    微信云托管开放接口服务客户端
+
+    request_api、get_api、post_api的参数和返回值与WeChatSDK一致，api为相对于根URL的路径，比如'cgi-bin/user/info'。
+    """
+    def __init__(self, api_root_url=None, session=None):
+        """
+        :param api_root_url: 开放接口服务根URL，默认读取settings.WXCLOUDRUN_OPENAPI_ROOT_URL
+        :param session: 自定义HTTP会话，默认使用进程内共享的连接池会话
+        """
+        self._api_root_url = api_root_url or get_openapi_root_url()
+        self._session = session
+
+    def request_api(self, method, api, query_params=None, data=None):
+        return_data = request_json(method, self._api_root_url + api, session=self._session,
+                                   params=query_params, json=data)
+
+        # 部分接口成功时不返回errcode
+        if return_data.get('errcode', 0) != 0:
+            raise WXCloudRunAPIException(return_data)
+
+        return_data.pop('errcode', None)
+        return_data.pop('errmsg', None)
+        return return_data
+
+    def get_api(self, api, query_params=None):
+        return self.request_api('GET', api, query_params)
+
+    def post_api(self, api, query_params=None, data=None):
+        return self.request_api('POST', api, query_params, data)
+
+    # ----- 微信支付 -----
+
+    def request_pay_api(self, api, data: dict) -> dict:
+        """
+        调用云托管微信支付接口，不需要商户API密钥和证书
+        详细说明：https://developers.weixin.qq.com/miniprogram/dev/wxcloudrun/src/guide/weixin/pay.html
+        :param api: 接口名称，比如'unifiedOrder'
+        :param data: 请求参数，默认使用当前环境ID
+        :return: 微信支付返回的respdata
+        """
+        data = dict({'env_id': CBR_ENV_ID}, **data)
+        return_data = self.post_api('_/pay/' + api, data=data)
+        return return_data.get('respdata', return_data)
+
+    def create_order(self, data: dict) -> dict:
+        """
+        统一下单，参数包括body、openid、out_trade_no、spbill_create_ip、sub_mch_id、total_fee、callback_type、container等
+        """
+        return self.request_pay_api('unifiedOrder', data)
+
+    def query_order(self, sub_mch_id, out_trade_no=None, transaction_id=None) -> dict:
+        """
+        查询订单，商户订单号和微信支付订单号二选一
+        """
+        data = {'sub_mch_id': sub_mch_id}
+        if transaction_id is not None:
+            data['transaction_id'] = transaction_id
+        else:
+            data['out_trade_no'] = out_trade_no
+        return self.request_pay_api('queryOrder', data)
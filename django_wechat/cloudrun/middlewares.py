@@ -1,9 +1,148 @@
+# -*- coding: utf-8 -*-
 """
 微信云托管Django中间件
+
+云托管在请求Header中注入调用方的微信身份（X-WX-OPENID、X-WX-UNIONID、X-WX-APPID等），
+不需要再用code换取openid。WXCloudRunMiddleware把这些Header解析为request.wechat：
+
+- request.wechat在第一次访问时才解析Header，不使用身份的视图没有额外开销
+- request.wechat.user在第一次访问时查询本地用户，同一请求内只查询一次；异步视图使用await request.wechat.auser()
+
+Header只有经过云托管网关时才可信，默认只在云托管环境中（IS_WXCLOUDRUN_ENV）解析。
+
+Django settings传入格式示例（均为可选项）：
+WXCLOUDRUN_TRUST_HEADERS = True  # 是否信任身份Header，默认为IS_WXCLOUDRUN_ENV
+WXCLOUDRUN_USER_MODEL = 'accounts.User'  # AbstractWeChatUser子类，用于request.wechat.user
 """
 
+from functools import lru_cache
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
+
+from django_wechat.cloudrun.settings import IS_WXCLOUDRUN_ENV
+
+# 属性名 -> 请求Header
+IDENTITY_HEADERS = {
+    'openid': 'HTTP_X_WX_OPENID',
+    'unionid': 'HTTP_X_WX_UNIONID',
+    'appid': 'HTTP_X_WX_APPID',
+    'from_openid': 'HTTP_X_WX_FROM_OPENID',
+    'from_unionid': 'HTTP_X_WX_FROM_UNIONID',
+    'from_appid': 'HTTP_X_WX_FROM_APPID',
+    'env': 'HTTP_X_WX_ENV',
+    'source': 'HTTP_X_WX_SOURCE',
+    'service': 'HTTP_X_WX_SERVICE',
+}
+
+# 尚未查询本地用户
+_UNRESOLVED = object()
+
+
+@lru_cache(maxsize=None)
+def get_client_label(appid):
+    """
+    按AppID查找settings.WECHAT_APP_SECRETS中的应用标签，找不到时为None
+    """
+    for client_label, secrets in getattr(settings, 'WECHAT_APP_SECRETS', {}).items():
+        if secrets.get('appid') == appid:
+            return client_label
+    return None
+
+
+def get_user_model():
+    """
+    settings.WXCLOUDRUN_USER_MODEL指定的用户模型，没有设置时为None
+    """
+    model_label = getattr(settings, 'WXCLOUDRUN_USER_MODEL', None)
+    if model_label is None:
+        return None
+    return apps.get_model(model_label, require_ready=False)
+
+
+class WeChatIdentity(object):
+    """
+    云托管注入的微信身份，没有身份Header时各属性为None，布尔值为False
+    """
+    __slots__ = tuple(IDENTITY_HEADERS) + ('_user',)
+
+    def __init__(self, **kwargs):
+        for name in IDENTITY_HEADERS:
+            setattr(self, name, kwargs.get(name))
+        self._user = _UNRESOLVED
+
+    @classmethod
+    def from_meta(cls, meta: dict):
+        """
+        从request.META解析身份
+        """
+        return cls(**{name: meta.get(header) or None for name, header in IDENTITY_HEADERS.items()})
+
+    def __bool__(self):
+        return self.openid is not None
+
+    def __repr__(self):
+        return '<WeChatIdentity appid={} openid={}>'.format(self.appid, self.openid)
+
+    @property
+    def client_label(self):
+        """
+        AppID对应的应用标签
+        """
+        return get_client_label(self.appid) if self.appid else None
+
+    def resolve_user(self):
+        """
+        查询本地用户：有UnionID时先按UnionID查询，未找到时按应用的openid字段查询，
+        只按openid导入、尚未补充UnionID的用户也能找到
+        :return: 用户，没有身份、没有设置用户模型或者用户不存在时为None
+        """
+        model = get_user_model()
+        if not self or model is None:
+            return None
+        if self.unionid:
+            user = model.objects.filter(**{model.UNIONID_FIELD: self.unionid}).first()
+            if user is not None:
+                return user
+        client_label = self.client_label
+        if client_label not in model.OPENID_CLIENT_LABELS:
+            return None
+        return model.objects.filter(**{model.get_openid_field_name(client_label): self.openid}).first()
+
+    @property
+    def user(self):
+        """
+        本地用户，同一请求内只查询一次
+        """
+        if self._user is _UNRESOLVED:
+            self._user = self.resolve_user()
+        return self._user
+
+    async def auser(self):
+        """
+        异步视图中获取本地用户
+        """
+        if self._user is _UNRESOLVED:
+            self._user = await sync_to_async(self.resolve_user)()
+        return self._user
+
 
 class WXCloudRunMiddleware(object):
+    """
+    解析云托管身份Header，同时支持同步和异步请求
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.trust_headers = getattr(settings, 'WXCLOUDRUN_TRUST_HEADERS', IS_WXCLOUDRUN_ENV)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
     def process_wxcloudrun_header(self, request):
         """
         处理微信云托管请求Header的微信信息
@@ -13,7 +152,18 @@ class WXCloudRunMiddleware(object):
         :param request:
         :return:
         """
+        if self.trust_headers:
+            request.wechat = SimpleLazyObject(lambda: WeChatIdentity.from_meta(request.META))
+        else:
+            request.wechat = WeChatIdentity()
         return request
 
-    def process_view(self, request, view_func, view_args, view_kwargs):
-        pass
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        self.process_wxcloudrun_header(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        self.process_wxcloudrun_header(request)
+        return await self.get_response(request)
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+企业微信通讯录本地镜像
+
+- sync_contacts: 全量同步部门、成员和标签，首次使用和定期对账时调用
+- apply_contact_event: 根据通讯录变更回调事件增量更新
+- fetch_user: 从企业微信读取单个成员并写入本地镜像
+
+settings.WECHATWORK_CONTACT_MIRROR为True时，通讯录回调视图收到的事件会自动更新本地镜像。
+"""
+
+from django.db import transaction
+from django.utils import timezone
+
+from django_wechat.models import WeChatWorkDepartment, WeChatWorkUser, WeChatWorkTag
+from django_wechat.sdk.work import UserSDK, DepartmentSDK, TagSDK, chunked
+
+# 全量同步时每批写入的成员数
+SYNC_BATCH_SIZE = 500
+
+# 成员接口字段中对应模型字段的部分
+USER_FIELDS = ('name', 'alias', 'mobile', 'email', 'position', 'gender', 'avatar', 'status', 'main_department')
+# 成员接口字段中不保存到extra的部分
+USER_EXCLUDED_EXTRA_FIELDS = USER_FIELDS + ('userid', 'department')
+
+# 回调事件字段 -> 成员接口字段
+USER_EVENT_FIELDS = {
+    'Name': 'name',
+    'Alias': 'alias',
+    'Mobile': 'mobile',
+    'Email': 'email',
+    'Position': 'position',
+    'Gender': 'gender',
+    'Avatar': 'avatar',
+    'Status': 'status',
+    'MainDepartment': 'main_department',
+    'Department': 'department',
+}
+
+
+# ----- 数据转换 -----
+
+def split_ids(value, cast=str) -> list:
+    """
+    把回调事件中逗号分隔的ID字符串转成列表
+    """
+    if not value:
+        return []
+    return [cast(item) for item in str(value).split(',') if item]
+
+
+def user_defaults(data: dict) -> dict:
+    """
+    把成员接口数据转成模型字段
+    :param data: 成员接口数据，可以只包含部分字段
+    :return:
+    """
+    defaults = {field: data[field] for field in USER_FIELDS if field in data and data[field] is not None}
+    for field in ('status', 'main_department'):
+        if field in defaults:
+            defaults[field] = int(defaults[field])
+    return defaults
+
+
+def user_extra(data: dict) -> dict:
+    return {key: value for key, value in data.items() if key not in USER_EXCLUDED_EXTRA_FIELDS}
+
+
+def event_to_user_data(event: dict) -> dict:
+    """
+    把成员变更回调事件转成成员接口数据，只包含事件中出现的字段
+    """
+    data = {api_field: event[event_field] for event_field, api_field in USER_EVENT_FIELDS.items()
+            if event_field in event}
+    if 'department' in data:
+        data['department'] = split_ids(data['department'], int)
+    return data
+
+
+# ----- 写入本地镜像 -----
+
+def save_user(data: dict, userid=None) -> WeChatWorkUser:
+    """
+    创建或更新成员
+    :param data: 成员接口数据，可以只包含部分字段
+    :param userid: 成员UserID，默认为data['userid']
+    :return:
+    """
+    if userid is None:
+        userid = data['userid']
+    with transaction.atomic():
+        user, created = WeChatWorkUser.objects.update_or_create(userid=userid, defaults=user_defaults(data))
+        if 'department' in data:
+            user.departments.set(data['department'])
+    return user
+
+
+def fetch_user(userid) -> WeChatWorkUser:
+    """
+    从企业微信读取成员并写入本地镜像
+    """
+    data = UserSDK().get(userid)
+    user = save_user(data)
+    user.extra = user_extra(data)
+    user.save(update_fields=['extra'])
+    return user
+
+
+def sync_departments(sdk: DepartmentSDK = None) -> set:
+    """
+    全量同步部门
+    :return: 部门ID集合
+    """
+    if sdk is None:
+        sdk = DepartmentSDK()
+    departments = sdk.list()['department']
+    objs = [WeChatWorkDepartment(id=department['id'], name=department.get('name', ''),
+                                 parentid=department.get('parentid', 0), order=department.get('order', 0))
+            for department in departments]
+    WeChatWorkDepartment.objects.bulk_create(objs, update_conflicts=True, unique_fields=['id'],
+                                             update_fields=['name', 'parentid', 'order', 'synced_at'])
+    department_ids = {obj.id for obj in objs}
+    WeChatWorkDepartment.objects.exclude(id__in=department_ids).delete()
+    return department_ids
+
+
+def sync_users(sdk: UserSDK = None, batch_size: int = SYNC_BATCH_SIZE) -> int:
+    """
+    全量同步成员，逐个部门读取并分批写入，删除企业微信中已不存在的成员
+    :return: 成员数量
+    """
+    if sdk is None:
+        sdk = UserSDK()
+    started_at = timezone.now()
+    through = WeChatWorkUser.departments.through
+    count = 0
+    for users in chunked(sdk.iter_list(), batch_size):
+        objs = [WeChatWorkUser(userid=user['userid'], extra=user_extra(user), **user_defaults(user)) for user in users]
+        with transaction.atomic():
+            WeChatWorkUser.objects.bulk_create(
+                objs, update_conflicts=True, unique_fields=['userid'],
+                update_fields=[field.name for field in WeChatWorkUser._meta.concrete_fields
+                               if not field.primary_key and field.name != 'userid'],
+            )
+            pks = WeChatWorkUser.objects.filter(userid__in=[user['userid'] for user in users]) \
+                .values_list('userid', 'pk')
+            pks = dict(pks)
+            through.objects.filter(wechatworkuser_id__in=pks.values()).delete()
+            through.objects.bulk_create([
+                through(wechatworkuser_id=pks[user['userid']], wechatworkdepartment_id=department_id)
+                for user in users for department_id in user.get('department', [])
+            ])
+        count += len(objs)
+    # 本次未同步到的成员已被删除
+    WeChatWorkUser.objects.filter(synced_at__lt=started_at).delete()
+    return count
+
+
+def sync_tags(sdk: TagSDK = None) -> set:
+    """
+    全量同步标签及其成员和部门
+    :return: 标签ID集合
+    """
+    if sdk is None:
+        sdk = TagSDK()
+    tagids = set()
+    for tag in sdk.list()['taglist']:
+        tagid = int(tag['tagid'])
+        members = sdk.get(tagid)
+        with transaction.atomic():
+            obj, created = WeChatWorkTag.objects.update_or_create(tagid=tagid, defaults={'tagname': tag['tagname']})
+            userids = [user['userid'] for user in members.get('userlist', [])]
+            obj.users.set(WeChatWorkUser.objects.filter(userid__in=userids))
+            obj.departments.set(members.get('partylist', []))
+        tagids.add(tagid)
+    WeChatWorkTag.objects.exclude(tagid__in=tagids).delete()
+    return tagids
+
+
+def sync_contacts() -> dict:
+    """
+    全量同步通讯录
+    :return: 各类数据的数量
+    """
+    return {
+        'departments': len(sync_departments()),
+        'users': sync_users(),
+        'tags': len(sync_tags()),
+    }
+
+
+# ----- 通讯录变更回调事件 -----
+# 详见：https://developer.work.weixin.qq.com/document/path/90970
+
+def create_or_update_user(event: dict):
+    data = event_to_user_data(event)
+    userid = event['UserID']
+    # UserID变更时先把本地成员改成新的UserID
+    new_userid = event.get('NewUserID')
+    if new_userid and new_userid != userid:
+        WeChatWorkUser.objects.filter(userid=userid).update(userid=new_userid)
+        userid = new_userid
+    save_user(data, userid=userid)
+
+
+def delete_user(event: dict):
+    WeChatWorkUser.objects.filter(userid=event['UserID']).delete()
+
+
+def create_or_update_party(event: dict):
+    defaults = {}
+    if 'Name' in event:
+        defaults['name'] = event['Name']
+    if 'ParentId' in event:
+        defaults['parentid'] = int(event['ParentId'])
+    if 'Order' in event:
+        defaults['order'] = int(event['Order'])
+    WeChatWorkDepartment.objects.update_or_create(id=int(event['Id']), defaults=defaults)
+
+
+def delete_party(event: dict):
+    WeChatWorkDepartment.objects.filter(id=int(event['Id'])).delete()
+
+
+def update_tag(event: dict):
+    with transaction.atomic():
+        tag, created = WeChatWorkTag.objects.get_or_create(tagid=int(event['TagId']))
+        add_userids = split_ids(event.get('AddUserItems'))
+        del_userids = split_ids(event.get('DelUserItems'))
+        if add_userids:
+            tag.users.add(*WeChatWorkUser.objects.filter(userid__in=add_userids))
+        if del_userids:
+            tag.users.remove(*WeChatWorkUser.objects.filter(userid__in=del_userids))
+        tag.departments.add(*split_ids(event.get('AddPartyItems'), int))
+        tag.departments.remove(*split_ids(event.get('DelPartyItems'), int))
+
+
+# ChangeType -> 处理函数
+CONTACT_EVENT_HANDLERS = {
+    'create_user': create_or_update_user,
+    'update_user': create_or_update_user,
+    'delete_user': delete_user,
+    'create_party': create_or_update_party,
+    'update_party': create_or_update_party,
+    'delete_party': delete_party,
+    'update_tag': update_tag,
+}
+
+
+def apply_contact_event(event: dict) -> bool:
+    """
+    根据ContactCallbackSDK解密后的通讯录变更事件更新本地镜像
+    :param event: 解密后的事件数据
+    :return: 是否处理了该事件
+    """
+    if event.get('Event') != 'change_contact':
+        return False
+    handler = CONTACT_EVENT_HANDLERS.get(event.get('ChangeType'))
+    if handler is None:
+        return False
+    with transaction.atomic():
+        handler(event)
+    return True
+
+
+def handle_contact_event(sender, event, **kwargs):
+    """
+    wechatwork_contact_event信号的接收函数，settings.WECHATWORK_CONTACT_MIRROR为True时自动连接
+    """
+    apply_contact_event(event)
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+提前续期各应用的access_token，可以由定时任务执行，或者用--loop在单独的进程中常驻运行
+"""
+
+from django.core.management.base import BaseCommand
+
+from django_wechat.sdk.token_registry import get_token_registry
+
+
+class Command(BaseCommand):
+    help = '提前续期企业微信应用和公众号、小程序的access_token'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=None, help='剩余有效期不足该秒数时续期')
+        parser.add_argument('--loop', action='store_true', help='常驻运行，按REFRESH_INTERVAL定期续期')
+        parser.add_argument('--interval', type=int, default=None, help='常驻运行时的检查间隔秒数')
+
+    def handle(self, *args, **options):
+        registry = get_token_registry()
+        if options['loop']:
+            registry.run(options['interval'])
+            return
+        results = registry.refresh_due(options['ahead'])
+        metrics = registry.metrics()
+        for name, result in results.items():
+            if isinstance(result, Exception):
+                self.stderr.write('{}：续期失败 {!r}'.format(name, result))
+            else:
+                self.stdout.write('{}：{}，剩余{}秒'.format(name, '已续期' if result else '无需续期',
+                                                            metrics[name]['expires_in']))
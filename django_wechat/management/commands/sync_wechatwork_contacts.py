@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+全量同步企业微信通讯录到本地镜像，用于首次导入和定期对账
+"""
+
+from django.core.management.base import BaseCommand
+
+from django_wechat.contacts import sync_contacts
+
+
+class Command(BaseCommand):
+    help = '全量同步企业微信通讯录（部门、成员、标签）到本地镜像'
+
+    def handle(self, *args, **options):
+        counts = sync_contacts()
+        self.stdout.write(self.style.SUCCESS(
+            '同步完成：部门{departments}个，成员{users}个，标签{tags}个'.format(**counts)
+        ))
@@ -0,0 +1,75 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WeChatUser',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unionid', models.CharField(max_length=32, verbose_name='UnionID')),
+            ],
+            options={
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='WeChatWorkDepartment',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False, verbose_name='部门ID')),
+                ('name', models.CharField(blank=True, default='', max_length=64, verbose_name='名称')),
+                ('parentid', models.IntegerField(db_index=True, default=0, verbose_name='父部门ID')),
+                ('order', models.BigIntegerField(default=0, verbose_name='次序值')),
+                ('synced_at', models.DateTimeField(auto_now=True, verbose_name='同步时间')),
+            ],
+            options={
+                'verbose_name': '企业微信部门',
+                'verbose_name_plural': '企业微信部门',
+            },
+        ),
+        migrations.CreateModel(
+            name='WeChatWorkUser',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('userid', models.CharField(max_length=64, unique=True, verbose_name='UserID')),
+                ('name', models.CharField(blank=True, default='', max_length=64, verbose_name='姓名')),
+                ('alias', models.CharField(blank=True, default='', max_length=64, verbose_name='别名')),
+                ('mobile', models.CharField(blank=True, db_index=True, default='', max_length=32, verbose_name='手机号')),
+                ('email', models.CharField(blank=True, db_index=True, default='', max_length=128, verbose_name='邮箱')),
+                ('position', models.CharField(blank=True, default='', max_length=128, verbose_name='职务')),
+                ('gender', models.CharField(blank=True, default='', max_length=1, verbose_name='性别')),
+                ('status', models.IntegerField(default=1, verbose_name='激活状态')),
+                ('avatar', models.CharField(blank=True, default='', max_length=512, verbose_name='头像')),
+                ('main_department', models.IntegerField(blank=True, null=True, verbose_name='主部门ID')),
+                ('extra', models.JSONField(blank=True, default=dict, verbose_name='其他字段')),
+                ('synced_at', models.DateTimeField(auto_now=True, verbose_name='同步时间')),
+                ('departments', models.ManyToManyField(blank=True, db_constraint=False, related_name='users', to='django_wechat.wechatworkdepartment', verbose_name='部门')),
+            ],
+            options={
+                'verbose_name': '企业微信成员',
+                'verbose_name_plural': '企业微信成员',
+            },
+        ),
+        migrations.CreateModel(
+            name='WeChatWorkTag',
+            fields=[
+                ('tagid', models.IntegerField(primary_key=True, serialize=False, verbose_name='标签ID')),
+                ('tagname', models.CharField(blank=True, default='', max_length=64, verbose_name='标签名')),
+                ('synced_at', models.DateTimeField(auto_now=True, verbose_name='同步时间')),
+                ('departments', models.ManyToManyField(blank=True, db_constraint=False, related_name='tags', to='django_wechat.wechatworkdepartment', verbose_name='部门')),
+                ('users', models.ManyToManyField(blank=True, db_constraint=False, related_name='tags', to='django_wechat.wechatworkuser', verbose_name='成员')),
+            ],
+            options={
+                'verbose_name': '企业微信标签',
+                'verbose_name_plural': '企业微信标签',
+            },
+        ),
+    ]
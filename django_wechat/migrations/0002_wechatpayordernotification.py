@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_wechat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WeChatPayOrderNotification',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('transaction_id', models.CharField(max_length=32, unique=True, verbose_name='微信支付订单号')),
+                ('out_trade_no', models.CharField(db_index=True, max_length=32, verbose_name='商户订单号')),
+                ('appid', models.CharField(max_length=32, verbose_name='AppID')),
+                ('mch_id', models.CharField(max_length=32, verbose_name='商户号')),
+                ('openid', models.CharField(blank=True, default='', max_length=128, verbose_name='OpenID')),
+                ('trade_type', models.CharField(blank=True, default='', max_length=16, verbose_name='交易类型')),
+                ('result_code', models.CharField(max_length=16, verbose_name='业务结果')),
+                ('total_fee', models.IntegerField(verbose_name='订单金额')),
+                ('time_end', models.CharField(blank=True, default='', max_length=14, verbose_name='支付完成时间')),
+                ('data', models.JSONField(default=dict, verbose_name='通知数据')),
+                ('status', models.CharField(choices=[('received', '已接收'), ('processed', '已处理')], default='received', max_length=16, verbose_name='处理状态')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='接收时间')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='处理时间')),
+            ],
+            options={
+                'verbose_name': '微信支付结果通知',
+                'verbose_name_plural': '微信支付结果通知',
+            },
+        ),
+    ]
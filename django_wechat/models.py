@@ -1,9 +1,156 @@
 # -*- coding: utf-8 -*-
 
-from django.db import models
+import logging
+from itertools import islice
+from collections import defaultdict
 
+from django.db import migrations, models
+from django.db.models.base import ModelBase
 
-class AbstractWeChatUser(models.Model):
+
+logger = logging.getLogger(__name__)
+
+
+class WeChatUserBase(ModelBase):
+    """
+    根据OPENID_CLIENT_LABELS生成openid字段
+
+    每个应用标签生成一个openid_<label>字段，唯一且可为空，数据库为其建立唯一索引，按openid查询用户只需要一次索引查询。
+    已经显式定义或者从父类继承的同名字段不重复生成。
+    """
+    def __new__(mcs, name, bases, attrs, **kwargs):
+        labels = attrs.get('OPENID_CLIENT_LABELS')
+        if labels is None:
+            labels = next((getattr(base, 'OPENID_CLIENT_LABELS') for base in bases
+                           if hasattr(base, 'OPENID_CLIENT_LABELS')), [])
+        inherited_fields = {field.name for base in bases for klass in base.__mro__ if hasattr(klass, '_meta')
+                            for field in klass._meta.local_fields}
+        prefix = attrs.get('OPENID_PREFIX') or next(
+            (base.OPENID_PREFIX for base in bases if hasattr(base, 'OPENID_PREFIX')), 'openid')
+        separator = attrs.get('OPENID_PREFIX_SEPARATOR') or next(
+            (base.OPENID_PREFIX_SEPARATOR for base in bases if hasattr(base, 'OPENID_PREFIX_SEPARATOR')), '_')
+        for label in labels:
+            field_name = prefix + separator + label
+            if field_name not in attrs and field_name not in inherited_fields:
+                attrs[field_name] = models.CharField(max_length=64, unique=True, null=True, blank=True,
+                                                     verbose_name='OpenID（{}）'.format(label))
+        return super().__new__(mcs, name, bases, attrs, **kwargs)
+
+
+class WeChatUserManager(models.Manager):
+    def get_by_openid(self, client_label, openid):
+        """
+        按应用的openid获取用户
+        :param client_label: 应用标签，需要在OPENID_CLIENT_LABELS中
+        :param openid:
+        :return:
+        """
+        return self.get(**{self.model.get_openid_field_name(client_label): openid})
+
+    def bulk_get_by_openids(self, client_label, openids) -> dict:
+        """
+        按应用的openid批量获取用户
+        :param client_label: 应用标签，需要在OPENID_CLIENT_LABELS中
+        :param openids: openid列表
+        :return: openid -> 用户，不存在的openid不包含在内
+        """
+        return self.in_bulk(list(openids), field_name=self.model.get_openid_field_name(client_label))
+
+    def _merge_users(self, users, client_label=None) -> list:
+        """
+        规范化并合并同一批次中的重复用户，unionid或任一openid相同的视为同一用户，后出现的值覆盖先出现的值
+        """
+        model = self.model
+        field_names = {field.name for field in model._meta.concrete_fields if not field.primary_key}
+        key_fields = model.get_user_key_fields()
+        openid_field = model.get_openid_field_name(client_label) if client_label is not None else None
+
+        merged = []
+        index = {}  # (字段名, 值) -> 合并后的用户
+        for data in users:
+            row = {}
+            for key, value in data.items():
+                if key == 'openid' and openid_field is not None:
+                    key = openid_field
+                if key in field_names and value not in (None, ''):
+                    row[key] = value
+            keys = [(field, row[field]) for field in key_fields if field in row]
+            # 没有unionid和openid的数据无法定位用户，忽略
+            if not keys:
+                continue
+            target = next((index[key] for key in keys if key in index), None)
+            if target is None:
+                target = {}
+                merged.append(target)
+            target.update(row)
+            for key in keys:
+                index[key] = target
+        return merged
+
+    def _find_existing(self, rows) -> dict:
+        """
+        按unionid和各openid字段批量查询已存在的用户，每个有值的字段一条查询
+        :return: (字段名, 值) -> 主键集合，unionid不唯一时一个值可能对应多个用户
+        """
+        existing = defaultdict(set)
+        for field in self.model.get_user_key_fields():
+            values = {row[field] for row in rows if field in row}
+            if values:
+                for value, pk in self.filter(**{field + '__in': values}).values_list(field, 'pk'):
+                    existing[(field, value)].add(pk)
+        return existing
+
+    def bulk_upsert(self, users, client_label=None, batch_size=1000) -> int:
+        """
+        批量写入用户，已存在的用户更新传入的字段
+
+        逐批读取输入，输入可以是生成器，内存占用与批次大小有关。每批：
+        1. 合并同一批次中的重复用户
+        2. 按unionid和各openid字段查询已存在的用户，任一字段相同即为同一用户，比如只有openid的用户补充unionid
+        3. 已存在的用户用bulk_update只更新传入的字段，按字段组合分组，每组一条语句；新用户用一条bulk_create写入
+
+        匹配到多个已存在用户的数据（比如unionid和openid分属两个用户）无法自动合并，记录警告后跳过。
+        新用户的其他字段使用模型默认值，子类有不可为空且没有默认值的字段时需要在数据中提供。
+        :param users: 用户数据的可迭代对象，键为模型字段名
+        :param client_label: 应用标签，指定时数据中的openid键写入该应用的openid字段，便于直接导入登录结果
+        :param batch_size: 每批的用户数
+        :return: 新建和更新的用户数，已存在且没有新字段的用户和跳过的数据不计入
+        """
+        model = self.model
+        key_fields = model.get_user_key_fields()
+        users = iter(users)
+        count = 0
+        while True:
+            chunk = list(islice(users, batch_size))
+            if not chunk:
+                break
+            rows = self._merge_users(chunk, client_label)
+            existing = self._find_existing(rows)
+            updates = defaultdict(list)  # 更新的字段 -> 用户
+            creates = []
+            for row in rows:
+                pks = set().union(*(existing[(field, row[field])] for field in key_fields
+                                    if field in row and (field, row[field]) in existing))
+                if len(pks) > 1:
+                    logger.warning('用户数据匹配到多个已存在的用户，跳过：%s', row)
+                    continue
+                if not pks:
+                    creates.append(model(**row))
+                    continue
+                # 只有唯一字段且都已保存的用户不需要更新
+                update_fields = tuple(sorted(field for field in row if (field, row[field]) not in existing))
+                if update_fields:
+                    updates[update_fields].append(model(pk=pks.pop(), **row))
+            for update_fields, objs in updates.items():
+                self.bulk_update(objs, update_fields)
+                count += len(objs)
+            if creates:
+                self.bulk_create(creates)
+                count += len(creates)
+        return count
+
+
+class AbstractWeChatUser(models.Model, metaclass=WeChatUserBase):
     unionid = models.CharField(max_length=32, verbose_name='UnionID')
 
     # unionid字段设置
@@ -13,10 +160,200 @@ class AbstractWeChatUser(models.Model):
     OPENID_PREFIX_SEPARATOR = '_'
     OPENID_CLIENT_LABELS = []  # 用以设置和生成openid字段
 
+    objects = WeChatUserManager()
+
     class Meta:
         abstract = True
 
+    @classmethod
+    def get_openid_field_name(cls, client_label) -> str:
+        """
+        应用标签对应的openid字段名
+        """
+        if client_label not in cls.OPENID_CLIENT_LABELS:
+            raise ValueError('应用标签不在OPENID_CLIENT_LABELS中：{}'.format(client_label))
+        return cls.OPENID_PREFIX + cls.OPENID_PREFIX_SEPARATOR + client_label
+
+    @classmethod
+    def get_user_key_fields(cls) -> list:
+        """
+        可以唯一确定用户的字段，依次为unionid字段和各应用的openid字段
+        """
+        return [cls.UNIONID_FIELD] + [cls.get_openid_field_name(label) for label in cls.OPENID_CLIENT_LABELS]
+
+    def save(self, *args, **kwargs):
+        # 可为空的唯一字段的空字符串保存为NULL，没有unionid或openid的多个用户不会违反唯一约束
+        for field in self.get_user_key_fields():
+            if getattr(self, field) == '' and self._meta.get_field(field).null:
+                setattr(self, field, None)
+        super().save(*args, **kwargs)
+
+
+class AbstractUniqueUnionIDWeChatUser(AbstractWeChatUser):
+    """
+    unionid唯一且可为空的微信用户，没有绑定开放平台的用户unionid为NULL
+
+    需要显式继承。已有数据的模型改为继承这个类时，用unique_unionid_operations生成迁移，
+    先把空字符串改为NULL再添加唯一约束。
+    """
+    unionid = models.CharField(max_length=32, unique=True, null=True, blank=True, verbose_name='UnionID')
+
+    class Meta:
+        abstract = True
+
+
+def convert_blank_to_null(model_label, field_names=('unionid',)):
+    """
+    生成数据迁移函数，把字段中的空字符串改为NULL
+    :param model_label: 模型标签，比如'accounts.User'
+    :param field_names: 字段名
+    :return: 用于migrations.RunPython的函数
+    """
+    def forwards(apps, schema_editor):
+        model = apps.get_model(model_label)
+        for field_name in field_names:
+            model._default_manager.using(schema_editor.connection.alias) \
+                .filter(**{field_name: ''}).update(**{field_name: None})
+    return forwards
+
+
+def unique_unionid_operations(model_label, field_name='unionid') -> list:
+    """
+    生成把unionid改为唯一且可为空的迁移操作，用于改为继承AbstractUniqueUnionIDWeChatUser的模型
+
+    分为三步，否则添加唯一约束时空字符串重复：
+    1. 允许为空
+    2. 空字符串改为NULL
+    3. 添加唯一约束
+
+    迁移文件中使用：
+        operations = unique_unionid_operations('accounts.User')
+    :param model_label: 模型标签，比如'accounts.User'
+    :param field_name: unionid字段名
+    :return: 迁移操作列表
+    """
+    model_name = model_label.split('.')[-1].lower()
+    return [
+        migrations.AlterField(model_name, field_name,
+                              models.CharField(max_length=32, null=True, blank=True, verbose_name='UnionID')),
+        migrations.RunPython(convert_blank_to_null(model_label, (field_name,)), migrations.RunPython.noop),
+        migrations.AlterField(model_name, field_name,
+                              models.CharField(max_length=32, unique=True, null=True, blank=True,
+                                               verbose_name='UnionID')),
+    ]
+
 
 class WeChatUser(AbstractWeChatUser):
     class Meta:
         managed = False
+
+
+# ----- 企业微信通讯录本地镜像 -----
+
+class WeChatWorkDepartment(models.Model):
+    """
+    企业微信部门，主键为企业微信的部门ID
+    """
+    id = models.IntegerField(primary_key=True, verbose_name='部门ID')
+    name = models.CharField(max_length=64, blank=True, default='', verbose_name='名称')
+    parentid = models.IntegerField(default=0, db_index=True, verbose_name='父部门ID')
+    order = models.BigIntegerField(default=0, verbose_name='次序值')
+    synced_at = models.DateTimeField(auto_now=True, verbose_name='同步时间')
+
+    class Meta:
+        verbose_name = '企业微信部门'
+        verbose_name_plural = verbose_name
+
+
+class WeChatWorkUserManager(models.Manager):
+    def get_or_fetch(self, userid):
+        """
+        优先从本地镜像读取成员，本地不存在时从企业微信读取并写入本地镜像
+        :param userid: 成员UserID
+        :return:
+        """
+        try:
+            return self.get(userid=userid)
+        except self.model.DoesNotExist:
+            from django_wechat.contacts import fetch_user
+            return fetch_user(userid)
+
+
+class WeChatWorkUser(models.Model):
+    """
+    企业微信成员
+    """
+    id = models.BigAutoField(primary_key=True)
+    userid = models.CharField(max_length=64, unique=True, verbose_name='UserID')
+    name = models.CharField(max_length=64, blank=True, default='', verbose_name='姓名')
+    alias = models.CharField(max_length=64, blank=True, default='', verbose_name='别名')
+    mobile = models.CharField(max_length=32, blank=True, default='', db_index=True, verbose_name='手机号')
+    email = models.CharField(max_length=128, blank=True, default='', db_index=True, verbose_name='邮箱')
+    position = models.CharField(max_length=128, blank=True, default='', verbose_name='职务')
+    gender = models.CharField(max_length=1, blank=True, default='', verbose_name='性别')
+    status = models.IntegerField(default=1, verbose_name='激活状态')
+    avatar = models.CharField(max_length=512, blank=True, default='', verbose_name='头像')
+    main_department = models.IntegerField(null=True, blank=True, verbose_name='主部门ID')
+    # 回调事件可能先于部门事件到达，不建立数据库外键约束
+    departments = models.ManyToManyField(WeChatWorkDepartment, related_name='users', db_constraint=False,
+                                         blank=True, verbose_name='部门')
+    # 其他字段原样保存
+    extra = models.JSONField(default=dict, blank=True, verbose_name='其他字段')
+    synced_at = models.DateTimeField(auto_now=True, verbose_name='同步时间')
+
+    objects = WeChatWorkUserManager()
+
+    class Meta:
+        verbose_name = '企业微信成员'
+        verbose_name_plural = verbose_name
+
+
+class WeChatWorkTag(models.Model):
+    """
+    企业微信标签，主键为企业微信的标签ID
+    """
+    tagid = models.IntegerField(primary_key=True, verbose_name='标签ID')
+    tagname = models.CharField(max_length=64, blank=True, default='', verbose_name='标签名')
+    users = models.ManyToManyField(WeChatWorkUser, related_name='tags', db_constraint=False, blank=True,
+                                   verbose_name='成员')
+    departments = models.ManyToManyField(WeChatWorkDepartment, related_name='tags', db_constraint=False,
+                                         blank=True, verbose_name='部门')
+    synced_at = models.DateTimeField(auto_now=True, verbose_name='同步时间')
+
+    class Meta:
+        verbose_name = '企业微信标签'
+        verbose_name_plural = verbose_name
+
+
+# ----- 微信支付 -----
+
+class WeChatPayOrderNotification(models.Model):
+    """
+    微信支付结果通知，同一微信支付订单号只保存一条
+    """
+    STATUS_RECEIVED = 'received'
+    STATUS_PROCESSED = 'processed'
+    STATUS_CHOICES = (
+        (STATUS_RECEIVED, '已接收'),
+        (STATUS_PROCESSED, '已处理'),
+    )
+
+    id = models.BigAutoField(primary_key=True)
+    transaction_id = models.CharField(max_length=32, unique=True, verbose_name='微信支付订单号')
+    out_trade_no = models.CharField(max_length=32, db_index=True, verbose_name='商户订单号')
+    appid = models.CharField(max_length=32, verbose_name='AppID')
+    mch_id = models.CharField(max_length=32, verbose_name='商户号')
+    openid = models.CharField(max_length=128, blank=True, default='', verbose_name='OpenID')
+    trade_type = models.CharField(max_length=16, blank=True, default='', verbose_name='交易类型')
+    result_code = models.CharField(max_length=16, verbose_name='业务结果')
+    total_fee = models.IntegerField(verbose_name='订单金额')
+    time_end = models.CharField(max_length=14, blank=True, default='', verbose_name='支付完成时间')
+    # 通知原始数据
+    data = models.JSONField(default=dict, verbose_name='通知数据')
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_RECEIVED, verbose_name='处理状态')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='接收时间')
+    processed_at = models.DateTimeField(null=True, blank=True, verbose_name='处理时间')
+
+    class Meta:
+        verbose_name = '微信支付结果通知'
+        verbose_name_plural = verbose_name
@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+"""
+微信支付结果通知处理
+
+通知视图验证签名后：
+1. 在请求中调用save_notification，以transaction_id为唯一键插入WeChatPayOrderNotification，重复通知插入时被忽略；
+   保存成功后才应答微信支付，进程崩溃或重启不会丢失已应答的通知
+2. 由分发器在工作线程中调用handle_payment_notify，发送wechatpay_order_notified信号
+3. 所有接收函数成功后才把记录从已接收改为已处理，写入“已处理”缓存；
+   处理失败的通知保持已接收状态，由微信支付的重复通知或process_received_notifications重试
+
+微信支付在应答超时或失败时会重复通知，视图先查“已处理”缓存，命中时直接应答，不再分发。
+
+reconcile_wechatpay_bill用交易账单和已保存的支付结果通知双向对账，同时检查账单中缺少的已支付订单。
+
+WeChatPayOrderPoller在服务端轮询未支付订单，结果写入订单状态缓存，前端轮询时只需读取get_cached_order_state。
+
+Django settings可以指定轮询参数（均为可选项）：
+WECHATPAY_ORDER_POLLER = {
+    'MAX_WORKERS': 8,      # 并发查询数
+    'MIN_INTERVAL': 2,     # 首次查询和查询间隔的最小秒数
+    'MAX_INTERVAL': 30,    # 查询间隔的最大秒数
+    'BACKOFF': 1.5,        # 订单仍未支付时查询间隔的增长倍数
+    'TIMEOUT': 1800,       # 超过该秒数仍未支付的订单不再轮询
+}
+"""
+
+import time
+import logging
+import datetime
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from django_wechat.models import WeChatPayOrderNotification
+from django_wechat.signals import wechatpay_order_notified
+
+
+logger = logging.getLogger(__name__)
+
+# “已处理”缓存键前缀
+PROCESSED_CACHE_PREFIX = 'wechatpay_notify_processed_'
+# 订单状态缓存键前缀，键为商户订单号
+ORDER_STATE_CACHE_PREFIX = 'wechatpay_order_state_'
+# 处理锁缓存键前缀
+PROCESSING_LOCK_PREFIX = 'wechatpay_notify_processing_'
+# 缓存保留的秒数
+WECHATPAY_NOTIFY_CACHE_TIMEOUT = getattr(settings, 'WECHATPAY_NOTIFY_CACHE_TIMEOUT', 24 * 3600)
+# 处理锁的超时秒数，应大于wechatpay_order_notified接收函数的最长耗时
+WECHATPAY_NOTIFY_LOCK_TIMEOUT = getattr(settings, 'WECHATPAY_NOTIFY_LOCK_TIMEOUT', 300)
+
+# 通知数据中对应模型字段的部分
+NOTIFICATION_FIELDS = ('out_trade_no', 'appid', 'mch_id', 'openid', 'trade_type', 'result_code', 'time_end')
+
+
+def is_processed(transaction_id) -> bool:
+    """
+    通知是否已经处理过
+    """
+    return cache.get(PROCESSED_CACHE_PREFIX + transaction_id) is not None
+
+
+def cache_order_state(out_trade_no, state: dict):
+    """
+    缓存订单状态，供轮询和查询接口直接读取
+    :param out_trade_no: 商户订单号
+    :param state: 订单状态，包含trade_state
+    """
+    cache.set(ORDER_STATE_CACHE_PREFIX + out_trade_no, state, timeout=WECHATPAY_NOTIFY_CACHE_TIMEOUT)
+
+
+def cache_pending_order_state(out_trade_no, state: dict) -> dict:
+    """
+    缓存未进入最终状态的订单状态，已缓存最终状态时不覆盖
+    :param out_trade_no: 商户订单号
+    :param state: 订单状态，包含trade_state
+    :return: 缓存后的订单状态，已缓存最终状态时为缓存的最终状态
+    """
+    cached_state = get_cached_order_state(out_trade_no)
+    if cached_state is not None and cached_state['trade_state'] in FINAL_TRADE_STATES:
+        return cached_state
+    cache_order_state(out_trade_no, state)
+    return state
+
+
+def get_cached_order_state(out_trade_no):
+    """
+    读取缓存的订单状态，由支付结果通知或WeChatPayOrderPoller写入
+    :param out_trade_no: 商户订单号
+    :return: 订单状态，包含trade_state；没有缓存时为None
+    """
+    return cache.get(ORDER_STATE_CACHE_PREFIX + out_trade_no)
+
+
+def notification_from_data(data: dict) -> WeChatPayOrderNotification:
+    fields = {field: data.get(field) or '' for field in NOTIFICATION_FIELDS}
+    return WeChatPayOrderNotification(transaction_id=data['transaction_id'], total_fee=int(data['total_fee']),
+                                      data=data, **fields)
+
+
+def save_notification(data: dict):
+    """
+    幂等地保存通知，视图在应答微信支付之前调用
+    :param data: 验证签名后的通知数据
+    """
+    WeChatPayOrderNotification.objects.bulk_create([notification_from_data(data)], ignore_conflicts=True)
+    trade_state = 'SUCCESS' if data.get('result_code') == 'SUCCESS' else 'PAYERROR'
+    cache_order_state(data['out_trade_no'], {
+        'trade_state': trade_state,
+        'transaction_id': data['transaction_id'],
+        'total_fee': int(data['total_fee']),
+        'time_end': data.get('time_end'),
+    })
+
+
+def process_notification(transaction_id) -> bool:
+    """
+    发送wechatpay_order_notified信号处理已保存的通知，所有接收函数成功后才标记为已处理
+
+    同一通知同时只有一个调用方处理；处理失败时保持已接收状态，可以再次调用重试
+    :param transaction_id: 微信支付订单号
+    :return: 是否由本次调用处理成功
+    """
+    lock_key = PROCESSING_LOCK_PREFIX + transaction_id
+    if not cache.add(lock_key, 1, timeout=WECHATPAY_NOTIFY_LOCK_TIMEOUT):
+        return False
+    try:
+        notification = WeChatPayOrderNotification.objects \
+            .filter(transaction_id=transaction_id, status=WeChatPayOrderNotification.STATUS_RECEIVED).first()
+        if notification is None:
+            return False
+        succeeded = True
+        for receiver, response in wechatpay_order_notified.send_robust(sender=None, notification=notification):
+            if isinstance(response, Exception):
+                succeeded = False
+                logger.error('微信支付结果通知处理失败：%r', receiver, exc_info=response)
+        if not succeeded:
+            return False
+        processed = WeChatPayOrderNotification.objects \
+            .filter(pk=notification.pk, status=WeChatPayOrderNotification.STATUS_RECEIVED) \
+            .update(status=WeChatPayOrderNotification.STATUS_PROCESSED, processed_at=timezone.now())
+        cache.set(PROCESSED_CACHE_PREFIX + transaction_id, 1, timeout=WECHATPAY_NOTIFY_CACHE_TIMEOUT)
+        return bool(processed)
+    finally:
+        cache.delete(lock_key)
+
+
+def record_notification(data: dict) -> bool:
+    """
+    保存并处理通知，用于不经过通知视图的场景
+    :param data: 验证签名后的通知数据
+    :return: 是否由本次调用处理成功
+    """
+    save_notification(data)
+    return process_notification(data['transaction_id'])
+
+
+def process_received_notifications(older_than: int = 60, limit: int = 100) -> int:
+    """
+    重试处理失败的通知，可以在定时任务中调用
+    :param older_than: 只处理接收超过该秒数的通知，避开正在处理的通知
+    :param limit: 最多处理的通知数
+    :return: 处理成功的通知数
+    """
+    transaction_ids = WeChatPayOrderNotification.objects \
+        .filter(status=WeChatPayOrderNotification.STATUS_RECEIVED,
+                created_at__lt=timezone.now() - datetime.timedelta(seconds=older_than)) \
+        .order_by('created_at').values_list('transaction_id', flat=True)[:limit]
+    return sum(process_notification(transaction_id) for transaction_id in list(transaction_ids))
+
+
+def handle_payment_notify(sender, data, **kwargs):
+    """
+    wechatpay_notify信号的接收函数，在DjangoWeChatConfig.ready中连接；通知已由视图保存
+    """
+    process_notification(data['transaction_id'])
+
+
+# ----- 对账 -----
+
+def lookup_notified_orders(out_trade_nos: list) -> dict:
+    """
+    批量查询已保存支付结果通知的订单，用作reconcile_bill的lookup
+    :return: 商户订单号 -> {'total_fee': 分, 'trade_state': 交易状态}
+    """
+    notifications = WeChatPayOrderNotification.objects.filter(out_trade_no__in=out_trade_nos) \
+        .values_list('out_trade_no', 'total_fee', 'result_code')
+    return {
+        out_trade_no: {'total_fee': total_fee, 'trade_state': 'SUCCESS' if result_code == 'SUCCESS' else 'PAYERROR'}
+        for out_trade_no, total_fee, result_code in notifications
+    }
+
+
+def iter_notified_orders(bill_date: str):
+    """
+    逐条读取账单日期内支付成功的支付结果通知，用作reconcile_bill的local_orders
+    按支付完成时间time_end筛选，临近零点支付的订单可能和账单日期不一致
+    :param bill_date: 账单日期，格式为20200915
+    :return: {'out_trade_no', 'total_fee': 分, 'trade_state': 'SUCCESS'}的迭代器
+    """
+    notifications = WeChatPayOrderNotification.objects \
+        .filter(time_end__startswith=bill_date, result_code='SUCCESS') \
+        .values_list('out_trade_no', 'total_fee').iterator()
+    for out_trade_no, total_fee in notifications:
+        yield {'out_trade_no': out_trade_no, 'total_fee': total_fee, 'trade_state': 'SUCCESS'}
+
+
+def reconcile_wechatpay_bill(client_label, bill_date: str, lookup=lookup_notified_orders,
+                             local_orders=iter_notified_orders) -> list:
+    """
+    下载交易账单并和本地订单双向对账
+    :param client_label: 应用标签
+    :param bill_date: 账单日期，格式为20200915
+    :param lookup: 批量查询本地订单的函数，默认使用支付结果通知
+    :param local_orders: 参数为账单日期、返回本地已支付订单的函数，默认使用支付结果通知；为None时不检查账单中缺少的订单
+    :return: 不一致的记录，详见reconcile_bill
+    """
+    from django_wechat.sdk.pay import download_bill, reconcile_bill
+    return list(reconcile_bill(download_bill(client_label, bill_date, tar_type='GZIP'), lookup,
+                               local_orders=local_orders(bill_date) if local_orders is not None else None))
+
+
+# ----- 订单状态轮询 -----
+
+# 订单的最终交易状态，不会再变化
+FINAL_TRADE_STATES = ('SUCCESS', 'REFUND', 'CLOSED', 'REVOKED', 'PAYERROR')
+
+# 默认轮询参数
+POLLER_DEFAULTS = {
+    'MAX_WORKERS': 8,
+    'MIN_INTERVAL': 2,
+    'MAX_INTERVAL': 30,
+    'BACKOFF': 1.5,
+    'TIMEOUT': 1800,
+}
+
+
+def get_poller_settings() -> dict:
+    """
+    读取轮询设置，用户设置覆盖默认参数
+    """
+    user_settings = getattr(settings, 'WECHATPAY_ORDER_POLLER', None) or {}
+    return dict(POLLER_DEFAULTS, **user_settings)
+
+
+def order_state_from_query(result: dict) -> dict:
+    """
+    把查询订单接口的结果转成订单状态
+    """
+    state = {'trade_state': result['trade_state']}
+    for field in ('transaction_id', 'time_end'):
+        if result.get(field):
+            state[field] = result[field]
+    if result.get('total_fee'):
+        state['total_fee'] = int(result['total_fee'])
+    return state
+
+
+class WeChatPayOrderPoller(object):
+    """
+    未支付订单的服务端轮询
+
+    - 每轮只查询到期的订单，先用一次cache.get_many跳过已收到支付结果通知的订单
+    - 到期订单在线程池中并发查询，并发数不超过MAX_WORKERS
+    - 订单仍未支付时查询间隔按BACKOFF倍数增长，查询失败时加倍，最长MAX_INTERVAL秒
+    - 订单进入最终状态或超过TIMEOUT秒后不再轮询
+    """
+    def __init__(self, client_label, query=None, poller_settings: dict = None):
+        """
+        :param client_label: 应用标签
+        :param query: 查询订单的函数，参数同query_wechatpay_order，默认为query_wechatpay_order
+        :param poller_settings: 轮询设置，默认读取Django settings
+        """
+        if query is None:
+            from django_wechat.sdk.pay import query_wechatpay_order
+            query = query_wechatpay_order
+        if poller_settings is None:
+            poller_settings = get_poller_settings()
+        self.client_label = client_label
+        self.query = query
+        self.settings = poller_settings
+        self.executor = ThreadPoolExecutor(max_workers=poller_settings['MAX_WORKERS'],
+                                           thread_name_prefix='wechatpay-poller')
+        # 商户订单号 -> {'next_poll_at', 'interval', 'deadline'}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+
+    @property
+    def pending(self) -> list:
+        with self._lock:
+            return list(self._pending)
+
+    def add(self, out_trade_no):
+        """
+        开始轮询订单，已在轮询中时不重复添加
+        :param out_trade_no: 商户订单号
+        """
+        now = time.time()
+        with self._lock:
+            self._pending.setdefault(out_trade_no, {
+                'next_poll_at': now + self.settings['MIN_INTERVAL'],
+                'interval': self.settings['MIN_INTERVAL'],
+                'deadline': now + self.settings['TIMEOUT'],
+            })
+        self._wakeup.set()
+
+    def discard(self, out_trade_no):
+        """
+        停止轮询订单
+        """
+        with self._lock:
+            self._pending.pop(out_trade_no, None)
+
+    def _reschedule(self, out_trade_no, now, factor):
+        with self._lock:
+            order = self._pending.get(out_trade_no)
+            if order is None:
+                return
+            if now >= order['deadline']:
+                del self._pending[out_trade_no]
+                return
+            order['interval'] = min(order['interval'] * factor, self.settings['MAX_INTERVAL'])
+            order['next_poll_at'] = now + order['interval']
+
+    def _query(self, out_trade_no):
+        return order_state_from_query(self.query(self.client_label, out_trade_no=out_trade_no))
+
+    def poll_once(self, now: float = None) -> dict:
+        """
+        查询到期的订单
+        :param now: 当前时间戳，默认为time.time()
+        :return: 商户订单号 -> 订单状态，不包含查询失败的订单
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            due = [out_trade_no for out_trade_no, order in self._pending.items() if order['next_poll_at'] <= now]
+        if not due:
+            return {}
+
+        # 已收到支付结果通知的订单不再查询
+        cached_states = cache.get_many([ORDER_STATE_CACHE_PREFIX + out_trade_no for out_trade_no in due])
+        results = {}
+        futures = {}
+        for out_trade_no in due:
+            state = cached_states.get(ORDER_STATE_CACHE_PREFIX + out_trade_no)
+            if state is not None and state['trade_state'] in FINAL_TRADE_STATES:
+                self.discard(out_trade_no)
+                results[out_trade_no] = state
+            else:
+                futures[self.executor.submit(self._query, out_trade_no)] = out_trade_no
+
+        for future in as_completed(futures):
+            out_trade_no = futures[future]
+            try:
+                state = future.result()
+            except Exception:
+                logger.warning('查询微信支付订单失败：%s', out_trade_no, exc_info=True)
+                self._reschedule(out_trade_no, now, 2)
+                continue
+            if state['trade_state'] in FINAL_TRADE_STATES:
+                cache_order_state(out_trade_no, state)
+            else:
+                # 更新未支付的状态，但不覆盖支付结果通知同时写入的最终状态
+                state = cache_pending_order_state(out_trade_no, state)
+            results[out_trade_no] = state
+            if state['trade_state'] in FINAL_TRADE_STATES:
+                self.discard(out_trade_no)
+            else:
+                self._reschedule(out_trade_no, now, self.settings['BACKOFF'])
+        return results
+
+    # ----- 后台轮询 -----
+
+    def _next_wait(self) -> float:
+        with self._lock:
+            if not self._pending:
+                return self.settings['MAX_INTERVAL']
+            return max(0, min(order['next_poll_at'] for order in self._pending.values()) - time.time())
+
+    def run(self):
+        """
+        持续轮询，直到调用stop
+        """
+        while not self._stop_event.is_set():
+            try:
+                self.poll_once()
+            except Exception:
+                logger.exception('微信支付订单轮询失败')
+            self._wakeup.wait(self._next_wait())
+            self._wakeup.clear()
+
+    def start(self) -> threading.Thread:
+        """
+        启动后台轮询线程，已启动时直接返回
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self.run, name='wechatpay-poller', daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def stop(self, timeout: float = None):
+        """
+        停止后台轮询线程
+        """
+        self._stop_event.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+@lru_cache(maxsize=None)
+def get_order_poller(client_label) -> WeChatPayOrderPoller:
+    """
+    获取应用的订单轮询器，同一进程内共享，首次获取时启动后台轮询线程
+    """
+    poller = WeChatPayOrderPoller(client_label)
+    poller.start()
+    return poller
+
+
+def poll_wechatpay_order(client_label, out_trade_no):
+    """
+    创建订单后开始在服务端轮询，前端通过get_cached_order_state读取结果
+    :param client_label: 应用标签
+    :param out_trade_no: 商户订单号
+    """
+    get_order_poller(client_label).add(out_trade_no)
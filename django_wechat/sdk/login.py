@@ -1,12 +1,206 @@
 # -*- coding: utf-8 -*-
+"""
+微信登录服务端API
 
-import json
+- code换取的登录结果在code有效期内缓存，重复提交的登录请求使用缓存结果，同一code同时只请求一次微信
+- 网站应用、公众号等OAuth2登录按openid保存access_token和refresh_token，过期后用refresh_token续期，不需要重新登录
+- 用户信息按openid缓存
+- 各应用的AppID、AppSecret和接口参数在启动时计算一次
 
-import requests
+Django settings传入格式示例（均为可选项）：
+WECHAT_LOGIN_CACHE = {
+    'CODE_TIMEOUT': 300,           # 登录结果的缓存秒数，code的有效期为5分钟
+    'USERINFO_TIMEOUT': 3600,      # 用户信息的缓存秒数
+    'TOKEN_TIMEOUT': 30 * 86400,   # access_token和refresh_token的缓存秒数，refresh_token的有效期为30天
+    'EARLY_RENEWAL': 300,          # access_token提前续期的秒数
+    'LOCK_TIMEOUT': 10,            # 换取登录结果的锁超时秒数
+    'WAIT_TIMEOUT': 5,             # 等待其他请求换取登录结果的最长秒数
+}
+"""
+
+import time
+import hashlib
+from functools import lru_cache
 
 from django.conf import settings
+from django.core.cache import cache
 from wechatpy.oauth import WeChatOAuth
 
+from django_wechat.sdk.sessions import request_json
+
+# 微信登录API根URL
+WECHAT_LOGIN_API_ROOT_URL = 'https://api.weixin.qq.com/sns/'
+
+# access_token无效或者已过期的错误码
+INVALID_ACCESS_TOKEN_ERRCODES = (40001, 40014, 42001)
+
+# code无效（40029）或者已使用（40163）的错误码，重试也不会成功，和成功结果一样缓存
+INVALID_CODE_ERRCODES = (40029, 40163)
+
+# 默认参数
+DEFAULTS = {
+    'CODE_TIMEOUT': 300,
+    'USERINFO_TIMEOUT': 3600,
+    'TOKEN_TIMEOUT': 30 * 86400,
+    'EARLY_RENEWAL': 300,
+    'LOCK_TIMEOUT': 10,
+    'WAIT_TIMEOUT': 5,
+}
+
+# 等待其他请求换取登录结果时轮询缓存的间隔秒数
+POLL_INTERVAL = 0.05
+
+# 缓存键前缀
+CODE_CACHE_PREFIX = 'wechat_login_code_'
+TOKEN_CACHE_PREFIX = 'wechat_login_token_'
+USERINFO_CACHE_PREFIX = 'wechat_login_userinfo_'
+
+
+def get_login_settings() -> dict:
+    """
+    读取登录设置，用户设置覆盖默认参数
+    """
+    user_settings = getattr(settings, 'WECHAT_LOGIN_CACHE', None) or {}
+    return dict(DEFAULTS, **user_settings)
+
+
+# ----- Exception -----
+
+class WeChatLoginException(Exception):
+    @property
+    def errcode(self):
+        """
+        微信返回的错误码，非接口返回的异常为None
+        """
+        data = self.args[0] if self.args else None
+        if isinstance(data, dict):
+            return data.get('errcode')
+        return None
+
+
+def check_response(response: dict) -> dict:
+    if response.get('errcode'):
+        raise WeChatLoginException(response)
+    return response
+
+
+# ----- 应用凭据 -----
+
+class LoginCredential(object):
+    """
+    应用的登录凭据和换取code的接口参数
+    """
+    def __init__(self, client_label, client_type, appid, secret):
+        self.client_label = client_label
+        self.client_type = client_type
+        self.appid = appid
+        self.secret = secret
+        # 微信小程序使用小程序接口
+        if client_type == 'mp':
+            self.code_url = WECHAT_LOGIN_API_ROOT_URL + 'jscode2session'
+            self.code_type = 'js_code'
+        # 网站应用、移动应用、微信公众号等使用OAuth2接口
+        else:
+            self.code_url = WECHAT_LOGIN_API_ROOT_URL + 'oauth2/access_token'
+            self.code_type = 'code'
+        self._code_params = {'appid': appid, 'secret': secret, 'grant_type': 'authorization_code'}
+
+    @property
+    def is_oauth(self) -> bool:
+        return self.client_type != 'mp'
+
+    def code_params(self, code) -> dict:
+        return dict(self._code_params, **{self.code_type: code})
+
+
+@lru_cache(maxsize=None)
+def get_login_credential(client_type, client_label=None) -> LoginCredential:
+    """
+    获取应用的登录凭据，同一进程内只读取一次settings
+    :param client_type: 微信应用类型，可选settings.QTAPP_CLIENT_TYPES
+    :param client_label: 微信应用的标签，默认为settings.WECHAT_LOGIN_DEFAULT_CLIENT_LABELS[client_type]
+    :return:
+    """
+    # TODO: 验证client_label是否符合client_type
+    if client_label is None:
+        client_label = settings.WECHAT_LOGIN_DEFAULT_CLIENT_LABELS[client_type]
+    wechat_client_secrets = settings.WECHAT_APP_SECRETS[client_label]
+    return LoginCredential(client_label, client_type, wechat_client_secrets['appid'],
+                           wechat_client_secrets['app_secret'])
+
+
+def load_login_credentials():
+    """
+    启动时计算settings.WECHAT_LOGIN_DEFAULT_CLIENT_LABELS中各应用的登录凭据
+    """
+    for client_type, client_label in getattr(settings, 'WECHAT_LOGIN_DEFAULT_CLIENT_LABELS', {}).items():
+        get_login_credential(client_type)
+        get_login_credential(client_type, client_label)
+
+
+# ----- code换取登录结果 -----
+
+def get_code_cache_key(credential: LoginCredential, code) -> str:
+    return CODE_CACHE_PREFIX + hashlib.sha1('{}:{}'.format(credential.appid, code).encode()).hexdigest()
+
+
+def _wait_for_result(key, wait_timeout):
+    """
+    等待其他请求换取登录结果，对方失败时立即抛出相同的异常
+    """
+    error_key = key + '_error'
+    deadline = time.time() + wait_timeout
+    while time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        values = cache.get_many([key, error_key])
+        if key in values:
+            return values[key]
+        if error_key in values:
+            raise WeChatLoginException(values[error_key])
+    raise WeChatLoginException('登录请求处理超时')
+
+
+def exchange_code(code, client_type, client_label=None) -> dict:
+    """
+    使用临时票据code换取登录结果，结果在code有效期内缓存
+
+    code只能使用一次，重复提交的登录请求读取缓存；同时提交时只有一个请求调用微信，其他请求等待结果。
+    code无效或已使用的错误结果同样缓存；限流、系统繁忙等临时性错误不缓存，code仍然可以重试，
+    同时等待的请求立即收到相同的异常。
+    :param code: 临时票据
+    :param client_type: 微信应用类型
+    :param client_label: 微信应用的标签
+    :return: 微信返回的登录结果
+    """
+    credential = get_login_credential(client_type, client_label)
+    login_settings = get_login_settings()
+    key = get_code_cache_key(credential, code)
+    error_key = key + '_error'
+
+    result = cache.get(key)
+    if result is None:
+        if cache.add(key + '_lock', 1, timeout=login_settings['LOCK_TIMEOUT']):
+            # 清除上一次失败的记录，避免本次等待的请求读到
+            cache.delete(error_key)
+            try:
+                result = request_json('GET', credential.code_url, params=credential.code_params(code))
+            except Exception as e:
+                cache.set(error_key, {'errmsg': str(e) or repr(e)}, timeout=login_settings['LOCK_TIMEOUT'])
+                raise
+            else:
+                errcode = result.get('errcode')
+                if not errcode or errcode in INVALID_CODE_ERRCODES:
+                    cache.set(key, result, timeout=login_settings['CODE_TIMEOUT'])
+                else:
+                    cache.set(error_key, result, timeout=login_settings['LOCK_TIMEOUT'])
+                if credential.is_oauth and not errcode:
+                    save_oauth_token(credential, result)
+            finally:
+                cache.delete(key + '_lock')
+        else:
+            result = _wait_for_result(key, login_settings['WAIT_TIMEOUT'])
+    return check_response(result)
+
 
 def get_openid(code, client_type, client_label=None):
     """
@@ -20,50 +214,98 @@ def get_openid(code, client_type, client_label=None):
     :param client_label: 微信应用的标签
     :return:
     """
-    # TODO: 验证client_label是否符合client_type
+    return exchange_code(code, client_type, client_label)
 
-    # 根据client_type和client_label读取AppID和AppSecret
-    if client_label is None:
-        client_label = settings.WECHAT_LOGIN_DEFAULT_CLIENT_LABELS[client_type]
-        wechat_client_secrets = settings.WECHAT_APP_SECRETS[client_label]
-    else:
-        wechat_client_secrets = settings.WECHAT_APP_SECRETS[client_label]
-    appid = wechat_client_secrets['appid']
-    secret = wechat_client_secrets['app_secret']
-
-    # 拼接API的URL
-    # 微信小程序使用小程序接口
-    if client_type == 'mp':
-        api_path = 'sns/jscode2session'
-        code_type = 'js_code'
-    # 网站应用、移动应用、微信公众号等使用OAuth2接口
-    else:
-        api_path = 'sns/oauth2/access_token'
-        code_type = 'code'
-    login_url: str = 'https://api.weixin.qq.com/{api_path}?appid={appid}&secret={secret}&{code_type}={code}&grant_type=authorization_code'\
-        .format(api_path=api_path, appid=appid, secret=secret, code_type=code_type, code=code)
-
-    # 请求微信登录服务器
-    content = requests.get(login_url).content
-    # 将json数据包转成字典
-    response: dict = json.loads(content)
-
-    if 'errcode' in response:
-        # TODO: 定义异常类
-        raise response
 
-    return response
+# ----- OAuth2 access_token -----
+
+def save_oauth_token(credential: LoginCredential, data: dict):
+    """
+    按openid保存OAuth2的access_token和refresh_token
+    :param credential: 应用的登录凭据
+    :param data: 换取code或刷新access_token的结果
+    """
+    token = {
+        'client_type': credential.client_type,
+        'client_label': credential.client_label,
+        'access_token': data['access_token'],
+        'refresh_token': data['refresh_token'],
+        'expires_at': time.time() + int(data['expires_in']),
+        'scope': data.get('scope'),
+    }
+    cache.set(TOKEN_CACHE_PREFIX + data['openid'], token, timeout=get_login_settings()['TOKEN_TIMEOUT'])
 
 
-def get_unionid(openid, access_token):
+def refresh_access_token(openid) -> str:
     """
-    获取unionid和userinfo
+    使用refresh_token刷新access_token
+    详细说明：https://developers.weixin.qq.com/doc/oplatform/Website_App/WeChat_Login/Authorized_Interface_Calling_UnionID.html
     :param openid:
-    :param access_token:
+    :return: 新的access_token
+    """
+    token = cache.get(TOKEN_CACHE_PREFIX + openid)
+    if token is None:
+        raise WeChatLoginException('refresh_token不存在或已过期，需要重新登录')
+    credential = get_login_credential(token['client_type'], token['client_label'])
+    data = check_response(request_json('GET', WECHAT_LOGIN_API_ROOT_URL + 'oauth2/refresh_token', params={
+        'appid': credential.appid, 'grant_type': 'refresh_token', 'refresh_token': token['refresh_token'],
+    }))
+    save_oauth_token(credential, data)
+    return data['access_token']
+
+
+def get_access_token(openid) -> str:
+    """
+    获取用户的OAuth2 access_token，临近过期时用refresh_token续期
+    :param openid:
+    :return:
+    """
+    token = cache.get(TOKEN_CACHE_PREFIX + openid)
+    if token is None:
+        raise WeChatLoginException('access_token不存在或已过期，需要重新登录')
+    if token['expires_at'] - get_login_settings()['EARLY_RENEWAL'] > time.time():
+        return token['access_token']
+    return refresh_access_token(openid)
+
+
+# ----- 用户信息 -----
+
+def _request_userinfo(openid, access_token) -> dict:
+    return request_json('GET', WECHAT_LOGIN_API_ROOT_URL + 'userinfo',
+                        params={'access_token': access_token, 'openid': openid})
+
+
+def get_userinfo(openid, access_token=None, refresh=False) -> dict:
+    """
+    获取用户信息，按openid缓存
+    :param openid:
+    :param access_token: 用户的OAuth2 access_token，缓存未命中时使用，默认使用保存的access_token
+    :param refresh: 是否忽略缓存
     :return:
     """
-    user_info_url: str = 'https://api.weixin.qq.com/sns/userinfo?access_token={access_token}&openid={openid}' \
-        .format(access_token=access_token, openid=openid)
-    user_info: dict = json.loads(requests.get(user_info_url).content)
+    key = USERINFO_CACHE_PREFIX + openid
+    if not refresh:
+        user_info = cache.get(key)
+        if user_info is not None:
+            return user_info
+
+    if access_token is None:
+        access_token = get_access_token(openid)
+    user_info = _request_userinfo(openid, access_token)
+    # access_token失效时用refresh_token续期并重试一次
+    if user_info.get('errcode') in INVALID_ACCESS_TOKEN_ERRCODES \
+            and cache.get(TOKEN_CACHE_PREFIX + openid) is not None:
+        user_info = _request_userinfo(openid, refresh_access_token(openid))
+    check_response(user_info)
+    cache.set(key, user_info, timeout=get_login_settings()['USERINFO_TIMEOUT'])
     return user_info
 
+
+def get_unionid(openid, access_token=None):
+    """
+    获取unionid和userinfo
+    :param openid:
+    :param access_token: 默认使用get_openid时保存的access_token
+    :return:
+    """
+    return get_userinfo(openid, access_token)
@@ -1,13 +1,26 @@
 # -*- coding: utf-8 -*-
 
+import io
+import os
+import hmac
+import gzip
 import time
-from functools import partial
+import hashlib
+import threading
+from decimal import Decimal
+from functools import partial, lru_cache
+from typing import Iterable, Iterator, Callable
+
+import xmltodict
 
 from django.conf import settings
 
 from wechatpy.pay import WeChatPay
-from wechatpy.pay.api import WeChatOrder
-from wechatpy.pay.utils import calculate_signature
+from wechatpy.pay.utils import dict_to_xml
+
+from qtutils.random import gen_random_str
+
+from django_wechat.sdk.sessions import get_session, get_http_settings
 
 
 WECHAT_NOTIFY_URL = settings.WECHATPAY_NOTIFY_URL
@@ -17,16 +30,165 @@ MCH_ID = settings.WECHATPAY_SECRETS['mch_id']
 MCH_CERT = settings.WECHATPAY_SECRETS['mch_cert']
 MCH_KEY = settings.WECHATPAY_SECRETS['mch_key']
 
+# 签名类型：MD5或HMAC-SHA256，统一下单和调起支付的签名类型必须一致
+WECHATPAY_SIGN_TYPE = getattr(settings, 'WECHATPAY_SIGN_TYPE', 'MD5')
+
+
+# ----- Exception -----
+
+class WeChatPaySdkException(Exception):
+    pass
+
+
+# ----- 签名 -----
+# 详细说明：https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=4_3
+
+# 不参与签名的字段
+SIGN_EXCLUDED_FIELDS = ('sign', 'paySign')
+
+
+class PaySigner(object):
+    """
+    微信支付签名
+
+    密钥相关的数据只在创建时计算一次：MD5预先编码"&key=..."后缀，HMAC-SHA256预先计算带密钥的初始状态，
+    每次签名只复制该状态。签名结果和wechatpy的calculate_signature、calculate_signature_hmac一致。
+    """
+    def __init__(self, api_key: str = MCH_API_KEY, sign_type: str = WECHATPAY_SIGN_TYPE):
+        """
+        :param api_key: 商户API密钥
+        :param sign_type: MD5或HMAC-SHA256
+        """
+        if sign_type not in ('MD5', 'HMAC-SHA256'):
+            raise WeChatPaySdkException('不支持的签名类型：{}'.format(sign_type))
+        self.sign_type = sign_type
+        self._key_suffix = '&key={}'.format(api_key).encode()
+        self._hmac = hmac.new(api_key.encode(), digestmod=hashlib.sha256)
+
+    @staticmethod
+    def format_params(params: dict) -> str:
+        """
+        按字段名排序拼接非空参数
+        """
+        return '&'.join('{}={}'.format(key, params[key]) for key in sorted(params)
+                        if params[key] and key not in SIGN_EXCLUDED_FIELDS)
+
+    def sign(self, params: dict) -> str:
+        """
+        :param params: 需要签名的参数，sign和paySign不参与签名
+        :return: 大写的签名
+        """
+        message = self.format_params(params).encode() + self._key_suffix
+        if self.sign_type == 'MD5':
+            return hashlib.md5(message).hexdigest().upper()
+        digest = self._hmac.copy()
+        digest.update(message)
+        return digest.hexdigest().upper()
+
+    def sign_many(self, params_list: Iterable[dict]) -> list:
+        """
+        批量签名，比如购物车中的多个订单或预先生成的支付链接
+        :return: 签名列表，顺序和参数一致
+        """
+        sign = self.sign
+        return [sign(params) for params in params_list]
+
+    def jsapi_params(self, appid, prepay_id, nonce_str, timestamp: str = None) -> dict:
+        """
+        生成JSAPI、小程序调起支付的参数
+        :param appid: 应用ID
+        :param prepay_id: 统一下单返回的预支付交易会话标识
+        :param nonce_str: 随机字符串
+        :param timestamp: 时间戳，默认为当前时间
+        :return: 包含paySign的参数
+        """
+        params = {
+            'appId': appid,
+            'timeStamp': timestamp or str(int(time.time())),
+            'nonceStr': nonce_str,
+            'package': 'prepay_id={}'.format(prepay_id),
+            'signType': self.sign_type,
+        }
+        params['paySign'] = self.sign(params)
+        return params
+
+
+@lru_cache(maxsize=None)
+def get_pay_signer(api_key: str = MCH_API_KEY, sign_type: str = WECHATPAY_SIGN_TYPE) -> PaySigner:
+    """
+    获取进程内共享的签名对象
+    """
+    return PaySigner(api_key, sign_type)
+
 
 QtWeChatPay = partial(WeChatPay, api_key=MCH_API_KEY, mch_id=MCH_ID, mch_cert=MCH_CERT, mch_key=MCH_KEY)
 
 
+# ----- 客户端 -----
+
+# appid -> 客户端
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def create_wechatpay_client(appid) -> WeChatPay:
+    """
+    创建微信支付客户端，使用进程内共享的连接池会话和默认超时
+    :param appid: 应用ID
+    :return:
+    """
+    client = QtWeChatPay(appid=appid, timeout=get_http_settings()['TIMEOUT'])
+    # wechatpy为每个客户端创建独立的Session，替换成共享会话以复用和微信支付服务器的连接
+    client._http.close()
+    client._http = get_session()
+    return client
+
+
+def get_wechatpay_client(client_label=None, appid=None) -> WeChatPay:
+    """
+    获取应用的微信支付客户端，同一进程内同一appid共享
+
+    fork出的子进程不能复用父进程的连接，按进程ID重新创建
+    :param client_label: 应用标签，对应settings.WECHAT_APP_SECRETS的键
+    :param appid: 应用ID，不传client_label时使用
+    :return:
+    """
+    global _clients_pid
+    if appid is None:
+        appid = settings.WECHAT_APP_SECRETS[client_label]['appid']
+    pid = os.getpid()
+    client = _clients.get(appid)
+    if client is None or _clients_pid != pid:
+        with _clients_lock:
+            if _clients_pid != pid:
+                _clients.clear()
+                _clients_pid = pid
+            client = _clients.get(appid)
+            if client is None:
+                client = _clients[appid] = create_wechatpay_client(appid)
+    return client
+
+
+def reset_wechatpay_clients():
+    """
+    丢弃当前进程缓存的客户端，下次调用时按最新设置重新创建
+    """
+    global _clients_pid
+    with _clients_lock:
+        _clients.clear()
+        _clients_pid = None
+
+
 # ----- 生成订单 -----
 
 def create_wechatpay_order(client_label, trade_type, body, price, qt_order_id, qt_product_id, client_ip, openid):
-    client = QtWeChatPay(appid=settings.WECHAT_APP_SECRETS[client_label]['appid'])
-    wxorder = WeChatOrder(client=client)
-    result = wxorder.create(
+    client = get_wechatpay_client(client_label)
+    kwargs = {}
+    # MD5为wechatpy的默认签名类型，其他类型需要显式传入
+    if WECHATPAY_SIGN_TYPE != 'MD5':
+        kwargs['sign_type'] = WECHATPAY_SIGN_TYPE
+    result = client.order.create(
         trade_type=trade_type,
         body=body,
         total_fee=int(100*float(price)),
@@ -35,6 +197,7 @@ def create_wechatpay_order(client_label, trade_type, body, price, qt_order_id, q
         product_id=qt_product_id,
         client_ip=client_ip,
         user_id=openid,
+        **kwargs
     )
     return result
 
@@ -65,15 +228,7 @@ def parse_wechatpay_unifiedorder_result(result: dict) -> (dict, str):
     #  - https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=7_4
     #  - https://pay.weixin.qq.com/wiki/doc/api/wxa/wxa_api.php?chapter=7_4&index=3
     elif trade_type == 'JSAPI':
-        pay_sign_data = {
-            "appId": result['appid'],
-            "timeStamp": str(int(time.time())),
-            "nonceStr": result["nonce_str"],
-            "package": 'prepay_id={prepay_id}'.format(prepay_id=result["prepay_id"]),
-            "signType": 'MD5',
-        }
-        pay_sign = calculate_signature(pay_sign_data, settings.WECHAT_MCH_API_KEY)
-        pay_sign_data["paySign"] = pay_sign
+        pay_sign_data = get_pay_signer().jsapi_params(result['appid'], result['prepay_id'], result['nonce_str'])
         content_type = 'application/json'
         return pay_sign_data, content_type
 
@@ -101,16 +256,246 @@ def parse_wechatpay_unifiedorder_result(result: dict) -> (dict, str):
 
 def query_wechatpay_order(client_label, transaction_id=None, out_trade_no=None):
     assert transaction_id or out_trade_no, '微信订单ID和用户订单ID不可以同时为空'
-    client = QtWeChatPay(appid=settings.WECHAT_APP_SECRETS[client_label]['appid'])
-    wxorder = WeChatOrder(client=client)
-    result = wxorder.query(transaction_id, out_trade_no)
+    client = get_wechatpay_client(client_label)
+    result = client.order.query(transaction_id, out_trade_no)
     return result
 
 
 # ----- 回调通知 -----
 
+# 支付结果通知中的整数字段
+NOTIFY_INT_FIELDS = ('total_fee', 'settlement_total_fee', 'cash_fee', 'coupon_fee', 'coupon_count')
+
+
 def parse_wechatpay_notify_data(xml):
-    data = WeChatPay.get_payment_data(xml)
-    appid = data['appid']
-    client = WeChatPay(appid=appid, api_key=MCH_API_KEY, mch_id=MCH_ID)
-    return client.parse_payment_result(xml)
+    """
+    解析支付结果通知并验证签名
+    详细说明：https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=9_7
+
+    下单使用HMAC-SHA256签名时，通知同样使用HMAC-SHA256签名，按通知中的sign_type选择签名方式，默认为MD5。
+    :param xml: 通知的XML
+    :return: 通知数据，整数字段转换为int
+    """
+    try:
+        data = xmltodict.parse(xml)['xml']
+    except Exception:
+        raise WeChatPaySdkException('支付结果通知格式错误')
+    if not isinstance(data, dict):
+        raise WeChatPaySdkException('支付结果通知格式错误')
+    sign = data.get('sign') or ''
+    expected_sign = get_pay_signer(sign_type=data.get('sign_type', 'MD5')).sign(data)
+    if not hmac.compare_digest(sign, expected_sign):
+        raise WeChatPaySdkException('支付结果通知签名错误')
+    for key in NOTIFY_INT_FIELDS:
+        if key in data:
+            data[key] = int(data[key])
+    return data
+
+
+# ----- 对账单 -----
+# 详细说明：
+#   - 交易账单：https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=9_6
+#   - 资金账单：https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=9_18
+
+# 账单中的数据行以反引号开头
+BILL_VALUE_PREFIX = '`'
+# gzip文件头
+GZIP_MAGIC = b'\x1f\x8b'
+
+# 交易账单表头 -> 对账使用的字段
+BILL_FIELDS = {
+    '微信订单号': 'transaction_id',
+    '商户订单号': 'out_trade_no',
+    '交易状态': 'trade_state',
+    '订单金额': 'total_fee',
+    '应结订单金额': 'settlement_total_fee',
+}
+
+# 对账时每批查询本地订单的数量
+RECONCILE_BATCH_SIZE = 500
+
+
+def iter_bill_lines(fileobj) -> Iterator[str]:
+    """
+    逐行读取账单，支持gzip压缩的账单
+    :param fileobj: 二进制文件对象，比如本地账单文件或下载接口的响应流
+    :return: 去掉换行符的文本行
+    """
+    if not isinstance(fileobj, io.BufferedReader):
+        fileobj = io.BufferedReader(fileobj)
+    if fileobj.peek(2)[:2] == GZIP_MAGIC:
+        fileobj = gzip.GzipFile(fileobj=fileobj)
+    # 账单带UTF-8 BOM
+    text = io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')
+    first_line = text.readline()
+    # 下载失败时返回XML格式的错误信息
+    if first_line.startswith('<xml>'):
+        error = xmltodict.parse(first_line + text.read())['xml']
+        raise WeChatPaySdkException(dict(error))
+    yield first_line.rstrip('\r\n')
+    for line in text:
+        yield line.rstrip('\r\n')
+
+
+def parse_bill(lines: Iterable[str]) -> Iterator[dict]:
+    """
+    增量解析账单，逐条返回明细；汇总部分不返回
+    :param lines: 账单文本行，第一行为表头
+    :return: 表头 -> 值
+    """
+    lines = iter(lines)
+    header = None
+    for line in lines:
+        if line:
+            header = line.split(',')
+            break
+    if header is None:
+        return
+    for line in lines:
+        # 明细之后是不以反引号开头的汇总表头
+        if not line.startswith(BILL_VALUE_PREFIX):
+            if line:
+                break
+            continue
+        # 值都以反引号开头，按",`"分隔，商品名称等字段中的逗号不影响解析
+        values = line[len(BILL_VALUE_PREFIX):].split(',' + BILL_VALUE_PREFIX)
+        yield dict(zip(header, values))
+
+
+def yuan_to_fen(value: str) -> int:
+    return int(Decimal(value) * 100)
+
+
+def request_bill_stream(client: WeChatPay, api: str, data: dict, sign_type: str = 'MD5'):
+    """
+    请求账单下载接口，返回不预先读取响应体的流
+    wechatpy的download_bill会把整个账单读入内存，这里直接用共享会话流式读取
+    :param client: 微信支付客户端
+    :param api: 接口路径
+    :param data: 请求参数
+    :param sign_type: 签名类型，资金账单只支持HMAC-SHA256
+    :return: requests.Response
+    """
+    data = dict(data, appid=client.appid, mch_id=client.mch_id, nonce_str=gen_random_str(32))
+    data = {key: value for key, value in data.items() if value is not None}
+    if sign_type != 'MD5':
+        data['sign_type'] = sign_type
+    sign = get_pay_signer(client.api_key, sign_type).sign(data)
+    kwargs = {}
+    if client.mch_cert and client.mch_key:
+        kwargs['cert'] = (client.mch_cert, client.mch_key)
+    response = client._http.post(client.API_BASE_URL + api, data=dict_to_xml(data, sign).encode('utf-8'),
+                                 timeout=client.timeout, stream=True, **kwargs)
+    response.raise_for_status()
+    # 按响应头解压gzip传输编码，账单本身的gzip由iter_bill_lines解压
+    response.raw.decode_content = True
+    return response
+
+
+def _iter_response_bill(response) -> Iterator[dict]:
+    try:
+        yield from parse_bill(iter_bill_lines(response.raw))
+    finally:
+        response.close()
+
+
+def download_bill(client_label, bill_date: str, bill_type: str = 'ALL', tar_type: str = None) -> Iterator[dict]:
+    """
+    下载交易账单，边下载边解析
+    :param client_label: 应用标签
+    :param bill_date: 账单日期，格式为20200915
+    :param bill_type: ALL、SUCCESS、REFUND等
+    :param tar_type: GZIP表示下载压缩账单
+    :return: 账单明细
+    """
+    client = get_wechatpay_client(client_label)
+    response = request_bill_stream(client, 'pay/downloadbill',
+                                   {'bill_date': bill_date, 'bill_type': bill_type, 'tar_type': tar_type})
+    return _iter_response_bill(response)
+
+
+def download_fundflow(client_label, bill_date: str, account_type: str = 'Basic',
+                      tar_type: str = None) -> Iterator[dict]:
+    """
+    下载资金账单，边下载边解析，需要商户证书
+    :param client_label: 应用标签
+    :param bill_date: 账单日期，格式为20200915
+    :param account_type: Basic、Operation、Fees
+    :param tar_type: GZIP表示下载压缩账单
+    :return: 账单明细
+    """
+    client = get_wechatpay_client(client_label)
+    response = request_bill_stream(client, 'pay/downloadfundflow',
+                                   {'bill_date': bill_date, 'account_type': account_type, 'tar_type': tar_type},
+                                   sign_type='HMAC-SHA256')
+    return _iter_response_bill(response)
+
+
+def normalize_bill_row(row: dict) -> dict:
+    """
+    把交易账单明细转成对账字段，金额单位转为分，空白金额为None
+    """
+    data = {field: row[name] for name, field in BILL_FIELDS.items() if name in row}
+    for field in ('total_fee', 'settlement_total_fee'):
+        if field in data:
+            data[field] = yuan_to_fen(data[field]) if data[field].strip() else None
+    return data
+
+
+def reconcile_bill(rows: Iterable[dict], lookup: Callable[[list], dict], trade_states=('SUCCESS',),
+                   batch_size: int = RECONCILE_BATCH_SIZE, local_orders: Iterable[dict] = None) -> Iterator[dict]:
+    """
+    交易账单和本地订单双向对账，逐批查询本地订单，只返回不一致的记录
+    :param rows: 交易账单明细，比如download_bill或parse_bill的返回值
+    :param lookup: 批量查询本地订单的函数，参数为商户订单号列表，返回商户订单号 -> {'total_fee': 分, 'trade_state': 可选}
+    :param trade_states: 参与对账的交易状态
+    :param batch_size: 每批查询的订单数
+    :param local_orders: 账单日期内本地已支付的订单，每项包含out_trade_no；传入时在账单之后检查账单中缺少的本地订单
+    :return: 不一致的记录，包含out_trade_no、reason、bill、local；reason为：
+      - missing: 账单中的订单本地不存在
+      - missing_in_bill: 本地已支付的订单不在账单中，bill为None
+      - blank_total_fee: 账单中的订单金额为空
+      - total_fee: 金额不一致
+      - trade_state: 交易状态不一致
+    """
+    batch = []
+    # 账单中参与对账的商户订单号，用于检查账单中缺少的本地订单
+    billed = set()
+
+    def check(batch):
+        local_orders = lookup([row['out_trade_no'] for row in batch])
+        for row in batch:
+            local = local_orders.get(row['out_trade_no'])
+            total_fee = row.get('total_fee')
+            if total_fee is None:
+                total_fee = row.get('settlement_total_fee')
+            if local is None:
+                reason = 'missing'
+            elif total_fee is None:
+                reason = 'blank_total_fee'
+            elif int(local['total_fee']) != total_fee:
+                reason = 'total_fee'
+            elif local.get('trade_state') not in (None, row['trade_state']):
+                reason = 'trade_state'
+            else:
+                continue
+            yield {'out_trade_no': row['out_trade_no'], 'reason': reason, 'bill': row, 'local': local}
+
+    for row in rows:
+        row = normalize_bill_row(row)
+        if row.get('trade_state') not in trade_states:
+            continue
+        if local_orders is not None:
+            billed.add(row['out_trade_no'])
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield from check(batch)
+            batch = []
+    if batch:
+        yield from check(batch)
+
+    if local_orders is not None:
+        for local in local_orders:
+            if local['out_trade_no'] not in billed:
+                yield {'out_trade_no': local['out_trade_no'], 'reason': 'missing_in_bill', 'bill': None,
+                       'local': local}
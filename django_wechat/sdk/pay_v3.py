@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+微信支付API v3
+
+- 商户私钥只在创建客户端时解析一次，请求签名复用已加载的私钥
+- 平台证书下载后解析成公钥保存在进程内，并写入Django缓存供其他进程使用；超过刷新间隔或遇到未知证书序列号时重新下载
+- 回调通知先验证签名和时间戳，再用复用的AESGCM实例解密resource
+
+商户私钥和商户证书序列号读取settings.WECHATPAY_SECRETS：
+WECHATPAY_SECRETS = {
+    'mch_id': '1900000109',
+    'mch_key': '/path/to/apiclient_key.pem',  # 商户私钥，和API v2的商户证书私钥相同
+    'mch_serial_no': '...',                   # 商户证书序列号
+    'api_v3_key': '...',                      # APIv3密钥，32字节
+}
+
+get_wechatpay_v3_client()在进程内缓存客户端，轮换商户私钥、商户证书或APIv3密钥后，
+调用get_wechatpay_v3_client.cache_clear()，下次调用时按新的settings重新创建客户端。
+
+详细说明：https://pay.weixin.qq.com/wiki/doc/apiv3/wechatpay/wechatpay4_0.shtml
+"""
+
+import json
+import time
+import base64
+import threading
+from functools import lru_cache
+from urllib.parse import urlencode
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidSignature, InvalidTag
+
+from django.conf import settings
+from django.core.cache import cache
+
+from qtutils.random import gen_random_str
+
+from django_wechat.sdk.sessions import request
+
+# 微信支付API v3根URL
+WECHATPAY_V3_API_ROOT_URL = 'https://api.mch.weixin.qq.com'
+
+# 签名认证类型
+AUTH_SCHEMA = 'WECHATPAY2-SHA256-RSA2048'
+
+# 平台证书刷新间隔秒数，微信支付建议不超过12小时
+CERTIFICATE_REFRESH_INTERVAL = 12 * 3600
+# 遇到未知证书序列号时重新下载的最小间隔秒数，避免伪造的序列号导致频繁下载
+CERTIFICATE_MIN_DOWNLOAD_INTERVAL = 60
+# 重新读取缓存证书的最小间隔秒数，避免伪造的序列号导致每个请求都读取缓存和解析证书
+CERTIFICATE_MIN_RELOAD_INTERVAL = 10
+# 平台证书缓存键前缀，键为商户号
+CERTIFICATE_CACHE_PREFIX = 'wechatpay_v3_certificates_'
+
+# 应答和回调通知的时间戳允许的偏差秒数
+TIMESTAMP_TOLERANCE = 300
+
+
+# ----- Exception -----
+
+class WeChatPayV3SdkException(Exception):
+    pass
+
+
+# ----- 加解密 -----
+
+def load_private_key(private_key):
+    """
+    加载商户私钥
+    :param private_key: PEM格式的私钥，str或bytes
+    :return:
+    """
+    if isinstance(private_key, str):
+        private_key = private_key.encode()
+    return serialization.load_pem_private_key(private_key, password=None)
+
+
+def rsa_sign(private_key, message: str) -> str:
+    """
+    SHA256 with RSA签名
+    :return: Base64编码的签名
+    """
+    signature = private_key.sign(message.encode(), padding.PKCS1v15(), hashes.SHA256())
+    return base64.b64encode(signature).decode()
+
+
+def rsa_verify(public_key, message: str, signature: str) -> bool:
+    try:
+        public_key.verify(base64.b64decode(signature), message.encode(), padding.PKCS1v15(), hashes.SHA256())
+    except (InvalidSignature, ValueError):
+        return False
+    return True
+
+
+def build_message(*parts) -> str:
+    """
+    构造签名串：每个部分后加换行符
+    """
+    return ''.join('{}\n'.format(part) for part in parts)
+
+
+# ----- 客户端 -----
+
+class WeChatPayV3Client(object):
+    """
+    微信支付API v3客户端，同一商户在进程内共享一个实例
+    """
+    def __init__(self, mch_id, serial_no, private_key, api_v3_key, session=None):
+        """
+        :param mch_id: 商户号
+        :param serial_no: 商户证书序列号
+        :param private_key: 商户私钥，PEM格式或已加载的私钥对象
+        :param api_v3_key: APIv3密钥
+        :param session: 自定义HTTP会话，默认使用进程内共享的连接池会话
+        """
+        self.mch_id = mch_id
+        self.serial_no = serial_no
+        if isinstance(private_key, (str, bytes)):
+            private_key = load_private_key(private_key)
+        self.private_key = private_key
+        if isinstance(api_v3_key, str):
+            api_v3_key = api_v3_key.encode()
+        # AESGCM实例可以复用，不需要每次解密重新创建
+        self.aesgcm = AESGCM(api_v3_key)
+        self._session = session
+        self.certificates_cache_key = CERTIFICATE_CACHE_PREFIX + str(mch_id)
+        # 平台证书序列号 -> 公钥
+        self._certificates = {}
+        self._certificate_pems = {}
+        # 已加载证书的下载时间，证书从缓存读取时为其他进程的下载时间
+        self._certificates_loaded_at = 0
+        # 本进程上次下载和上次读取缓存或下载的时间
+        self._certificates_downloaded_at = 0
+        self._certificates_checked_at = 0
+        self._certificates_lock = threading.Lock()
+
+    # ----- 请求签名 -----
+
+    def build_authorization(self, method, path, body='', timestamp=None, nonce_str=None) -> str:
+        """
+        生成Authorization请求头
+        :param method: HTTP方法
+        :param path: 包含查询参数的URL路径
+        :param body: 请求体
+        :return:
+        """
+        timestamp = timestamp or str(int(time.time()))
+        nonce_str = nonce_str or gen_random_str(32)
+        signature = rsa_sign(self.private_key, build_message(method.upper(), path, timestamp, nonce_str, body))
+        return '{} mchid="{}",nonce_str="{}",signature="{}",timestamp="{}",serial_no="{}"'.format(
+            AUTH_SCHEMA, self.mch_id, nonce_str, signature, timestamp, self.serial_no)
+
+    def _request(self, method, path, params=None, data=None) -> (dict, str):
+        if params:
+            path = path + '?' + urlencode(params)
+        body = json.dumps(data, ensure_ascii=False, separators=(',', ':')) if data is not None else ''
+        headers = {
+            'Authorization': self.build_authorization(method, path, body),
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+        }
+        response = request(method, WECHATPAY_V3_API_ROOT_URL + path, session=self._session,
+                           data=body.encode(), headers=headers)
+        text = response.content.decode()
+        if response.status_code >= 300:
+            raise WeChatPayV3SdkException(json.loads(text) if text else response.status_code)
+        return response.headers, text
+
+    def request_api(self, method, path, params=None, data=None) -> dict:
+        """
+        调用API v3接口并验证应答签名
+        :param method: HTTP方法
+        :param path: URL路径，比如/v3/pay/transactions/jsapi
+        :param params: 查询参数
+        :param data: JSON请求数据
+        :return: 应答数据，无应答体时为空字典
+        """
+        headers, text = self._request(method, path, params, data)
+        self.verify_signature(headers, text)
+        return json.loads(text) if text else {}
+
+    def get_api(self, path, params=None) -> dict:
+        return self.request_api('GET', path, params=params)
+
+    def post_api(self, path, data=None) -> dict:
+        return self.request_api('POST', path, data=data)
+
+    # ----- 平台证书 -----
+
+    def _set_certificates(self, pems: dict, downloaded_at: float):
+        # 证书没有变化时不重新解析
+        if pems != self._certificate_pems:
+            self._certificates = {serial_no: x509.load_pem_x509_certificate(pem.encode()).public_key()
+                                  for serial_no, pem in pems.items()}
+            self._certificate_pems = pems
+        self._certificates_loaded_at = downloaded_at
+
+    def download_certificates(self) -> dict:
+        """
+        下载并解密平台证书
+        详细说明：https://pay.weixin.qq.com/wiki/doc/apiv3/apis/wechatpay5_1.shtml
+        :return: 证书序列号 -> PEM格式证书
+        """
+        headers, text = self._request('GET', '/v3/certificates')
+        pems = {}
+        for item in json.loads(text)['data']:
+            pems[item['serial_no']] = self.decrypt(item['encrypt_certificate']).decode()
+        # 应答用下载的证书验证，解密成功说明证书来自持有APIv3密钥的微信支付
+        pem = pems.get(headers.get('Wechatpay-Serial'))
+        message = build_message(headers.get('Wechatpay-Timestamp'), headers.get('Wechatpay-Nonce'), text)
+        if pem is None or not rsa_verify(x509.load_pem_x509_certificate(pem.encode()).public_key(),
+                                         message, headers.get('Wechatpay-Signature', '')):
+            raise WeChatPayV3SdkException('平台证书应答签名效验不通过')
+        self._certificates_downloaded_at = time.time()
+        return pems
+
+    def refresh_certificates(self, force=False, checked_at=None):
+        """
+        刷新平台证书：优先读取其他进程缓存的证书，缓存不存在或force为True时下载
+        :param force: 是否不读取缓存直接下载
+        :param checked_at: 调用方决定刷新时看到的检查时间（force为True时为下载时间），
+          等待锁期间其他线程已经刷新过时不再刷新
+        """
+        with self._certificates_lock:
+            if checked_at is not None:
+                current = self._certificates_downloaded_at if force else self._certificates_checked_at
+                if current != checked_at:
+                    return
+            cached = None if force else cache.get(self.certificates_cache_key)
+            if cached is None:
+                pems = self.download_certificates()
+                cached = {'certificates': pems, 'downloaded_at': self._certificates_downloaded_at}
+                cache.set(self.certificates_cache_key, cached, timeout=CERTIFICATE_REFRESH_INTERVAL)
+            self._set_certificates(cached['certificates'], cached['downloaded_at'])
+            self._certificates_checked_at = time.time()
+
+    def get_certificate(self, serial_no):
+        """
+        获取平台证书公钥，超过刷新间隔或者序列号未知时刷新
+
+        读取缓存的间隔不小于CERTIFICATE_MIN_RELOAD_INTERVAL，下载的间隔不小于CERTIFICATE_MIN_DOWNLOAD_INTERVAL，
+        伪造的序列号不会导致每个请求都读取缓存或下载。
+        :param serial_no: 平台证书序列号
+        :return: 公钥
+        """
+        checked_at = self._certificates_checked_at
+        if time.time() - self._certificates_loaded_at > CERTIFICATE_REFRESH_INTERVAL \
+                and time.time() - checked_at > CERTIFICATE_MIN_RELOAD_INTERVAL:
+            self.refresh_certificates(checked_at=checked_at)
+        checked_at = self._certificates_checked_at
+        public_key = self._certificates.get(serial_no)
+        if public_key is None and time.time() - checked_at > CERTIFICATE_MIN_RELOAD_INTERVAL:
+            # 平台证书轮换时出现新的序列号，其他进程可能已经下载了新证书
+            self.refresh_certificates(checked_at=checked_at)
+            public_key = self._certificates.get(serial_no)
+        downloaded_at = self._certificates_downloaded_at
+        if public_key is None and time.time() - downloaded_at > CERTIFICATE_MIN_DOWNLOAD_INTERVAL:
+            self.refresh_certificates(force=True, checked_at=downloaded_at)
+            public_key = self._certificates.get(serial_no)
+        if public_key is None:
+            raise WeChatPayV3SdkException('平台证书不存在：{}'.format(serial_no))
+        return public_key
+
+    # ----- 验签和解密 -----
+
+    def verify_signature(self, headers, body: str):
+        """
+        验证应答和回调通知的签名
+        :param headers: HTTP头，包含Wechatpay-Serial、Wechatpay-Signature、Wechatpay-Timestamp、Wechatpay-Nonce
+        :param body: 应答体或通知体
+        """
+        try:
+            serial_no = headers['Wechatpay-Serial']
+            signature = headers['Wechatpay-Signature']
+            timestamp = headers['Wechatpay-Timestamp']
+            nonce = headers['Wechatpay-Nonce']
+        except KeyError:
+            raise WeChatPayV3SdkException('缺少签名信息')
+        try:
+            timestamp_value = int(timestamp)
+        except (TypeError, ValueError):
+            raise WeChatPayV3SdkException('时间戳格式错误')
+        if abs(time.time() - timestamp_value) > TIMESTAMP_TOLERANCE:
+            raise WeChatPayV3SdkException('时间戳超出有效期')
+        if not rsa_verify(self.get_certificate(serial_no), build_message(timestamp, nonce, body), signature):
+            raise WeChatPayV3SdkException('签名效验不通过')
+
+    def decrypt(self, resource: dict) -> bytes:
+        """
+        AEAD_AES_256_GCM解密
+        :param resource: 包含nonce、ciphertext和associated_data
+        :return: 明文
+        """
+        associated_data = resource.get('associated_data')
+        try:
+            return self.aesgcm.decrypt(resource['nonce'].encode(), base64.b64decode(resource['ciphertext']),
+                                       associated_data.encode() if associated_data else None)
+        except InvalidTag:
+            raise WeChatPayV3SdkException('解密失败')
+
+    def parse_notify(self, headers, body) -> dict:
+        """
+        验证并解密回调通知
+        详细说明：https://pay.weixin.qq.com/wiki/doc/apiv3/apis/chapter3_1_5.shtml
+        :param headers: HTTP头
+        :param body: 通知体，str或bytes
+        :return: 通知数据，resource替换为解密后的数据
+        """
+        if isinstance(body, bytes):
+            body = body.decode()
+        self.verify_signature(headers, body)
+        data = json.loads(body)
+        data['resource'] = json.loads(self.decrypt(data['resource']))
+        return data
+
+    # ----- 支付 -----
+
+    def create_order(self, trade_type: str, data: dict) -> dict:
+        """
+        下单
+        :param trade_type: jsapi、native、app、h5
+        :param data: 下单参数，不需要传入mchid
+        :return:
+        """
+        return self.post_api('/v3/pay/transactions/' + trade_type, data=dict(data, mchid=self.mch_id))
+
+    def query_order(self, transaction_id=None, out_trade_no=None) -> dict:
+        assert transaction_id or out_trade_no, '微信订单ID和用户订单ID不可以同时为空'
+        if transaction_id:
+            path = '/v3/pay/transactions/id/' + transaction_id
+        else:
+            path = '/v3/pay/transactions/out-trade-no/' + out_trade_no
+        return self.get_api(path, params={'mchid': self.mch_id})
+
+    def jsapi_params(self, appid, prepay_id, timestamp=None, nonce_str=None) -> dict:
+        """
+        生成JSAPI、小程序调起支付的参数
+        :return: 包含paySign的参数
+        """
+        params = {
+            'appId': appid,
+            'timeStamp': timestamp or str(int(time.time())),
+            'nonceStr': nonce_str or gen_random_str(32),
+            'package': 'prepay_id={}'.format(prepay_id),
+            'signType': 'RSA',
+        }
+        params['paySign'] = rsa_sign(self.private_key, build_message(
+            params['appId'], params['timeStamp'], params['nonceStr'], params['package']))
+        return params
+
+
+@lru_cache(maxsize=None)
+def get_wechatpay_v3_client() -> WeChatPayV3Client:
+    """
+    获取settings.WECHATPAY_SECRETS对应的客户端，同一进程内共享，私钥只读取和解析一次
+    轮换密钥或修改settings后调用get_wechatpay_v3_client.cache_clear()重新创建
+    """
+    secrets = settings.WECHATPAY_SECRETS
+    with open(secrets['mch_key'], 'rb') as f:
+        private_key = f.read()
+    return WeChatPayV3Client(secrets['mch_id'], secrets['mch_serial_no'], private_key, secrets['api_v3_key'])
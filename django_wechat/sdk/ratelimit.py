@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+令牌桶限流，用于批量调用时遵守微信接口的调用频率限制
+"""
+
+import time
+import threading
+
+
+class TokenBucket(object):
+    """
+    线程安全的令牌桶
+    """
+    def __init__(self, rate: float, capacity: int = None):
+        """
+        :param rate: 每秒补充的令牌数
+        :param capacity: 桶容量，即允许的突发调用数，默认等于rate
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def configure(self, rate: float, capacity: int = None):
+        """
+        修改补充速度和桶容量，已补充的令牌按原速度计算
+        :param rate: 每秒补充的令牌数
+        :param capacity: 桶容量，默认等于rate
+        """
+        with self._lock:
+            self._fill(time.monotonic())
+            self.rate = float(rate)
+            self.capacity = float(capacity if capacity is not None else max(rate, 1))
+            self._tokens = min(self._tokens, self.capacity)
+
+    def _fill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def try_acquire(self, tokens: int = 1) -> float:
+        """
+        尝试取出令牌
+        :param tokens: 令牌数
+        :return: 0表示取出成功，否则为还需要等待的秒数
+        """
+        with self._lock:
+            self._fill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens: int = 1):
+        """
+        取出令牌，令牌不足时阻塞等待
+        :param tokens: 令牌数
+        """
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+# ----- 令牌桶注册表 -----
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_token_bucket(key, rate: float, capacity: int = None) -> TokenBucket:
+    """
+    获取名称对应的令牌桶，同一进程内同一应用的批量调用共享一个令牌桶
+    :param key: 名称，比如应用的access_token缓存键
+    :param rate: 每秒补充的令牌数，和现有令牌桶不同时更新现有令牌桶
+    :param capacity: 桶容量，和现有令牌桶不同时更新现有令牌桶
+    :return:
+    """
+    bucket = _buckets.get(key)
+    if bucket is None:
+        with _buckets_lock:
+            bucket = _buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(rate, capacity)
+                _buckets[key] = bucket
+                return bucket
+    expected_capacity = float(capacity if capacity is not None else max(rate, 1))
+    if bucket.rate != float(rate) or bucket.capacity != expected_capacity:
+        bucket.configure(rate, capacity)
+    return bucket
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+微信API共享HTTP会话
+
+每个进程复用同一个带连接池的requests.Session，避免每次调用都和微信服务器重新建立TCP+TLS连接。
+异步SDK使用httpx.AsyncClient（可选依赖），每个事件循环复用一个。
+
+Django settings传入格式示例（均为可选项）：
+WECHAT_HTTP = {
+    'POOL_CONNECTIONS': 10,       # 连接池缓存的主机数
+    'POOL_MAXSIZE': 20,           # 每个主机的最大连接数
+    'MAX_RETRIES': 3,             # 网络错误和临时性错误码的最大重试次数
+    'BACKOFF_FACTOR': 0.3,        # 退避系数，第n次重试前等待 BACKOFF_FACTOR * 2^(n-1) 秒
+    'TIMEOUT': (3.05, 10),        # (连接超时, 读取超时)，单位秒
+    'RETRY_STATUS_CODES': [500, 502, 503, 504],
+    'RETRY_ERRCODES': [-1],       # 微信返回的临时性错误码，-1为系统繁忙
+}
+"""
+
+import os
+import json
+import time
+import asyncio
+import weakref
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from django.conf import settings
+
+
+# 默认参数
+DEFAULTS = {
+    'POOL_CONNECTIONS': 10,
+    'POOL_MAXSIZE': 20,
+    'MAX_RETRIES': 3,
+    'BACKOFF_FACTOR': 0.3,
+    'TIMEOUT': (3.05, 10),
+    'RETRY_STATUS_CODES': [500, 502, 503, 504],
+    'RETRY_ERRCODES': [-1],
+}
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+# 事件循环 -> httpx.AsyncClient
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_http_settings() -> dict:
+    """
+    读取HTTP设置，用户设置覆盖默认参数
+    """
+    user_settings = getattr(settings, 'WECHAT_HTTP', None) or {}
+    return dict(DEFAULTS, **user_settings)
+
+
+def create_session(http_settings: dict = None) -> requests.Session:
+    """
+    创建带连接池和网络层重试的Session
+    :param http_settings: HTTP设置，默认读取Django settings
+    :return:
+    """
+    if http_settings is None:
+        http_settings = get_http_settings()
+    # 网络层重试只对幂等方法重试读错误和状态码，POST仅在建立连接失败时重试，避免重复提交
+    retry = Retry(
+        total=http_settings['MAX_RETRIES'],
+        backoff_factor=http_settings['BACKOFF_FACTOR'],
+        status_forcelist=http_settings['RETRY_STATUS_CODES'],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=http_settings['POOL_CONNECTIONS'],
+        pool_maxsize=http_settings['POOL_MAXSIZE'],
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    获取当前进程共享的Session
+
+    fork出的子进程不能复用父进程的连接，按进程ID重新创建
+    :return:
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = create_session()
+                _session_pid = pid
+    return _session
+
+
+def reset_session():
+    """
+    关闭并丢弃当前进程共享的Session，下次调用时按最新设置重新创建
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _session_pid = None
+
+
+def request(method, url, session=None, **kwargs) -> requests.Response:
+    """
+    使用共享Session发送请求，默认带超时
+    :param method: HTTP方法
+    :param url: URL
+    :param session: 自定义Session，默认使用共享Session
+    :param kwargs: 传给requests.Session.request的其他参数
+    :return:
+    """
+    if session is None:
+        session = get_session()
+    kwargs.setdefault('timeout', get_http_settings()['TIMEOUT'])
+    return session.request(method, url, **kwargs)
+
+
+def request_json(method, url, session=None, **kwargs) -> dict:
+    """
+    请求微信API并把返回的JSON数据包转成字典
+
+    微信返回临时性错误码（比如-1系统繁忙）时按退避时间重试，其他错误码原样返回，由调用方处理
+    :param method: HTTP方法
+    :param url: URL
+    :param session: 自定义Session，默认使用共享Session
+    :param kwargs: 传给requests.Session.request的其他参数
+    :return:
+    """
+    http_settings = get_http_settings()
+    max_retries = http_settings['MAX_RETRIES']
+    for attempt in range(max_retries + 1):
+        response = request(method, url, session=session, **kwargs)
+        data: dict = json.loads(response.content)
+        if data.get('errcode', 0) not in http_settings['RETRY_ERRCODES'] or attempt == max_retries:
+            return data
+        time.sleep(http_settings['BACKOFF_FACTOR'] * (2 ** attempt))
+
+
+# ----- 异步HTTP客户端 -----
+
+def create_async_client(http_settings: dict = None):
+    """
+    创建带连接池的httpx.AsyncClient
+
+    httpx的传输层只对建立连接失败重试，和同步会话POST请求的重试策略一致
+    :param http_settings: HTTP设置，默认读取Django settings
+    :return:
+    """
+    import httpx
+
+    if http_settings is None:
+        http_settings = get_http_settings()
+    timeout = http_settings['TIMEOUT']
+    if isinstance(timeout, (tuple, list)):
+        connect_timeout, read_timeout = timeout
+        timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+    limits = httpx.Limits(
+        max_connections=http_settings['POOL_CONNECTIONS'] * http_settings['POOL_MAXSIZE'],
+        max_keepalive_connections=http_settings['POOL_MAXSIZE'],
+    )
+    transport = httpx.AsyncHTTPTransport(retries=http_settings['MAX_RETRIES'], limits=limits)
+    return httpx.AsyncClient(transport=transport, timeout=timeout)
+
+
+def get_async_client():
+    """
+    获取当前事件循环共享的httpx.AsyncClient
+
+    httpx的连接绑定在事件循环上，不同事件循环（比如每个线程各自运行的事件循环）各用一个
+    :return:
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = create_async_client()
+        _async_clients[loop] = client
+    return client
+
+
+async def arequest_json(method, url, client=None, **kwargs) -> dict:
+    """
+    request_json的异步版本
+    :param method: HTTP方法
+    :param url: URL
+    :param client: 自定义httpx.AsyncClient，默认使用当前事件循环共享的客户端
+    :param kwargs: 传给httpx.AsyncClient.request的其他参数
+    :return:
+    """
+    if client is None:
+        client = get_async_client()
+    http_settings = get_http_settings()
+    max_retries = http_settings['MAX_RETRIES']
+    for attempt in range(max_retries + 1):
+        response = await client.request(method, url, **kwargs)
+        data: dict = json.loads(response.content)
+        if data.get('errcode', 0) not in http_settings['RETRY_ERRCODES'] or attempt == max_retries:
+            return data
+        await asyncio.sleep(http_settings['BACKOFF_FACTOR'] * (2 ** attempt))
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+多应用access_token注册表
+
+企业微信的各个应用和WECHAT_APP_SECRETS中的公众号、小程序各自有access_token，
+TokenRegistry统一管理它们的AccessTokenManager：
+
+- load: 一次cache.get_many读取所有应用的access_token到进程内副本
+- refresh_due: 对剩余有效期不足REFRESH_AHEAD秒的应用提前续期
+- start/stop: 在一个后台线程中定期执行refresh_due，请求中的get只读取进程内副本，不需要等待续期
+- metrics: 各应用的调用统计
+
+后台续期可以在Django启动时开启（settings.WECHAT_ACCESS_TOKEN['BACKGROUND_REFRESH'] = True），
+也可以用管理命令refresh_wechat_tokens在单独的进程或定时任务中执行。
+
+默认注册的应用：
+- settings.WECHATWORK_SECRETS中包含secret的应用，名称为'wechatwork:<应用名称>'
+- settings.WECHAT_APP_SECRETS中的应用，名称为'wechat:<应用标签>'；网站应用等没有access_token的应用设置'access_token': False。
+  微信云托管环境中通过开放接口服务调用的应用（见sdk.wechat.is_cloudrun_app）不需要access_token，不注册
+"""
+
+import logging
+import threading
+from functools import partial, lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+
+from django_wechat.sdk.tokens import AccessTokenManager, get_token_manager, get_token_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenRegistry(object):
+    """
+    多应用access_token注册表
+    """
+    def __init__(self):
+        # 名称 -> 管理器
+        self._managers = {}
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def register(self, name, manager: AccessTokenManager):
+        """
+        注册应用
+        :param name: 应用名称
+        :param manager: access_token管理器
+        """
+        self._managers[name] = manager
+
+    @property
+    def managers(self) -> dict:
+        return dict(self._managers)
+
+    def _get_cache_values(self) -> dict:
+        keys = [key for manager in self._managers.values() for key in manager.cache_keys]
+        return cache.get_many(keys)
+
+    def load(self):
+        """
+        一次批量读取所有应用的access_token到进程内副本
+        """
+        values = self._get_cache_values()
+        for manager in self._managers.values():
+            manager._set_from_cache_values(values)
+
+    def refresh_due(self, ahead: int = None) -> dict:
+        """
+        对临近过期的应用续期，单个应用失败不影响其他应用
+        :param ahead: 提前续期的秒数，默认为settings中的REFRESH_AHEAD
+        :return: 名称 -> 是否刷新，失败时为异常
+        """
+        # 一次批量读取所有应用的缓存，各应用续期时不再单独读取
+        values = self._get_cache_values()
+        results = {}
+        for name, manager in self._managers.items():
+            try:
+                results[name] = manager.refresh_ahead(ahead, cache_values=values)
+            except Exception as e:
+                logger.exception('access_token续期失败：%s', name)
+                results[name] = e
+        return results
+
+    def metrics(self) -> dict:
+        """
+        :return: 名称 -> 调用统计
+        """
+        return {name: manager.metrics() for name, manager in self._managers.items()}
+
+    # ----- 后台续期 -----
+
+    def run(self, interval: int = None):
+        """
+        定期续期，直到调用stop
+        :param interval: 检查间隔秒数，默认为settings中的REFRESH_INTERVAL
+        """
+        if interval is None:
+            interval = get_token_settings()['REFRESH_INTERVAL']
+        while not self._stop_event.is_set():
+            self.refresh_due()
+            self._stop_event.wait(interval)
+
+    def start(self, interval: int = None) -> threading.Thread:
+        """
+        启动后台续期线程，已启动时直接返回
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self.run, args=(interval,), name='wechat-token-refresh',
+                                            daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def stop(self, timeout: float = None):
+        """
+        停止后台续期线程
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+# ----- 默认注册表 -----
+
+def register_wechatwork_apps(registry: TokenRegistry):
+    """
+    注册settings.WECHATWORK_SECRETS中的企业微信应用，缓存键和同名的WeChatWorkSDK一致
+    """
+    secrets = getattr(settings, 'WECHATWORK_SECRETS', None)
+    if not secrets:
+        return
+    from django_wechat.sdk.work import get_access_token
+    corpid = secrets['corpid']
+    for name, app in secrets.items():
+        if isinstance(app, dict) and app.get('secret'):
+            fetch_token = partial(get_access_token, corpid=corpid, secret=app['secret'])
+            registry.register('wechatwork:' + name, get_token_manager('wechatwork_access_token_' + name, fetch_token))
+
+
+def register_wechat_apps(registry: TokenRegistry):
+    """
+    注册settings.WECHAT_APP_SECRETS中的公众号、小程序，缓存键和同名的WeChatSDK一致
+    """
+    from django_wechat.sdk.wechat import get_access_token, get_access_token_key, is_cloudrun_app
+    for client_label, app in getattr(settings, 'WECHAT_APP_SECRETS', {}).items():
+        if not app.get('access_token', True) or not app.get('app_secret') or is_cloudrun_app(app):
+            continue
+        fetch_token = partial(get_access_token, appid=app['appid'], secret=app['app_secret'])
+        registry.register('wechat:' + client_label, get_token_manager(get_access_token_key(client_label), fetch_token))
+
+
+@lru_cache(maxsize=None)
+def get_token_registry() -> TokenRegistry:
+    """
+    获取进程内共享的注册表，包含settings中配置的所有应用
+    """
+    registry = TokenRegistry()
+    register_wechatwork_apps(registry)
+    register_wechat_apps(registry)
+    return registry
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+access_token管理
+
+- 进程内保存access_token副本，未到提前续期时间时不访问缓存
+- 进程内用线程锁、跨进程用缓存add实现的锁保证同一时刻只有一个调用方请求微信刷新（single-flight）
+- 在expires_in到期前提前续期，续期期间其他调用方继续使用尚未过期的旧access_token
+- 异步调用方使用aget，事件循环内用asyncio锁代替线程锁，和同步调用方共享进程内副本与缓存
+- 多个应用的access_token可以由TokenRegistry统一加载和后台续期，详见token_registry.py
+
+Django settings传入格式示例（均为可选项）：
+WECHAT_ACCESS_TOKEN = {
+    'EARLY_RENEWAL': 300,  # 提前续期的秒数
+    'LOCK_TIMEOUT': 10,    # 跨进程刷新锁的超时秒数
+    'WAIT_TIMEOUT': 5,     # 没有可用access_token时等待其他进程刷新的最长秒数
+    'REFRESH_AHEAD': 600,  # 后台续期的提前秒数，应大于EARLY_RENEWAL，使请求中不需要续期
+    'REFRESH_INTERVAL': 60,  # 后台续期线程的检查间隔秒数
+    'BACKGROUND_REFRESH': False,  # 是否在Django启动时开启后台续期线程
+}
+"""
+
+import time
+import asyncio
+import weakref
+import threading
+
+from django.core.cache import cache
+from django.conf import settings
+
+
+# 默认参数
+DEFAULTS = {
+    'EARLY_RENEWAL': 300,
+    'LOCK_TIMEOUT': 10,
+    'WAIT_TIMEOUT': 5,
+    'REFRESH_AHEAD': 600,
+    'REFRESH_INTERVAL': 60,
+    'BACKGROUND_REFRESH': False,
+}
+
+# 等待其他进程刷新时轮询缓存的间隔秒数
+POLL_INTERVAL = 0.05
+
+# 调用统计项
+# - hits: 直接使用进程内副本的次数
+# - cache_loads: 从缓存读取的次数
+# - refreshes: 请求微信刷新的次数
+# - refresh_errors: 刷新失败的次数
+STAT_NAMES = ('hits', 'cache_loads', 'refreshes', 'refresh_errors')
+
+
+def get_token_settings() -> dict:
+    """
+    读取access_token设置，用户设置覆盖默认参数
+    """
+    user_settings = getattr(settings, 'WECHAT_ACCESS_TOKEN', None) or {}
+    return dict(DEFAULTS, **user_settings)
+
+
+class AccessTokenManager(object):
+    """
+    单个应用的access_token管理器
+
+    缓存中access_token和过期时间分开保存：
+    - key: access_token，缓存超时时间为expires_in，兼容直接读取该缓存的旧代码
+    - key + '_expires_at': 过期的时间戳
+    """
+    def __init__(self, key, fetch_token):
+        """
+        :param key: 缓存键
+        :param fetch_token: 请求微信获取access_token的函数，无参数，返回(access_token, expires_in)
+        """
+        self.key = key
+        self.expires_at_key = key + '_expires_at'
+        self.lock_key = key + '_lock'
+        self.fetch_token = fetch_token
+        # 进程内副本
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+        # 事件循环 -> asyncio锁，asyncio锁不能跨事件循环使用
+        self._async_locks = weakref.WeakKeyDictionary()
+        # 调用统计
+        self.stats = dict.fromkeys(STAT_NAMES, 0)
+        self.last_refreshed_at = None
+
+    def _is_usable(self, now) -> bool:
+        return self._token is not None and now < self._expires_at
+
+    def _is_fresh(self, now, early_renewal) -> bool:
+        return self._token is not None and now < self._expires_at - early_renewal
+
+    @property
+    def cache_keys(self) -> list:
+        """
+        缓存中保存access_token和过期时间的键
+        """
+        return [self.key, self.expires_at_key]
+
+    def _set_from_cache_values(self, values: dict):
+        self.stats['cache_loads'] += 1
+        token = values.get(self.key)
+        if token is not None:
+            self._token = token
+            # 没有过期时间的缓存由旧代码写入，视为需要立即续期但仍可使用
+            self._expires_at = values.get(self.expires_at_key) or time.time() + 1
+
+    def _load_from_cache(self):
+        """
+        从缓存读取access_token到进程内副本
+        """
+        self._set_from_cache_values(cache.get_many(self.cache_keys))
+
+    async def _aload_from_cache(self):
+        self._set_from_cache_values(await cache.aget_many(self.cache_keys))
+
+    def _store(self, access_token, expires_in) -> dict:
+        """
+        更新进程内副本，返回需要写入缓存的数据
+        """
+        self._token = access_token
+        self._expires_at = time.time() + int(expires_in)
+        self.stats['refreshes'] += 1
+        self.last_refreshed_at = time.time()
+        return {self.key: access_token, self.expires_at_key: self._expires_at}
+
+    def _refresh(self):
+        """
+        请求微信获取新的access_token，写入缓存和进程内副本
+        """
+        try:
+            access_token, expires_in = self.fetch_token()
+        except Exception:
+            self.stats['refresh_errors'] += 1
+            raise
+        cache.set_many(self._store(access_token, expires_in), timeout=int(expires_in))
+
+    async def _arefresh(self, afetch_token):
+        try:
+            access_token, expires_in = await afetch_token()
+        except Exception:
+            self.stats['refresh_errors'] += 1
+            raise
+        await cache.aset_many(self._store(access_token, expires_in), timeout=int(expires_in))
+
+    def get(self) -> str:
+        """
+        获取access_token
+        :return access_token: str
+        """
+        token_settings = get_token_settings()
+        early_renewal = token_settings['EARLY_RENEWAL']
+
+        # 热路径：进程内副本未到续期时间
+        if self._is_fresh(time.time(), early_renewal):
+            self.stats['hits'] += 1
+            return self._token
+
+        # 已有未过期的副本时不阻塞，其他线程正在续期则直接使用旧副本
+        blocking = not self._is_usable(time.time())
+        if not self._lock.acquire(blocking=blocking):
+            return self._token
+        try:
+            if self._is_fresh(time.time(), early_renewal):
+                return self._token
+            self._load_from_cache()
+            if self._is_fresh(time.time(), early_renewal):
+                return self._token
+
+            # 跨进程锁，获得锁的进程负责刷新
+            deadline = time.time() + token_settings['WAIT_TIMEOUT']
+            while not cache.add(self.lock_key, 1, timeout=token_settings['LOCK_TIMEOUT']):
+                # 其他进程正在刷新：有未过期的副本就先用，否则等待刷新结果
+                if self._is_usable(time.time()):
+                    return self._token
+                if time.time() >= deadline:
+                    # 等待超时，不再依赖其他进程
+                    self._refresh()
+                    return self._token
+                time.sleep(POLL_INTERVAL)
+                self._load_from_cache()
+                if self._is_usable(time.time()):
+                    return self._token
+            try:
+                self._refresh()
+            finally:
+                cache.delete(self.lock_key)
+            return self._token
+        finally:
+            self._lock.release()
+
+    async def aget(self, afetch_token) -> str:
+        """
+        get的异步版本
+        :param afetch_token: 异步请求微信获取access_token的函数，无参数，返回(access_token, expires_in)
+        :return access_token: str
+        """
+        token_settings = get_token_settings()
+        early_renewal = token_settings['EARLY_RENEWAL']
+
+        if self._is_fresh(time.time(), early_renewal):
+            self.stats['hits'] += 1
+            return self._token
+
+        loop = asyncio.get_running_loop()
+        async_lock = self._async_locks.get(loop)
+        if async_lock is None:
+            async_lock = self._async_locks[loop] = asyncio.Lock()
+        # 已有未过期的副本时不等待，其他协程正在续期则直接使用旧副本
+        if async_lock.locked() and self._is_usable(time.time()):
+            return self._token
+        async with async_lock:
+            if self._is_fresh(time.time(), early_renewal):
+                return self._token
+            await self._aload_from_cache()
+            if self._is_fresh(time.time(), early_renewal):
+                return self._token
+
+            deadline = time.time() + token_settings['WAIT_TIMEOUT']
+            while not await cache.aadd(self.lock_key, 1, timeout=token_settings['LOCK_TIMEOUT']):
+                if self._is_usable(time.time()):
+                    return self._token
+                if time.time() >= deadline:
+                    await self._arefresh(afetch_token)
+                    return self._token
+                await asyncio.sleep(POLL_INTERVAL)
+                await self._aload_from_cache()
+                if self._is_usable(time.time()):
+                    return self._token
+            try:
+                await self._arefresh(afetch_token)
+            finally:
+                await cache.adelete(self.lock_key)
+            return self._token
+
+    def refresh_ahead(self, ahead: int = None, cache_values: dict = None) -> bool:
+        """
+        后台续期：剩余有效期不足ahead秒时刷新，其他进程正在刷新时跳过
+
+        续期期间请求中的get继续使用尚未过期的旧access_token，不会阻塞。
+        :param ahead: 提前续期的秒数，默认为settings中的REFRESH_AHEAD
+        :param cache_values: 调用方已经批量读取的缓存值，包含cache_keys，传入时不再读取缓存
+        :return: 是否刷新了access_token
+        """
+        token_settings = get_token_settings()
+        if ahead is None:
+            ahead = token_settings['REFRESH_AHEAD']
+        if self._is_fresh(time.time(), ahead):
+            return False
+        with self._lock:
+            if cache_values is None:
+                self._load_from_cache()
+            else:
+                self._set_from_cache_values(cache_values)
+            if self._is_fresh(time.time(), ahead):
+                return False
+            if not cache.add(self.lock_key, 1, timeout=token_settings['LOCK_TIMEOUT']):
+                return False
+            try:
+                self._refresh()
+            finally:
+                cache.delete(self.lock_key)
+            return True
+
+    def metrics(self) -> dict:
+        """
+        调用统计和进程内副本的状态
+        """
+        expires_in = max(0, int(self._expires_at - time.time())) if self._token is not None else 0
+        return dict(self.stats, key=self.key, expires_in=expires_in, last_refreshed_at=self.last_refreshed_at)
+
+    def invalidate(self, access_token=None):
+        """
+        作废access_token，比如微信返回access_token无效时
+        :param access_token: 需要作废的access_token；如果已被其他调用方刷新成新值则不作废
+        """
+        with self._lock:
+            if access_token is not None and access_token != self._token:
+                return
+            self._token = None
+            self._expires_at = 0
+            if access_token is None or cache.get(self.key) == access_token:
+                cache.delete_many([self.key, self.expires_at_key])
+
+    async def ainvalidate(self, access_token=None):
+        """
+        invalidate的异步版本
+        """
+        if access_token is not None and access_token != self._token:
+            return
+        self._token = None
+        self._expires_at = 0
+        if access_token is None or await cache.aget(self.key) == access_token:
+            await cache.adelete_many([self.key, self.expires_at_key])
+
+
+# ----- 管理器注册表 -----
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_token_manager(key, fetch_token) -> AccessTokenManager:
+    """
+    获取缓存键对应的管理器，同一进程内同一缓存键共享一个管理器和进程内副本
+    :param key: 缓存键
+    :param fetch_token: 请求微信获取access_token的函数，仅在首次创建管理器时使用
+    :return:
+    """
+    manager = _managers.get(key)
+    if manager is None:
+        with _managers_lock:
+            manager = _managers.get(key)
+            if manager is None:
+                manager = AccessTokenManager(key, fetch_token)
+                _managers[key] = manager
+    return manager
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+微信公众号、小程序等应用的服务端API
+
+应用密钥读取settings.WECHAT_APP_SECRETS，按应用标签（client_label）区分：
+WECHAT_APP_SECRETS = {
+    'qtclass_wxmp': {'appid': 'wx...', 'app_secret': '...'},
+}
+
+微信云托管环境中，开放接口服务只代理环境绑定的应用。这些应用通过开放接口服务调用，不需要access_token，
+详见django_wechat.cloudrun.api；其他应用仍然使用access_token：
+WECHAT_APP_SECRETS = {
+    'qtclass_wxmp': {'appid': 'wx...', 'app_secret': '...', 'cloudrun': True},
+}
+也可以用settings.WXCLOUDRUN_APPID指定环境绑定的AppID，应用中的'cloudrun'设置优先。
+"""
+
+from functools import partial
+
+from django.conf import settings
+
+from django_wechat.sdk.sessions import request_json
+from django_wechat.sdk.tokens import AccessTokenManager, get_token_manager
+from django_wechat.cloudrun.settings import IS_WXCLOUDRUN_ENV
+
+# 微信API根URL
+WECHAT_API_ROOT_URL = 'https://api.weixin.qq.com/cgi-bin/'
+
+# access_token无效（40001、40014）或者已过期（42001）的错误码
+INVALID_ACCESS_TOKEN_ERRCODES = (40001, 40014, 42001)
+
+
+# ----- Exception -----
+
+class WeChatSdkException(Exception):
+    @property
+    def errcode(self):
+        """
+        微信返回的错误码，非接口返回的异常为None
+        """
+        data = self.args[0] if self.args else None
+        if isinstance(data, dict):
+            return data.get('errcode')
+        return None
+
+
+# ----- Access Token -----
+
+def get_access_token(appid, secret, session=None) -> (str, int):
+    """
+    获取公众号、小程序的接口调用凭据
+    详细说明：https://developers.weixin.qq.com/doc/offiaccount/Basic_Information/Get_access_token.html
+    :param appid: 应用ID
+    :param secret: 应用密钥
+    :param session: 自定义HTTP会话，默认使用共享会话
+    :return:
+    """
+    url = WECHAT_API_ROOT_URL + 'token'
+    data = request_json('GET', url, session=session,
+                        params={'grant_type': 'client_credential', 'appid': appid, 'secret': secret})
+    if 'access_token' in data:
+        return data['access_token'], int(data['expires_in'])
+    else:
+        raise WeChatSdkException(data)
+
+
+def is_cloudrun_app(app_secrets: dict) -> bool:
+    """
+    应用是否通过微信云托管开放接口服务调用
+    :param app_secrets: settings.WECHAT_APP_SECRETS中的应用设置
+    :return: 云托管环境中设置了'cloudrun': True或者AppID等于settings.WXCLOUDRUN_APPID时为True
+    """
+    if not IS_WXCLOUDRUN_ENV:
+        return False
+    if 'cloudrun' in app_secrets:
+        return bool(app_secrets['cloudrun'])
+    return app_secrets.get('appid') == getattr(settings, 'WXCLOUDRUN_APPID', None)
+
+
+def get_access_token_key(client_label) -> str:
+    """
+    应用access_token的缓存键
+    """
+    return 'wechat_access_token_' + client_label
+
+
+# ----- 通用SDK类 -----
+
+class WeChatSDK(object):
+    """
+    微信公众号、小程序SDK基本类
+    """
+    def __init__(self, client_label, session=None, use_cloudrun=None):
+        """
+        :param client_label: 应用标签，对应settings.WECHAT_APP_SECRETS的键
+        :param session: 自定义HTTP会话，默认使用进程内共享的连接池会话
+        :param use_cloudrun: 是否通过微信云托管开放接口服务调用，默认为is_cloudrun_app的结果
+        """
+        secrets = settings.WECHAT_APP_SECRETS[client_label]
+        self.client_label = client_label
+        self.appid = secrets['appid']
+        self.secret = secrets['app_secret']
+        self._access_token_key = get_access_token_key(client_label)
+        self._api_root_url = WECHAT_API_ROOT_URL
+        self._session = session
+        if use_cloudrun is None:
+            use_cloudrun = is_cloudrun_app(secrets)
+        self._cloudrun_client = None
+        if use_cloudrun:
+            from django_wechat.cloudrun.api import WXCloudRunOpenAPIClient
+            self._cloudrun_client = WXCloudRunOpenAPIClient(session=session)
+
+    @property
+    def access_token(self):
+        """
+        获取access_token，详见AccessTokenManager
+        :return access_token: str
+        """
+        return self.token_manager.get()
+
+    @property
+    def token_manager(self) -> AccessTokenManager:
+        """
+        access_token管理器，同一进程内相同应用的SDK实例和TokenRegistry共享
+        """
+        fetch_token = partial(get_access_token, appid=self.appid, secret=self.secret, session=self._session)
+        return get_token_manager(self._access_token_key, fetch_token)
+
+    def request_api(self, method, api, query_params=None, data=None):
+        # 云托管开放接口服务不需要access_token
+        if self._cloudrun_client is not None:
+            return self._cloudrun_client.request_api(method, 'cgi-bin/' + api, query_params, data)
+
+        url = self._api_root_url + api
+
+        if query_params is None:
+            query_params = dict()
+        access_token = query_params['access_token'] = self.access_token
+
+        return_data = request_json(method, url, session=self._session, params=query_params, json=data)
+
+        # access_token无效或者已过期时作废并重试一次
+        if return_data.get('errcode') in INVALID_ACCESS_TOKEN_ERRCODES:
+            self.token_manager.invalidate(access_token)
+            query_params['access_token'] = self.access_token
+            return_data = request_json(method, url, session=self._session, params=query_params, json=data)
+
+        # 部分接口成功时不返回errcode
+        if return_data.get('errcode', 0) != 0:
+            raise WeChatSdkException(return_data)
+
+        return_data.pop('errcode', None)
+        return_data.pop('errmsg', None)
+        return return_data
+
+    def get_api(self, api, query_params=None):
+        return self.request_api('GET', api, query_params)
+
+    def post_api(self, api, query_params=None, data=None):
+        return self.request_api('POST', api, query_params, data)
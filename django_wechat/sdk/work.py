@@ -3,26 +3,32 @@
 企业微信自定义SDK，封装企业微信服务端API制作
 """
 
-import re
-import json
 import time
 import hashlib
+import logging
 import base64
-import socket
 import struct
-from typing import List
-
-import requests
-import xmltodict
+from typing import List, Iterable
+from functools import partial, lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import pad
 
-from django.core.cache import cache
 from django.conf import settings
+from django.core.cache import cache
 
 from qtutils.random import gen_random_str
 
+from django_wechat.sdk.sessions import request_json
+from django_wechat.sdk.tokens import AccessTokenManager, get_token_manager
+from django_wechat.sdk.ratelimit import get_token_bucket
+from django_wechat.sdk.xmlcodec import get_xml_codec
+
+
+logger = logging.getLogger(__name__)
+
+
 # 企业微信API根URL
 WECHATWORK_API_ROOT_URL = 'https://qyapi.weixin.qq.com/cgi-bin/'
 
@@ -35,25 +41,83 @@ CONTACT_SECRET = WECHATWORK_SECRETS['contact']['secret']
 CONTACT_TOKEN = WECHATWORK_SECRETS['contact']['token']
 CONTACT_ENCODING_AES_KEY = WECHATWORK_SECRETS['contact']['encoding_aes_key']
 
+# access_token无效（40014）或者已过期（42001）的错误码
+INVALID_ACCESS_TOKEN_ERRCODES = (40014, 42001)
+
+# 明文中msg_len的格式：4字节网络字节序无符号整数
+MSG_LEN_STRUCT = struct.Struct('!I')
+
+# 成员不存在的错误码
+USER_NOT_FOUND_ERRCODE = 60111
+# batchdelete单次最多删除的成员数
+BATCH_DELETE_SIZE = 200
+
+# 通讯录回调视图的时间戳允许偏差秒数，超出视为过期或重放的请求，None表示不校验
+WECHATWORK_CALLBACK_REPLAY_WINDOW = getattr(settings, 'WECHATWORK_CALLBACK_REPLAY_WINDOW', 300)
+
+# 批量调用默认设置，settings.WECHATWORK_BULK覆盖
+# - MAX_WORKERS: 并发调用的线程数
+# - RATE: 每个应用每秒最多调用次数，企业微信限制每个应用调用单个接口不超过1万次/分
+# - BURST: 允许的突发调用次数
+BULK_DEFAULTS = {
+    'MAX_WORKERS': 8,
+    'RATE': 100,
+    'BURST': 100,
+}
+
+
+def get_bulk_settings() -> dict:
+    """
+    读取批量调用设置，用户设置覆盖默认参数
+    """
+    user_settings = getattr(settings, 'WECHATWORK_BULK', None) or {}
+    return dict(BULK_DEFAULTS, **user_settings)
+
 
 # ----- Exception -----
 
 class WeChatWorkSdkException(Exception):
-    pass
+    @property
+    def errcode(self):
+        """
+        企业微信返回的错误码，非接口返回的异常为None
+        """
+        data = self.args[0] if self.args else None
+        if isinstance(data, dict):
+            return data.get('errcode')
+        return None
+
+
+class WeChatWorkCallbackStale(WeChatWorkSdkException):
+    """
+    回调请求的时间戳超出允许的时间窗口
+    """
+
+
+class WeChatWorkCallbackReplayed(WeChatWorkSdkException):
+    """
+    回调请求的timestamp和nonce已经使用过
+    """
+
+
+class WeChatWorkCallbackMalformed(WeChatWorkSdkException):
+    """
+    回调请求的密文无法解密或解码
+    """
 
 
 # ----- Access Token -----
 
-def get_access_token(corpid, secret) -> (str, int):
+def get_access_token(corpid, secret, session=None) -> (str, int):
     """
     获取Access Token
     :param corpid: 企业ID
     :param secret: 应用密钥
+    :param session: 自定义HTTP会话，默认使用共享会话
     :return:
     """
-    url = WECHATWORK_API_ROOT_URL + 'gettoken?corpid={corpid}&corpsecret={secret}'\
-        .format(corpid=corpid, secret=secret)
-    data = json.loads(requests.get(url).content)
+    url = WECHATWORK_API_ROOT_URL + 'gettoken'
+    data = request_json('GET', url, session=session, params={'corpid': corpid, 'corpsecret': secret})
     if int(data['errcode']) == 0:
         return data['access_token'], int(data['expires_in'])
     else:
@@ -68,7 +132,7 @@ def extract_encrypt(xml_text: str) -> str:
     :param xml_text:
     :return:
     """
-    data = xmltodict.parse(xml_text)['xml']
+    data = get_xml_codec().parse(xml_text)
     return data["Encrypt"]
 
 
@@ -86,47 +150,112 @@ def cal_encrypt_sign(token: str, timestamp: str, nonce: str, encrypt: str):
     return sha1.hexdigest()
 
 
-def aes_decrypt(msg_encrypt: str, encoding_aes_key: str) -> str:
+class AESCipher(object):
+    """
+    消息AES加解密上下文
+
+    EncodingAESKey转AESKey和IV只在初始化时计算一次。CBC模式的密码对象有状态不能复用，每条消息只创建密码对象。
+    """
+    def __init__(self, encoding_aes_key: str):
+        self.key = base64.b64decode(encoding_aes_key + "=")  # EncodingAESKey转AESKey
+        self.iv = self.key[0:16]
+
+    def new(self):
+        return AES.new(self.key, AES.MODE_CBC, iv=self.iv)
+
+    def decrypt(self, msg_encrypt) -> memoryview:
+        """
+        AES算法解密信息
+        :param msg_encrypt: base64编码的密文
+        :return: 去掉补位的明文字节，为避免复制返回memoryview
+        """
+        aes_msg = base64.b64decode(msg_encrypt)  # 对密文base64解码
+        random_msg = self.new().decrypt(aes_msg)  # 使用AESKey做AES解密
+        pad_num: int = random_msg[-1]  # 去掉补位字符串
+        return memoryview(random_msg)[:-pad_num]
+
+    def encrypt(self, random_msg) -> str:
+        """
+        AES算法加密信息
+        :param random_msg: 明文字节，传入str时按UTF-8编码
+        :return: base64编码的密文
+        """
+        if isinstance(random_msg, str):
+            random_msg = random_msg.encode()
+        msg_encrypt = self.new().encrypt(pad(random_msg, 32))
+        return base64.b64encode(msg_encrypt).decode()
+
+
+@lru_cache(maxsize=32)
+def get_aes_cipher(encoding_aes_key: str) -> AESCipher:
+    """
+    获取EncodingAESKey对应的加解密上下文，同一EncodingAESKey在进程内复用
+    """
+    return AESCipher(encoding_aes_key)
+
+
+def aes_decrypt(msg_encrypt: str, encoding_aes_key: str) -> bytes:
     """
     AES算法解密信息
+    :return: 去掉补位的明文字节
     """
-    aes_msg = base64.b64decode(msg_encrypt)  # 对密文base64解码
-    aes_key = base64.b64decode(encoding_aes_key + "=")  # EncodingAESKey转AESKey
-    random_msg = AES.new(aes_key, AES.MODE_CBC, iv=aes_key[0:16]).decrypt(aes_msg)  # 使用AESKey做AES解密
-    pad_num: int = random_msg[-1]  # 去掉补位字符串
-    return random_msg[:-pad_num].decode()
+    return bytes(get_aes_cipher(encoding_aes_key).decrypt(msg_encrypt))
 
 
-def parse_random_msg(random_msg: str) -> dict:
+def split_random_msg(random_msg) -> (memoryview, str):
     """
-    解析字符串
+    拆分明文
+    :param random_msg: 明文字节，可以是bytes或memoryview
+    :return: msg: 消息字节
+    :return: receive_id: 企业ID等接收方ID
     """
-    # 规则：and_msg = random(16B) + msg_len(4B) + msg + receive_id
-    content = random_msg[16:]  # 去掉前16随机字节
-    xml_len: int = socket.ntohl(struct.unpack("I", content[: 4].encode())[0])
-    msg = content[4: xml_len + 4]  # 截取msg_len 长度的msg
-    receive_id = content[xml_len + 4:]  # 剩余字节为receive_id
+    # 规则：random_msg = random(16B) + msg_len(4B) + msg + receive_id
+    # msg_len是msg的字节数，全程按字节切片，只在XML边界解码
+    buf = memoryview(random_msg)
+    xml_len: int = MSG_LEN_STRUCT.unpack_from(buf, 16)[0]  # 跳过前16随机字节，读取网络字节序的msg_len
+    msg = buf[20: xml_len + 20]  # 截取msg_len 长度的msg
+    receive_id = str(buf[xml_len + 20:], 'utf-8')  # 剩余字节为receive_id
+    return msg, receive_id
+
+
+def parse_random_msg(random_msg) -> dict:
+    """
+    解析明文
+    :param random_msg: 明文字节，可以是bytes或memoryview
+    """
+    msg, receive_id = split_random_msg(random_msg)
 
     # 解析XML明文信息
-    data = xmltodict.parse(msg)['xml']
+    data = get_xml_codec().parse(bytes(msg))
     if data['ToUserName'] != receive_id:
         raise WeChatWorkSdkException("XML数据解密或明文解析错误")
-    return dict(data)
+    return data
 
 
-def decrypt_msg(xml_text: str, encrypt_sign: str, timestamp: str, nonce: str, token: str, encoding_aes_key: str) -> dict:
+def verify_encrypt_sign(xml_text: str, encrypt_sign: str, timestamp: str, nonce: str, token: str) -> str:
     """
-    解密客户端消息
-    :return:
+    读取加密信息并效验签名
+    :return: 加密信息
     """
-    # 读取加密信息
     msg_encrypt = extract_encrypt(xml_text=xml_text)
-    # 效验签名
     dev_encrypt_sign = cal_encrypt_sign(token, timestamp, nonce, msg_encrypt)
     if dev_encrypt_sign != encrypt_sign:
         raise WeChatWorkSdkException("签名效验不通过")
+    return msg_encrypt
+
+
+def decrypt_msg(xml_text: str, encrypt_sign: str, timestamp: str, nonce: str, token: str, encoding_aes_key: str,
+                cipher: AESCipher = None) -> dict:
+    """
+    解密客户端消息
+    :param cipher: 加解密上下文，默认按encoding_aes_key获取
+    :return:
+    """
+    msg_encrypt = verify_encrypt_sign(xml_text, encrypt_sign, timestamp, nonce, token)
     # AES算法解密
-    random_msg = aes_decrypt(msg_encrypt, encoding_aes_key)
+    if cipher is None:
+        cipher = get_aes_cipher(encoding_aes_key)
+    random_msg = cipher.decrypt(msg_encrypt)
     # 解析随机字符串并把XML数据转成字典
     data = parse_random_msg(random_msg)
     return data
@@ -135,35 +264,25 @@ def decrypt_msg(xml_text: str, encrypt_sign: str, timestamp: str, nonce: str, to
 # ----- 服务端数据加密算法 ------
 
 def dict_to_xml(data: dict) -> str:
-    xml_str = "<xml>"
-    for key, value in data.items():
-        pattern = re.compile(r'\d+')
-        if not pattern.match(value):
-            value = "<![CDATA[{value}]]>".format(value=value)
-        xml_item = "<{key}>{value}</{key}>\n".format(key=key, value=value)
-        xml_str += xml_item
-    xml_str += "</xml>"
-    return xml_str
+    return get_xml_codec().dumps(data)
 
 
-def gen_random_msg(data: dict, random_str_16=None) -> str:
+def gen_random_msg(data: dict, random_str_16=None) -> bytes:
     """
-    生成随机字符串
+    生成明文
     :param data:
     :param random_str_16: 16位占位符，默认自动生成
     :return: b''
     """
     if random_str_16 is None:
         random_str_16 = gen_random_str(16)
-    msg: str = dict_to_xml(data)
-    random_msg = random_str_16 + struct.pack("I", socket.htonl(len(msg))).decode() + msg + data['ToUserName']
-    return random_msg
+    msg: bytes = dict_to_xml(data).encode()
+    # msg_len为msg的字节数，非ASCII字符占多个字节
+    return b''.join((random_str_16.encode(), MSG_LEN_STRUCT.pack(len(msg)), msg, data['ToUserName'].encode()))
 
 
-def aes_encrypt(random_str: str, encoding_aes_key: str) -> str:
-    aes_key = base64.b64decode(encoding_aes_key + "=")  # EncodingAESKey转AESKey
-    msg_encrypt = AES.new(aes_key, AES.MODE_CBC, iv=aes_key[0:16]).encrypt(pad(random_str.encode(), 32))  # AES算法加密
-    return base64.b64encode(msg_encrypt).decode()
+def aes_encrypt(random_msg, encoding_aes_key: str) -> str:
+    return get_aes_cipher(encoding_aes_key).encrypt(random_msg)
 
 
 def gen_xml_text(msg_encrypt: str, signature: str, timestamp: str, nonce: str) -> str:
@@ -185,9 +304,11 @@ def gen_xml_text(msg_encrypt: str, signature: str, timestamp: str, nonce: str) -
     return xml_text
 
 
-def encrypt_msg(data: dict, token: str, encoding_aes_key: str, timestamp=None, nonce=None, random_str_16=None) -> str:
+def encrypt_msg(data: dict, token: str, encoding_aes_key: str, timestamp=None, nonce=None, random_str_16=None,
+                cipher: AESCipher = None) -> str:
     """
     加密需要发给客户端的消息
+    :param cipher: 加解密上下文，默认按encoding_aes_key获取
     :return:
     """
     if timestamp is None:
@@ -196,8 +317,10 @@ def encrypt_msg(data: dict, token: str, encoding_aes_key: str, timestamp=None, n
         nonce = gen_random_str(10)  # 不确定随机字符串的要求，按照文档的位数给了10位
 
     # 加密数据
-    random_msg: str = gen_random_msg(data, random_str_16=random_str_16)
-    msg_encrypt = aes_encrypt(random_msg, encoding_aes_key)
+    random_msg: bytes = gen_random_msg(data, random_str_16=random_str_16)
+    if cipher is None:
+        cipher = get_aes_cipher(encoding_aes_key)
+    msg_encrypt = cipher.encrypt(random_msg)
 
     # 计算签名
     msg_sign = cal_encrypt_sign(token, timestamp, nonce, msg_encrypt)
@@ -206,11 +329,27 @@ def encrypt_msg(data: dict, token: str, encoding_aes_key: str, timestamp=None, n
     return gen_xml_text(msg_encrypt, msg_sign, timestamp, nonce)
 
 
+# ----- 工具函数 -----
+
+def chunked(iterable: Iterable, size: int):
+    """
+    把输入按size个一组切分，逐组返回列表
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 # ----- 通用SDK类 -----
 
-class WeChatWorkSDK(object):
+class WeChatWorkSDKMixin(object):
     """
-    企业微信SDK基本类
+    企业微信SDK的应用设置和access_token管理器，同步SDK和异步SDK共用，不包含任何网络请求
     """
     def __init__(self, corpid=None, secret=None, name=None):
         """
@@ -231,6 +370,31 @@ class WeChatWorkSDK(object):
             raise WeChatWorkSdkException("secret不可以为空")
         self.secret = secret
         self._api_root_url = WECHATWORK_API_ROOT_URL
+        # 同步获取access_token使用的HTTP会话，None表示进程内共享的连接池会话
+        self._session = None
+
+    @property
+    def token_manager(self) -> AccessTokenManager:
+        """
+        access_token管理器，同一进程内相同缓存键的SDK实例共享
+        """
+        fetch_token = partial(get_access_token, corpid=self.corpid, secret=self.secret, session=self._session)
+        return get_token_manager(self._access_token_key, fetch_token)
+
+
+class WeChatWorkSDK(WeChatWorkSDKMixin):
+    """
+    企业微信SDK基本类
+    """
+    def __init__(self, corpid=None, secret=None, name=None, session=None):
+        """
+        :param corpid:
+        :param secret:
+        :param name: 自定义的名称
+        :param session: 自定义HTTP会话，默认使用进程内共享的连接池会话
+        """
+        super().__init__(corpid, secret, name)
+        self._session = session
 
     @property
     def access_token(self):
@@ -238,21 +402,11 @@ class WeChatWorkSDK(object):
         获取access_token
         详细说明：https://work.weixin.qq.com/api/doc/90000/90135/91039
 
-        首先从缓存中获取；若缓存不存在或者过期，则通过调用接口从企业微信服务器获取并缓存
+        首先从进程内副本和缓存中获取；临近过期时由一个调用方通过调用接口从企业微信服务器获取并缓存，详见AccessTokenManager
         property装饰器只是把方法变成属性，每次被调用时依然会调用方法并且返回属性，不会出现缓存过期依然被使用的情况
         :return access_token: str
         """
-        try:
-            access_token = cache.get(self._access_token_key)
-        except KeyError:
-            access_token = None
-
-        # access_token缓存为空或者不存在此缓存数据时，都处理为None并且重新请求
-        if access_token is None:
-            access_token, expires_in = get_access_token(corpid=self.corpid, secret=self.secret)
-            cache.set(self._access_token_key, access_token, timeout=int(expires_in))
-
-        return access_token
+        return self.token_manager.get()
 
     def request_api(self, method, api, query_params=None, data=None):
         url = self._api_root_url + api
@@ -260,11 +414,16 @@ class WeChatWorkSDK(object):
         # 默认必须传入access_token
         if query_params is None:
             query_params = dict()
-        query_params['access_token'] = self.access_token
+        access_token = query_params['access_token'] = self.access_token
 
         # API接口要求必须以JSON格式传入数据
-        response = requests.request(method, url, params=query_params, json=data)
-        return_data = json.loads(response.content)
+        return_data = request_json(method, url, session=self._session, params=query_params, json=data)
+
+        # access_token无效或者已过期时作废并重试一次
+        if return_data['errcode'] in INVALID_ACCESS_TOKEN_ERRCODES:
+            self.token_manager.invalidate(access_token)
+            query_params['access_token'] = self.access_token
+            return_data = request_json(method, url, session=self._session, params=query_params, json=data)
 
         # 抛出异常
         if return_data['errcode'] != 0:
@@ -281,15 +440,106 @@ class WeChatWorkSDK(object):
     def post_api(self, api, query_params=None, data=None):
         return self.request_api('POST', api, query_params, data)
 
+    def run_bulk(self, func, items: Iterable, max_workers: int = None, rate: float = None) -> dict:
+        """
+        使用线程池并发执行批量调用，并用令牌桶限制调用频率
+
+        同一时刻最多提交max_workers * 2个任务，输入可以是生成器，内存占用不随输入数量增长。
+        :param func: 处理单个输入的函数，参数为(item, bucket)，每次调用接口前先调用bucket.acquire()，
+          返回{key: 返回数据或异常}
+        :param items: 输入
+        :param max_workers: 并发线程数，默认为get_bulk_settings()['MAX_WORKERS']
+        :param rate: 每秒最多调用次数，默认为get_bulk_settings()['RATE']；同一应用在进程内共享令牌桶，
+          传入不同的rate时更新共享令牌桶
+        :return: {'succeeded': {key: 返回数据}, 'failed': {key: 异常}}
+        """
+        bulk_settings = get_bulk_settings()
+        if max_workers is None:
+            max_workers = bulk_settings['MAX_WORKERS']
+        if rate is None:
+            rate = bulk_settings['RATE']
+        bucket = get_token_bucket(self._access_token_key, rate, bulk_settings['BURST'])
+
+        results = {'succeeded': {}, 'failed': {}}
+
+        def collect(futures):
+            for future in futures:
+                for key, result in future.result().items():
+                    if isinstance(result, Exception):
+                        results['failed'][key] = result
+                    else:
+                        results['succeeded'][key] = result
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = set()
+            for item in items:
+                if len(pending) >= max_workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(func, item, bucket))
+            collect(wait(pending).done)
+        return results
+
 
 class WeChatWorkCallbackSDK(object):
     """
     企业微信回调SDK基本类，用于实现内部系统和企业微信客户端的双向通信
     详细说明：https://work.weixin.qq.com/api/doc/90000/90135/90930
     """
-    def __init__(self, token, encoding_aes_key):
+    def __init__(self, token, encoding_aes_key, replay_window=None,
+                 nonce_cache_prefix='wechatwork_callback_nonce_', receive_id=None):
+        """
+        :param token:
+        :param encoding_aes_key:
+        :param replay_window: 时间戳允许的偏差秒数，None表示不校验时间戳和nonce
+        :param nonce_cache_prefix: nonce缓存键前缀
+        :param receive_id: 接收方ID，比如企业ID，设置时校验解密结果中的接收方ID
+        """
         self.token = token
         self.encoding_aes_key = encoding_aes_key
+        self.replay_window = replay_window
+        self.nonce_cache_prefix = nonce_cache_prefix
+        self.receive_id = receive_id
+        # AESKey和IV只计算一次
+        self.cipher = AESCipher(encoding_aes_key)
+
+    def check_timestamp(self, timestamp):
+        """
+        校验时间戳是否在允许的时间窗口内
+        """
+        if self.replay_window is None:
+            return
+        try:
+            delta = abs(time.time() - int(timestamp))
+        except (TypeError, ValueError):
+            raise WeChatWorkCallbackStale("时间戳格式错误")
+        if delta > self.replay_window:
+            raise WeChatWorkCallbackStale("时间戳超出有效期")
+
+    def get_nonce_cache_key(self, timestamp, nonce) -> str:
+        # 包含token，共用缓存的多个应用互不影响
+        identity = '{}:{}:{}'.format(self.token, timestamp, nonce)
+        return self.nonce_cache_prefix + hashlib.sha1(identity.encode()).hexdigest()
+
+    def check_nonce(self, timestamp, nonce):
+        """
+        校验timestamp和nonce是否已经处理过
+        """
+        if self.replay_window is None:
+            return
+        if cache.get(self.get_nonce_cache_key(timestamp, nonce)) is not None:
+            raise WeChatWorkCallbackReplayed("nonce已经使用过")
+
+    def record_nonce(self, timestamp, nonce):
+        """
+        回调处理完成后记录timestamp和nonce，时间窗口内再次出现视为重放
+
+        处理失败时不记录，企业微信用相同的timestamp和nonce重试时可以再次处理。
+        """
+        if self.replay_window is None:
+            return
+        # 时间戳前后各允许replay_window秒，记录保留到时间窗口结束
+        cache.set(self.get_nonce_cache_key(timestamp, nonce), 1, timeout=self.replay_window * 2 + 1)
 
     def encrypt(self, data: dict) -> str:
         """
@@ -299,27 +549,59 @@ class WeChatWorkCallbackSDK(object):
         :param nonce:
         :return:
         """
-        return encrypt_msg(data, token=self.token, encoding_aes_key=self.encoding_aes_key)
+        return encrypt_msg(data, token=self.token, encoding_aes_key=self.encoding_aes_key, cipher=self.cipher)
 
     def decrypt(self, xml, sign, timestamp, nonce) -> dict:
         """
         验证并解密来自客户端的数据
+
+        按开销从小到大依次校验时间戳、签名和nonce，通过后才进行AES解密和XML解析，
+        过期或重放的请求不会占用解密的开销。处理完成后需要调用record_nonce记录nonce。
         :return:
         """
-        return decrypt_msg(xml_text=xml, encrypt_sign=sign, timestamp=timestamp, nonce=nonce,
-                           token=self.token, encoding_aes_key=self.encoding_aes_key)
+        self.check_timestamp(timestamp)
+        msg_encrypt = verify_encrypt_sign(xml, sign, timestamp, nonce, self.token)
+        self.check_nonce(timestamp, nonce)
+        data = parse_random_msg(self.cipher.decrypt(msg_encrypt))
+        self.check_receive_id(data['ToUserName'])
+        return data
+
+    def check_receive_id(self, receive_id):
+        """
+        校验解密结果中的接收方ID
+        """
+        if self.receive_id is not None and receive_id != self.receive_id:
+            raise WeChatWorkSdkException("接收方ID不一致")
+
+    def verify_url(self, echostr, sign, timestamp, nonce) -> str:
+        """
+        验证回调URL，解密企业微信GET请求中的echostr
+        详细说明：https://developer.work.weixin.qq.com/document/path/90238
+        :return: 需要原样返回给企业微信的明文
+        """
+        self.check_timestamp(timestamp)
+        if cal_encrypt_sign(self.token, timestamp, nonce, echostr) != sign:
+            raise WeChatWorkSdkException("签名效验不通过")
+        try:
+            msg, receive_id = split_random_msg(self.cipher.decrypt(echostr))
+            msg = str(msg, 'utf-8')
+        except (ValueError, struct.error):
+            # base64、补位或UTF-8解码错误
+            raise WeChatWorkCallbackMalformed("echostr解密错误")
+        self.check_receive_id(receive_id)
+        return msg
 
 
 # ------ 企业微信通讯录SDK ------
 
 class ContactSDK(WeChatWorkSDK):
-    def __init__(self):
-        super().__init__(CORPID, CONTACT_SECRET, 'contact')
+    def __init__(self, session=None):
+        super().__init__(CORPID, CONTACT_SECRET, 'contact', session=session)
 
 
 class UserSDK(ContactSDK):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, session=None):
+        super().__init__(session=session)
         # 把默认（父类）API根目录修改成SDK类专用API根目录
         # 先后顺序很重要
         self._api_root_url = self._api_root_url + 'user/'
@@ -345,6 +627,71 @@ class UserSDK(ContactSDK):
     def delete(self, userid):
         return self.get_api(api='delete', query_params={'userid': userid})
 
+    def batch_delete(self, userids: List[str]):
+        """
+        批量删除成员
+        :param userids: 成员UserID列表，单次最多BATCH_DELETE_SIZE个
+        :return:
+        """
+        return self.post_api(api='batchdelete', data={'useridlist': userids})
+
+    def _upsert_one(self, data: dict, bucket) -> dict:
+        """
+        更新成员，成员不存在时创建
+        """
+        userid = data['userid']
+        try:
+            bucket.acquire()
+            try:
+                return {userid: self.update(data)}
+            except WeChatWorkSdkException as e:
+                if e.errcode != USER_NOT_FOUND_ERRCODE:
+                    raise
+            bucket.acquire()
+            return {userid: self.create(data)}
+        except Exception as e:
+            return {userid: e}
+
+    def _delete_chunk(self, userids: List[str], bucket) -> dict:
+        """
+        用batchdelete删除一批成员；整批失败时逐个删除，以便定位失败的成员
+        """
+        try:
+            bucket.acquire()
+            self.batch_delete(userids)
+            return {userid: {} for userid in userids}
+        except WeChatWorkSdkException as e:
+            logger.warning('批量删除成员失败，改为逐个删除：errcode=%s', e.errcode)
+        results = {}
+        for userid in userids:
+            try:
+                bucket.acquire()
+                results[userid] = self.delete(userid)
+            except Exception as e:
+                results[userid] = e
+        return results
+
+    def bulk_upsert(self, users: Iterable[dict], max_workers: int = None, rate: float = None) -> dict:
+        """
+        并发批量创建或更新成员，单个成员失败不影响其他成员
+        :param users: 成员数据，格式同create，可以是生成器
+        :param max_workers: 并发线程数
+        :param rate: 每秒最多调用次数
+        :return: {'succeeded': {userid: 返回数据}, 'failed': {userid: 异常}}
+        """
+        return self.run_bulk(self._upsert_one, users, max_workers=max_workers, rate=rate)
+
+    def bulk_delete(self, userids: Iterable[str], max_workers: int = None, rate: float = None) -> dict:
+        """
+        并发批量删除成员，每BATCH_DELETE_SIZE个成员调用一次batchdelete
+        :param userids: 成员UserID，可以是生成器
+        :param max_workers: 并发线程数
+        :param rate: 每秒最多调用次数
+        :return: {'succeeded': {userid: 返回数据}, 'failed': {userid: 异常}}
+        """
+        return self.run_bulk(self._delete_chunk, chunked(userids, BATCH_DELETE_SIZE),
+                             max_workers=max_workers, rate=rate)
+
     def list(self, department_id=1, fetch_child=True, detail=True) -> List[dict]:
         """
         获取部门成员（详情）
@@ -360,6 +707,55 @@ class UserSDK(ContactSDK):
         query_params = {'department_id': department_id, 'fetch_child': int(fetch_child)}
         return self.get_api(api=api, query_params=query_params)['userlist']
 
+    def iter_list(self, department_id=1, fetch_child=True, detail=True, fields: Iterable[str] = None):
+        """
+        逐个部门获取部门成员（详情），以生成器的形式返回
+
+        和list不同，每次只请求并保留一个部门的成员数据，内存占用不随企业规模增长。
+        同时属于多个部门的成员只返回一次。
+        :param department_id: 获取的部门id，默认根部门
+        :param fetch_child: 是否递归获取子部门下面的成员，默认是
+        :param detail: 是否获取详情数据，默认是
+        :param fields: 只保留的字段，比如('userid', 'name')，默认保留全部字段
+        :return: 成员数据的生成器
+        """
+        if fetch_child:
+            departments = DepartmentSDK(session=self._session).list(department_id)['department']
+            department_ids = [department['id'] for department in departments]
+        else:
+            department_ids = [department_id]
+        if fields is not None:
+            fields = tuple(fields)
+
+        seen_userids = set()
+        for dep_id in department_ids:
+            for user in self.list(department_id=dep_id, fetch_child=False, detail=detail):
+                userid = user['userid']
+                if userid in seen_userids:
+                    continue
+                seen_userids.add(userid)
+                if fields is not None:
+                    user = {field: user[field] for field in fields if field in user}
+                yield user
+
+    def iter_userids(self, limit: int = 10000):
+        """
+        使用游标分页获取企业全部成员的UserID和所属部门，以生成器的形式返回
+        详细说明：https://developer.work.weixin.qq.com/document/path/96067
+        :param limit: 每页数量，最大10000
+        :return: {'userid': ..., 'department': ...}的生成器，同时属于多个部门的成员每个部门返回一条
+        """
+        cursor = ''
+        while True:
+            data = {'limit': limit}
+            if cursor:
+                data['cursor'] = cursor
+            page = self.post_api(api='list_id', data=data)
+            yield from page.get('dept_user', [])
+            cursor = page.get('next_cursor')
+            if not cursor:
+                break
+
     def get_active_stat(self, date: str) -> int:
         """
         获取查询日期当天的活跃人数
@@ -375,8 +771,8 @@ class UserSDK(ContactSDK):
 
 
 class DepartmentSDK(ContactSDK):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, session=None):
+        super().__init__(session=session)
         self._api_root_url = self._api_root_url + 'department/'
 
     def create(self):
@@ -394,8 +790,8 @@ class DepartmentSDK(ContactSDK):
 
 
 class TagSDK(ContactSDK):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, session=None):
+        super().__init__(session=session)
         self._api_root_url = self._api_root_url + 'tag/'
 
     def list(self):
@@ -405,6 +801,14 @@ class TagSDK(ContactSDK):
         """
         return self.get_api('list')
 
+    def get(self, tagid):
+        """
+        获取标签成员
+        :param tagid: 标签ID
+        :return: 包含userlist（成员）和partylist（部门ID）
+        """
+        return self.get_api('get', {'tagid': tagid})
+
 
 class ContactCallbackSDK(ContactSDK):
     def __init__(self):
@@ -414,8 +818,8 @@ class ContactCallbackSDK(ContactSDK):
 # ----- 企业微信通讯录回调SDK -----
 
 class ContactCallbackSDK(WeChatWorkCallbackSDK):
-    def __init__(self, token, encoding_aes_key):
-        super().__init__(token, encoding_aes_key)
+    def __init__(self, token, encoding_aes_key, replay_window=None):
+        super().__init__(token, encoding_aes_key, replay_window=replay_window, receive_id=CORPID)
 
 
 # ----- 企业微信身份认证 -----
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+企业微信自定义SDK的异步版本，用于ASGI部署，需要安装httpx
+
+接口和work.py中的同步SDK一一对应，调用时加await：
+
+    sdk = AsyncUserSDK()
+    users = await asyncio.gather(*[sdk.get(userid) for userid in userids])
+"""
+
+from typing import List
+from functools import partial
+
+from django_wechat.sdk.sessions import arequest_json
+from django_wechat.sdk.work import (
+    WECHATWORK_API_ROOT_URL, CORPID, CONTACT_SECRET, INVALID_ACCESS_TOKEN_ERRCODES,
+    WeChatWorkSdkException, WeChatWorkSDKMixin,
+)
+
+
+# ----- Access Token -----
+
+async def aget_access_token(corpid, secret, client=None) -> (str, int):
+    """
+    get_access_token的异步版本
+    :param corpid: 企业ID
+    :param secret: 应用密钥
+    :param client: 自定义httpx.AsyncClient，默认使用当前事件循环共享的客户端
+    :return:
+    """
+    url = WECHATWORK_API_ROOT_URL + 'gettoken'
+    data = await arequest_json('GET', url, client=client, params={'corpid': corpid, 'corpsecret': secret})
+    if int(data['errcode']) == 0:
+        return data['access_token'], int(data['expires_in'])
+    else:
+        raise WeChatWorkSdkException(data['errmsg'])
+
+
+# ----- 通用SDK类 -----
+
+class AsyncWeChatWorkSDK(WeChatWorkSDKMixin):
+    """
+    企业微信SDK异步基本类
+
+    和同名的同步SDK使用相同的access_token缓存键，共享进程内副本和缓存。
+    不继承同步SDK，没有会阻塞事件循环的access_token属性和run_bulk，使用await get_access_token()
+    """
+    def __init__(self, corpid=None, secret=None, name=None, client=None):
+        """
+        :param corpid:
+        :param secret:
+        :param name: 自定义的名称
+        :param client: 自定义httpx.AsyncClient，默认使用当前事件循环共享的连接池客户端
+        """
+        super().__init__(corpid, secret, name)
+        self._client = client
+
+    async def get_access_token(self) -> str:
+        """
+        获取access_token，详见WeChatWorkSDK.access_token
+        :return access_token: str
+        """
+        afetch_token = partial(aget_access_token, corpid=self.corpid, secret=self.secret, client=self._client)
+        return await self.token_manager.aget(afetch_token)
+
+    async def request_api(self, method, api, query_params=None, data=None):
+        url = self._api_root_url + api
+
+        # 默认必须传入access_token
+        if query_params is None:
+            query_params = dict()
+        access_token = query_params['access_token'] = await self.get_access_token()
+
+        # API接口要求必须以JSON格式传入数据
+        return_data = await arequest_json(method, url, client=self._client, params=query_params, json=data)
+
+        # access_token无效或者已过期时作废并重试一次
+        if return_data['errcode'] in INVALID_ACCESS_TOKEN_ERRCODES:
+            await self.token_manager.ainvalidate(access_token)
+            query_params['access_token'] = await self.get_access_token()
+            return_data = await arequest_json(method, url, client=self._client, params=query_params, json=data)
+
+        # 抛出异常
+        if return_data['errcode'] != 0:
+            raise WeChatWorkSdkException(return_data)
+
+        # 返回时删除errcode和errmsg
+        return_data.pop('errcode')
+        return_data.pop('errmsg')
+        return return_data
+
+    async def get_api(self, api, query_params=None):
+        return await self.request_api('GET', api, query_params)
+
+    async def post_api(self, api, query_params=None, data=None):
+        return await self.request_api('POST', api, query_params, data)
+
+
+# ------ 企业微信通讯录SDK ------
+
+class AsyncContactSDK(AsyncWeChatWorkSDK):
+    def __init__(self, client=None):
+        super().__init__(CORPID, CONTACT_SECRET, 'contact', client=client)
+
+
+class AsyncUserSDK(AsyncContactSDK):
+    def __init__(self, client=None):
+        super().__init__(client=client)
+        self._api_root_url = self._api_root_url + 'user/'
+
+    async def create(self, data: dict):
+        """
+        :param data: 详见UserSDK.create
+        :return:
+        """
+        return await self.post_api(api='create', data=data)
+
+    async def get(self, userid):
+        return await self.get_api(api='get', query_params={'userid': userid})
+
+    async def update(self, data):
+        return await self.post_api(api='update', data=data)
+
+    async def delete(self, userid):
+        return await self.get_api(api='delete', query_params={'userid': userid})
+
+    async def list(self, department_id=1, fetch_child=True, detail=True) -> List[dict]:
+        """
+        获取部门成员（详情），详见UserSDK.list
+        """
+        if detail:
+            api = 'list'
+        else:
+            api = 'simplelist'
+        query_params = {'department_id': department_id, 'fetch_child': int(fetch_child)}
+        return (await self.get_api(api=api, query_params=query_params))['userlist']
+
+    async def get_active_stat(self, date: str) -> int:
+        """
+        获取查询日期当天的活跃人数，详见UserSDK.get_active_stat
+        """
+        data = await self.post_api(api='get_active_stat', data={'date': date})
+        return int(data['active_cnt'])
+
+
+class AsyncDepartmentSDK(AsyncContactSDK):
+    def __init__(self, client=None):
+        super().__init__(client=client)
+        self._api_root_url = self._api_root_url + 'department/'
+
+    async def list(self, depid: str = 1):
+        """
+        获取指定部门及其下的递归子部门数据，详见DepartmentSDK.list
+        """
+        query_params = {'id': depid}
+        return await self.get_api('list', query_params)
+
+
+class AsyncTagSDK(AsyncContactSDK):
+    def __init__(self, client=None):
+        super().__init__(client=client)
+        self._api_root_url = self._api_root_url + 'tag/'
+
+    async def list(self):
+        """
+        获取标签列表
+        """
+        return await self.get_api('list')
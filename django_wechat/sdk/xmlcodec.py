@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+回调消息XML编解码
+
+- FastXMLCodec: 默认实现，使用C加速的ElementTree单次遍历根节点下的元素，序列化使用预编译的正则
+- XmltodictCodec: 使用xmltodict解析，用作兼容后备
+
+两者的解析结果一致：根节点xml下的元素转成字典，叶子元素的文本去掉首尾空白，空文本为None，
+重复的元素转成列表；不保留属性。
+
+Django settings可以指定编解码类的导入路径：
+WECHATWORK_XML_CODEC = 'django_wechat.sdk.xmlcodec.XmltodictCodec'
+"""
+
+import re
+from functools import lru_cache
+from xml.etree import ElementTree
+
+import xmltodict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+# 默认编解码类
+DEFAULT_XML_CODEC = 'django_wechat.sdk.xmlcodec.FastXMLCodec'
+
+# 纯数字的值不需要CDATA
+NUMERIC_PATTERN = re.compile(r'\d+')
+
+
+def _cdata(value: str) -> str:
+    # CDATA内不能出现"]]>"，拆成两段
+    return '<![CDATA[' + value.replace(']]>', ']]]]><![CDATA[>') + ']]>'
+
+
+def dumps_xml(data: dict) -> str:
+    """
+    把扁平字典序列化成回调消息XML，每个元素后换行
+    """
+    parts = ['<xml>']
+    for key, value in data.items():
+        value = str(value)
+        if not NUMERIC_PATTERN.fullmatch(value):
+            value = _cdata(value)
+        parts.append('<{key}>{value}</{key}>\n'.format(key=key, value=value))
+    parts.append('</xml>')
+    return ''.join(parts)
+
+
+class XmltodictCodec(object):
+    """
+    基于xmltodict的编解码
+    """
+    def parse(self, xml) -> dict:
+        """
+        :param xml: XML文本，str或bytes
+        :return: 根节点xml下的数据
+        """
+        return dict(xmltodict.parse(xml)['xml'])
+
+    def dumps(self, data: dict) -> str:
+        return dumps_xml(data)
+
+
+def _element_value(element):
+    if len(element) == 0:
+        text = element.text
+        if text is not None:
+            text = text.strip() or None
+        return text
+    value = {}
+    for child in element:
+        child_value = _element_value(child)
+        if child.tag in value:
+            if not isinstance(value[child.tag], list):
+                value[child.tag] = [value[child.tag]]
+            value[child.tag].append(child_value)
+        else:
+            value[child.tag] = child_value
+    return value
+
+
+class FastXMLCodec(object):
+    """
+    基于ElementTree的编解码
+
+    回调消息基本是扁平结构，解析时只遍历一次根节点的子元素，不逐个触发SAX回调构造中间对象。
+    """
+    def parse(self, xml) -> dict:
+        """
+        :param xml: XML文本，str或bytes
+        :return: 根节点xml下的数据
+        """
+        value = _element_value(ElementTree.fromstring(xml))
+        # 根节点没有子元素
+        if not isinstance(value, dict):
+            return {}
+        return value
+
+    def dumps(self, data: dict) -> str:
+        return dumps_xml(data)
+
+
+@lru_cache(maxsize=None)
+def get_xml_codec():
+    """
+    获取settings.WECHATWORK_XML_CODEC指定的编解码实例，默认为FastXMLCodec
+    """
+    codec_class = import_string(getattr(settings, 'WECHATWORK_XML_CODEC', DEFAULT_XML_CODEC))
+    return codec_class()
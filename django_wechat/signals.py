@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+django_wechat信号
+"""
+
+from django.dispatch import Signal
+
+# 收到企业微信通讯录回调事件，在分发器的工作线程中发送
+# 参数：event，ContactCallbackSDK解密后的事件数据
+wechatwork_contact_event = Signal()
+
+# 微信支付结果通知验证签名并保存后，在分发器的工作线程中发送，由payments.handle_payment_notify处理
+# 参数：data，parse_wechatpay_notify_data解析后的通知数据
+wechatpay_notify = Signal()
+
+# 处理微信支付订单的结果通知，所有接收函数成功后通知才标记为已处理，任一接收函数失败时会再次发送
+# 参数：notification，WeChatPayOrderNotification实例
+wechatpay_order_notified = Signal()
@@ -8,5 +8,6 @@ from . import views
 app_name = "django_wechat"
 
 urlpatterns = [
-
+    path('wechatwork/contact/callback/', views.contact_callback, name='wechatwork_contact_callback'),
+    path('wechatpay/notify/', views.wechatpay_notify_callback, name='wechatpay_notify'),
 ]
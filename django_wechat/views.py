@@ -1,10 +1,128 @@
 # -*- coding: utf-8 -*-
 
+import logging
+from functools import lru_cache
+
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+
 from rest_framework.request import Request
-from rest_framework.response import Response
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.permissions import AllowAny
+
+from django_wechat.callbacks import get_dispatcher, get_deduplicator
+from django_wechat.payments import is_processed, save_notification
+from django_wechat.signals import wechatwork_contact_event, wechatpay_notify
+
+
+logger = logging.getLogger(__name__)
+
+# 通讯录回调事件的顺序键
+CONTACT_EVENT_ORDERING_KEY = 'wechatwork-contact'
+
+
+@lru_cache(maxsize=None)
+def get_contact_callback_sdk():
+    # 企业微信SDK需要WECHATWORK_SECRETS，只在使用通讯录回调时导入
+    from django_wechat.sdk.work import (
+        CONTACT_TOKEN, CONTACT_ENCODING_AES_KEY, WECHATWORK_CALLBACK_REPLAY_WINDOW, ContactCallbackSDK,
+    )
+    return ContactCallbackSDK(CONTACT_TOKEN, CONTACT_ENCODING_AES_KEY,
+                              replay_window=WECHATWORK_CALLBACK_REPLAY_WINDOW)
 
 
 @api_view(['GET', 'POST'])
-def contact_callback(request):
-    pass
\ No newline at end of file
+@authentication_classes([])
+@permission_classes([AllowAny])
+def contact_callback(request: Request):
+    """
+    企业微信通讯录回调
+    详细说明：https://developer.work.weixin.qq.com/document/path/90967
+
+    - GET: 验证回调URL，返回解密后的echostr
+    - POST: 校验并解密事件，交给分发器后立即返回success，事件由wechatwork_contact_event信号的接收函数处理；
+      企业微信重复推送的事件直接返回success，不再分发
+    - 时间戳过期、签名错误或接收方ID不一致返回403，密文格式错误返回400，timestamp和nonce重复的请求在解密前返回success
+    """
+    from django_wechat.sdk.work import (
+        WeChatWorkSdkException, WeChatWorkCallbackReplayed, WeChatWorkCallbackMalformed,
+    )
+
+    sdk = get_contact_callback_sdk()
+    params = request.query_params
+    try:
+        sign, timestamp, nonce = params['msg_signature'], params['timestamp'], params['nonce']
+    except KeyError:
+        return HttpResponseBadRequest()
+
+    if request.method == 'GET':
+        try:
+            echo = sdk.verify_url(params.get('echostr', ''), sign, timestamp, nonce)
+        except WeChatWorkCallbackMalformed:
+            return HttpResponseBadRequest()
+        except WeChatWorkSdkException:
+            return HttpResponseForbidden()
+        return HttpResponse(echo, content_type='text/plain')
+
+    try:
+        event = sdk.decrypt(request.body, sign, timestamp, nonce)
+    except WeChatWorkCallbackReplayed:
+        # 签名有效的请求已经处理过
+        return HttpResponse('success', content_type='text/plain')
+    except WeChatWorkSdkException:
+        return HttpResponseForbidden()
+    except Exception:
+        # XML或密文格式错误
+        return HttpResponseBadRequest()
+    deduplicator = get_deduplicator()
+    if not deduplicator.is_duplicate(event):
+        try:
+            # 通讯录事件按推送顺序处理，避免先删除后更新的成员在本地镜像中恢复
+            get_dispatcher().dispatch(wechatwork_contact_event, ordering_key=CONTACT_EVENT_ORDERING_KEY, event=event)
+        except Exception:
+            # 分发失败时删除去重记录，企业微信重试时再次分发
+            deduplicator.forget(event)
+            logger.exception('企业微信通讯录回调事件分发失败')
+            return HttpResponse(status=500)
+    # 处理完成后才记录nonce，处理失败时企业微信可以用相同的timestamp和nonce重试
+    sdk.record_nonce(timestamp, nonce)
+    return HttpResponse('success', content_type='text/plain')
+
+
+# ----- 微信支付 -----
+
+WECHATPAY_NOTIFY_SUCCESS = '<xml><return_code><![CDATA[SUCCESS]]></return_code>' \
+                           '<return_msg><![CDATA[OK]]></return_msg></xml>'
+WECHATPAY_NOTIFY_FAIL = '<xml><return_code><![CDATA[FAIL]]></return_code>' \
+                        '<return_msg><![CDATA[{}]]></return_msg></xml>'
+
+
+@api_view(['POST'])
+@authentication_classes([])
+@permission_classes([AllowAny])
+def wechatpay_notify_callback(request: Request):
+    """
+    微信支付结果通知
+    详细说明：https://pay.weixin.qq.com/wiki/doc/api/jsapi.php?chapter=9_7
+
+    验证签名后先保存通知再应答，保存失败时应答FAIL，由微信支付重复通知；
+    后续处理交给分发器，已处理过的重复通知直接应答，不再分发
+    """
+    # 支付SDK需要WECHATPAY_SECRETS，只在使用支付通知时导入
+    from django_wechat.sdk.pay import parse_wechatpay_notify_data
+
+    try:
+        data = parse_wechatpay_notify_data(request.body)
+    except Exception:
+        # 签名错误或XML格式错误
+        return HttpResponseBadRequest(WECHATPAY_NOTIFY_FAIL.format('invalid notify'), content_type='text/xml')
+    transaction_id = data.get('transaction_id')
+    if not transaction_id:
+        logger.warning('微信支付结果通知缺少transaction_id：%s', data.get('out_trade_no'))
+    elif not is_processed(transaction_id):
+        try:
+            save_notification(data)
+        except Exception:
+            logger.exception('微信支付结果通知保存失败：%s', transaction_id)
+            return HttpResponse(WECHATPAY_NOTIFY_FAIL.format('save failed'), content_type='text/xml', status=500)
+        get_dispatcher().dispatch(wechatpay_notify, data=data)
+    return HttpResponse(WECHATPAY_NOTIFY_SUCCESS, content_type='text/xml')
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+性能测试公共fixture
+
+- stub_wechatwork: 本地模拟企业微信服务器，替代qyapi.weixin.qq.com，不依赖网络
+- record_allocations: 记录单次调用的内存分配峰值，写入benchmark的extra_info（--benchmark-json输出中可见）
+"""
+
+import json
+import threading
+import tracemalloc
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+
+class StubWeChatWorkHandler(BaseHTTPRequestHandler):
+    """
+    按路径返回固定数据的企业微信API，支持keep-alive以便测试连接复用
+    """
+    protocol_version = 'HTTP/1.1'
+    # 响应头和响应体分开写入，关闭Nagle算法避免和客户端的延迟确认叠加产生40ms延迟
+    disable_nagle_algorithm = True
+
+    def _reply(self, data: dict):
+        content = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _handle(self, body: dict):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        api = url.path.split('/cgi-bin/', 1)[-1]
+        data = {'errcode': 0, 'errmsg': 'ok'}
+        if api == 'gettoken':
+            data.update(access_token='stub_access_token', expires_in=7200)
+        elif api == 'user/get':
+            data.update(userid=params['userid'], name=params['userid'], department=[1])
+        elif api in ('user/update', 'user/create'):
+            data['userid'] = body.get('userid')
+        self._reply(data)
+
+    def do_GET(self):
+        self._handle({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self._handle(json.loads(self.rfile.read(length) or b'{}'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope='session')
+def stub_wechatwork_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubWeChatWorkHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{port}/cgi-bin/'.format(port=server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def stub_wechatwork(monkeypatch, stub_wechatwork_url):
+    """
+    把企业微信API根URL替换成本地模拟服务器，返回根URL
+    """
+    from django_wechat.sdk import work
+
+    monkeypatch.setattr(work, 'WECHATWORK_API_ROOT_URL', stub_wechatwork_url)
+    return stub_wechatwork_url
+
+
+@pytest.fixture
+def record_allocations(benchmark):
+    """
+    调用一次函数，把期间的内存分配峰值（字节）写入benchmark.extra_info['peak_bytes']
+    """
+    def record(func, *args, **kwargs):
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        benchmark.extra_info['peak_bytes'] = peak
+    return record
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+微信支付签名性能测试，对比PaySigner和wechatpy的签名函数
+
+运行：pytest tests/benchmarks（需要安装pytest-benchmark）
+"""
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from wechatpy.pay.utils import calculate_signature, calculate_signature_hmac
+
+from django_wechat.sdk.pay import PaySigner
+
+
+API_KEY = 'k' * 32
+
+# 调起支付的参数
+JSAPI_PARAMS = {
+    'appId': 'wxappid',
+    'timeStamp': '1600175140',
+    'nonceStr': '5d2b6c2a8db53831f7eda20af46e531c',
+    'package': 'prepay_id=wx201410272009395522657a690389285100',
+    'signType': 'MD5',
+}
+
+# 统一下单的参数
+UNIFIEDORDER_PARAMS = {
+    'appid': 'wxappid',
+    'mch_id': '1900000109',
+    'nonce_str': '5d2b6c2a8db53831f7eda20af46e531c',
+    'body': '课程-支付测试',
+    'out_trade_no': 'qtorder_20200915182157105164',
+    'total_fee': 1,
+    'spbill_create_ip': '127.0.0.1',
+    'notify_url': 'https://example.com/wechatpay/notify/',
+    'trade_type': 'JSAPI',
+    'openid': 'o5UdX0hDXymhfKmk1whTVUlIwZqE',
+}
+
+PARAMS = {
+    'jsapi': JSAPI_PARAMS,
+    'unifiedorder': UNIFIEDORDER_PARAMS,
+}
+
+WECHATPY_SIGNERS = {
+    'MD5': calculate_signature,
+    'HMAC-SHA256': calculate_signature_hmac,
+}
+
+
+@pytest.mark.parametrize('params', list(PARAMS))
+@pytest.mark.parametrize('sign_type', list(WECHATPY_SIGNERS))
+def test_wechatpy_sign(benchmark, sign_type, params):
+    benchmark.group = 'sign_{}_{}'.format(sign_type, params)
+    benchmark(WECHATPY_SIGNERS[sign_type], PARAMS[params], API_KEY)
+
+
+@pytest.mark.parametrize('params', list(PARAMS))
+@pytest.mark.parametrize('sign_type', list(WECHATPY_SIGNERS))
+def test_pay_signer_sign(benchmark, sign_type, params):
+    benchmark.group = 'sign_{}_{}'.format(sign_type, params)
+    signer = PaySigner(API_KEY, sign_type)
+    assert benchmark(signer.sign, PARAMS[params]) == WECHATPY_SIGNERS[sign_type](PARAMS[params], API_KEY)
+
+
+@pytest.mark.parametrize('sign_type', list(WECHATPY_SIGNERS))
+def test_pay_signer_sign_many(benchmark, sign_type):
+    """
+    批量签名100个调起支付参数，比如预先生成支付链接
+    """
+    benchmark.group = 'sign_many_{}'.format(sign_type)
+    signer = PaySigner(API_KEY, sign_type)
+    params_list = [dict(JSAPI_PARAMS, package='prepay_id=wx{:030d}'.format(i)) for i in range(100)]
+    assert len(benchmark(signer.sign_many, params_list)) == 100
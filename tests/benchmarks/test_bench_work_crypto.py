@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+企业微信回调加解密流程性能测试
+
+运行：pytest tests/benchmarks（需要安装pytest-benchmark）
+"""
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from django_wechat.sdk.work import (
+    WeChatWorkCallbackSDK, WeChatWorkCallbackStale, cal_encrypt_sign, dict_to_xml, encrypt_msg, decrypt_msg, get_xml_codec,
+)
+
+
+# 企业微信官方文档的demo参数
+CORPID = 'wx5823bf96d3bd56c7'
+TOKEN = 'QDG6eK'
+ENCODING_AES_KEY = 'jWmYm7qr5nMoAUwZRjGtBxmz3KA1tkAj3ykkR6q2B2C'
+TIMESTAMP = '1409659813'
+NONCE = '1372623149'
+
+# 消息内容长度：短文本、普通事件、长文本（约4KB）、超长文本（约32KB）
+PAYLOAD_SIZES = {
+    'small': 5,
+    'medium': 256,
+    'large': 4 * 1024,
+    'xlarge': 32 * 1024,
+}
+
+
+def make_message(size: int) -> dict:
+    unit = '企业微信hello'
+    return {
+        'ToUserName': CORPID,
+        'FromUserName': 'mycreate',
+        'CreateTime': TIMESTAMP,
+        'MsgType': 'text',
+        'Content': (unit * (size // len(unit) + 1))[:size],
+        'MsgId': '4561255354251345929',
+        'AgentID': '218',
+    }
+
+
+def make_encrypted(size: int) -> (str, str):
+    xml_text = encrypt_msg(make_message(size), TOKEN, ENCODING_AES_KEY, timestamp=TIMESTAMP, nonce=NONCE)
+    return xml_text, get_xml_codec().parse(xml_text)['MsgSignature']
+
+
+@pytest.mark.parametrize('size', list(PAYLOAD_SIZES))
+def test_encrypt_msg(benchmark, record_allocations, size):
+    benchmark.group = 'encrypt_msg'
+    data = make_message(PAYLOAD_SIZES[size])
+    record_allocations(encrypt_msg, data, TOKEN, ENCODING_AES_KEY, TIMESTAMP, NONCE)
+    benchmark(encrypt_msg, data, TOKEN, ENCODING_AES_KEY, TIMESTAMP, NONCE)
+
+
+@pytest.mark.parametrize('size', list(PAYLOAD_SIZES))
+def test_decrypt_msg(benchmark, record_allocations, size):
+    benchmark.group = 'decrypt_msg'
+    xml_text, sign = make_encrypted(PAYLOAD_SIZES[size])
+    args = (xml_text, sign, TIMESTAMP, NONCE, TOKEN, ENCODING_AES_KEY)
+    record_allocations(decrypt_msg, *args)
+    data = benchmark(decrypt_msg, *args)
+    assert len(data['Content']) == PAYLOAD_SIZES[size]
+
+
+@pytest.mark.parametrize('size', list(PAYLOAD_SIZES))
+def test_cal_encrypt_sign(benchmark, size):
+    benchmark.group = 'cal_encrypt_sign'
+    xml_text, sign = make_encrypted(PAYLOAD_SIZES[size])
+    msg_encrypt = get_xml_codec().parse(xml_text)['Encrypt']
+    assert benchmark(cal_encrypt_sign, TOKEN, TIMESTAMP, NONCE, msg_encrypt) == sign
+
+
+@pytest.mark.parametrize('size', list(PAYLOAD_SIZES))
+def test_dict_to_xml(benchmark, record_allocations, size):
+    benchmark.group = 'dict_to_xml'
+    data = make_message(PAYLOAD_SIZES[size])
+    record_allocations(dict_to_xml, data)
+    benchmark(dict_to_xml, data)
+
+
+@pytest.mark.parametrize('size', list(PAYLOAD_SIZES))
+def test_callback_sdk_round_trip(benchmark, record_allocations, size):
+    """
+    回调SDK解密收到的消息并加密回复
+    """
+    benchmark.group = 'callback_round_trip'
+    # 重复使用固定的timestamp和nonce，不校验时间窗口
+    sdk = WeChatWorkCallbackSDK(TOKEN, ENCODING_AES_KEY)
+    xml_text, sign = make_encrypted(PAYLOAD_SIZES[size])
+
+    def round_trip():
+        data = sdk.decrypt(xml_text, sign, TIMESTAMP, NONCE)
+        return sdk.encrypt(data)
+
+    record_allocations(round_trip)
+    assert benchmark(round_trip).startswith('<xml>')
+
+
+@pytest.mark.parametrize('size', list(PAYLOAD_SIZES))
+def test_callback_sdk_reject_stale(benchmark, size):
+    """
+    回调SDK拒绝过期请求，不进行解密
+    """
+    benchmark.group = 'callback_reject_stale'
+    sdk = WeChatWorkCallbackSDK(TOKEN, ENCODING_AES_KEY, replay_window=300)
+    xml_text, sign = make_encrypted(PAYLOAD_SIZES[size])
+
+    def reject():
+        try:
+            sdk.decrypt(xml_text, sign, TIMESTAMP, NONCE)
+        except WeChatWorkCallbackStale:
+            return True
+        return False
+
+    assert benchmark(reject)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+企业微信SDK HTTP调用性能测试，请求本地模拟服务器（见conftest.stub_wechatwork），测量SDK自身和连接复用的开销
+
+运行：pytest tests/benchmarks（需要安装pytest-benchmark）
+"""
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from django_wechat.sdk.sessions import create_session, request_json
+from django_wechat.sdk.work import UserSDK
+
+
+@pytest.fixture
+def user_sdk(stub_wechatwork):
+    sdk = UserSDK()
+    sdk.token_manager.invalidate()
+    return sdk
+
+
+def test_user_get(benchmark, user_sdk):
+    benchmark.group = 'http'
+    data = benchmark(user_sdk.get, 'zhangsan')
+    assert data['userid'] == 'zhangsan'
+
+
+def test_user_get_new_connection(benchmark, user_sdk):
+    """
+    每次新建会话，作为连接复用的对照
+    """
+    benchmark.group = 'http'
+
+    def get():
+        with create_session() as session:
+            user_sdk._session = session
+            return user_sdk.get('zhangsan')
+
+    data = benchmark(get)
+    assert data['userid'] == 'zhangsan'
+
+
+def test_gettoken(benchmark, stub_wechatwork):
+    benchmark.group = 'http'
+    data = benchmark(request_json, 'GET', stub_wechatwork + 'gettoken', params={'corpid': 'corpid', 'corpsecret': 's'})
+    assert data['access_token']
+
+
+def test_bulk_upsert(benchmark, user_sdk):
+    benchmark.group = 'http-bulk'
+    users = [{'userid': 'user_{}'.format(i), 'name': 'user', 'department': [1]} for i in range(200)]
+    results = benchmark.pedantic(user_sdk.bulk_upsert, args=(users,), kwargs={'rate': 100000}, rounds=3)
+    assert len(results['succeeded']) == 200
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+XML编解码性能测试，对比FastXMLCodec和XmltodictCodec
+
+运行：pytest tests/benchmarks（需要安装pytest-benchmark）
+"""
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from django_wechat.sdk.xmlcodec import FastXMLCodec, XmltodictCodec
+
+from tests.test_sdk_xmlcodec import TEXT_MSG, CONTACT_EVENT
+
+
+CODECS = {
+    'fast': FastXMLCodec(),
+    'xmltodict': XmltodictCodec(),
+}
+
+# 接近真实消息大小的样例：短文本消息、通讯录变更事件、长文本消息（约4KB）
+MESSAGES = {
+    'text': TEXT_MSG.encode(),
+    'contact_event': CONTACT_EVENT.encode(),
+    'long_text': TEXT_MSG.replace('hello', '企业微信' * 340).encode(),
+}
+
+# 回复消息
+REPLY = {
+    'ToUserName': 'wx5823bf96d3bd56c7',
+    'FromUserName': 'mycreate',
+    'CreateTime': '1409659813',
+    'MsgType': 'text',
+    'Content': 'hello',
+    'MsgId': '4561255354251345929',
+    'AgentID': '218',
+}
+
+
+@pytest.mark.parametrize('size', list(MESSAGES))
+@pytest.mark.parametrize('codec', list(CODECS))
+def test_parse(benchmark, codec, size):
+    benchmark.group = 'parse-' + size
+    data = benchmark(CODECS[codec].parse, MESSAGES[size])
+    assert data['ToUserName']
+
+
+@pytest.mark.parametrize('codec', list(CODECS))
+def test_dumps(benchmark, codec):
+    benchmark.group = 'dumps'
+    xml = benchmark(CODECS[codec].dumps, REPLY)
+    assert xml.startswith('<xml>')
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+from unittest import mock
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from django.test import TestCase, override_settings
+
+from django_wechat.cloudrun.api import *
+from django_wechat.sdk.wechat import WeChatSDK, WeChatSdkException, is_cloudrun_app
+from django_wechat.sdk.token_registry import TokenRegistry, register_wechat_apps
+
+
+class StubOpenAPIHandler(BaseHTTPRequestHandler):
+    """
+    模拟云托管开放接口服务，记录收到的请求
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    requests = []
+
+    def _handle(self, body: dict):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.requests.append((self.command, url.path, params, body))
+        if url.path == '/cgi-bin/user/info':
+            data = {'openid': params['openid'], 'subscribe': 1}
+        elif url.path == '/_/pay/unifiedOrder':
+            data = {'errcode': 0, 'errmsg': 'ok', 'respdata': {'return_code': 'SUCCESS', 'env_id': body['env_id']}}
+        else:
+            data = {'errcode': 40001, 'errmsg': 'invalid credential'}
+        content = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self._handle({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self._handle(json.loads(self.rfile.read(length) or b'{}'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WXCloudRunOpenAPITestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubOpenAPIHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.root_url = 'http://127.0.0.1:{port}/'.format(port=cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        StubOpenAPIHandler.requests.clear()
+        self.client = WXCloudRunOpenAPIClient(api_root_url=self.root_url)
+
+    def test_request_api(self):
+        data = self.client.get_api('cgi-bin/user/info', {'openid': 'o1'})
+        self.assertEqual(data, {'openid': 'o1', 'subscribe': 1})
+        # 不携带access_token
+        self.assertEqual(StubOpenAPIHandler.requests, [('GET', '/cgi-bin/user/info', {'openid': 'o1'}, {})])
+
+        with self.assertRaises(WXCloudRunAPIException) as cm:
+            self.client.post_api('cgi-bin/message/custom/send', data={'touser': 'o1'})
+        self.assertIsInstance(cm.exception, WeChatSdkException)
+        self.assertEqual(cm.exception.errcode, 40001)
+
+    def test_wechat_sdk_uses_cloudrun(self):
+        with override_settings(WXCLOUDRUN_OPENAPI_ROOT_URL=self.root_url):
+            sdk = WeChatSDK('qtclass_wxweb', use_cloudrun=True)
+            self.assertEqual(sdk.get_api('user/info', {'openid': 'o1'})['openid'], 'o1')
+        # 没有获取access_token
+        self.assertEqual([request[1] for request in StubOpenAPIHandler.requests], ['/cgi-bin/user/info'])
+
+    def test_create_order(self):
+        with mock.patch('django_wechat.cloudrun.api.CBR_ENV_ID', 'prod-1'):
+            data = self.client.create_order({'openid': 'o1', 'out_trade_no': 'order1', 'total_fee': 1})
+        self.assertEqual(data, {'return_code': 'SUCCESS', 'env_id': 'prod-1'})
+
+    def test_register_wechat_apps_skipped(self):
+        """
+        只有环境绑定的应用不注册access_token
+        """
+        registry = TokenRegistry()
+        app_secrets = {
+            'bound': {'appid': 'wxbound', 'app_secret': 'sec'},
+            'flagged': {'appid': 'wxflagged', 'app_secret': 'sec', 'cloudrun': True},
+            'other': {'appid': 'wxother', 'app_secret': 'sec'},
+        }
+        with override_settings(WECHAT_APP_SECRETS=app_secrets, WXCLOUDRUN_APPID='wxbound'), \
+                mock.patch('django_wechat.sdk.wechat.IS_WXCLOUDRUN_ENV', True):
+            register_wechat_apps(registry)
+        self.assertEqual(list(registry.managers), ['wechat:other'])
+
+    def test_is_cloudrun_app(self):
+        with override_settings(WXCLOUDRUN_APPID='wxbound'):
+            self.assertFalse(is_cloudrun_app({'appid': 'wxbound'}))
+            with mock.patch('django_wechat.sdk.wechat.IS_WXCLOUDRUN_ENV', True):
+                self.assertTrue(is_cloudrun_app({'appid': 'wxbound'}))
+                self.assertFalse(is_cloudrun_app({'appid': 'wxbound', 'cloudrun': False}))
+                self.assertTrue(is_cloudrun_app({'appid': 'wxother', 'cloudrun': True}))
+                self.assertFalse(is_cloudrun_app({'appid': 'wxother'}))
+                # 其他应用仍然使用access_token
+                sdk = WeChatSDK('qtclass_wxweb')
+                self.assertIsNone(sdk._cloudrun_client)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+from asgiref.sync import async_to_sync
+from django.db import connection
+from django.http import HttpResponse
+from django.test import TestCase, RequestFactory, override_settings
+
+from django_wechat.cloudrun.middlewares import *
+from tests.test_models import MultiClientWeChatUser
+
+
+WECHAT_HEADERS = {
+    'HTTP_X_WX_OPENID': 'mp1',
+    'HTTP_X_WX_APPID': 'wxmpappid',
+    'HTTP_X_WX_SOURCE': 'wx_client',
+}
+
+
+@override_settings(WXCLOUDRUN_TRUST_HEADERS=True, WXCLOUDRUN_USER_MODEL='django_wechat.MultiClientWeChatUser',
+                   WECHAT_APP_SECRETS={'wxmp': {'appid': 'wxmpappid', 'app_secret': 'sec'}})
+class WXCloudRunMiddlewareTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(MultiClientWeChatUser)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(MultiClientWeChatUser)
+
+    def setUp(self):
+        get_client_label.cache_clear()
+        self.factory = RequestFactory()
+        self.requests = []
+
+    def get_response(self, request):
+        self.requests.append(request)
+        return HttpResponse()
+
+    async def aget_response(self, request):
+        self.requests.append(request)
+        return HttpResponse()
+
+    def test_identity(self):
+        middleware = WXCloudRunMiddleware(self.get_response)
+        request = self.factory.get('/', **WECHAT_HEADERS)
+        middleware(request)
+
+        identity = request.wechat
+        self.assertTrue(identity)
+        self.assertEqual((identity.openid, identity.appid, identity.source), ('mp1', 'wxmpappid', 'wx_client'))
+        self.assertIsNone(identity.unionid)
+        self.assertEqual(identity.client_label, 'wxmp')
+
+        request = self.factory.get('/')
+        middleware(request)
+        self.assertFalse(request.wechat)
+
+    def test_untrusted_headers(self):
+        with override_settings(WXCLOUDRUN_TRUST_HEADERS=False):
+            middleware = WXCloudRunMiddleware(self.get_response)
+        request = self.factory.get('/', **WECHAT_HEADERS)
+        middleware(request)
+        self.assertFalse(request.wechat)
+        self.assertIsNone(request.wechat.openid)
+
+    def test_user(self):
+        user = MultiClientWeChatUser.objects.create(openid_wxmp='mp1')
+        middleware = WXCloudRunMiddleware(self.get_response)
+
+        # 不访问身份时不查询
+        with self.assertNumQueries(0):
+            middleware(self.factory.get('/', **WECHAT_HEADERS))
+
+        request = self.factory.get('/', **WECHAT_HEADERS)
+        middleware(request)
+        with self.assertNumQueries(1):
+            self.assertEqual(request.wechat.user, user)
+            self.assertEqual(request.wechat.user, user)
+
+        # 有UnionID时先按UnionID查询
+        other = MultiClientWeChatUser.objects.create(unionid='u2', openid_wxweb='web2')
+        request = self.factory.get('/', HTTP_X_WX_UNIONID='u2', **WECHAT_HEADERS)
+        middleware(request)
+        self.assertEqual(request.wechat.user, other)
+
+    def test_user_unionid_fallback(self):
+        """
+        按UnionID未找到时按openid查询
+        """
+        user = MultiClientWeChatUser.objects.create(openid_wxmp='mp1')
+        middleware = WXCloudRunMiddleware(self.get_response)
+        request = self.factory.get('/', HTTP_X_WX_UNIONID='u1', **WECHAT_HEADERS)
+        middleware(request)
+        with self.assertNumQueries(2):
+            self.assertEqual(request.wechat.user, user)
+
+        request = self.factory.get('/', HTTP_X_WX_UNIONID='u1', HTTP_X_WX_OPENID='mp_unknown',
+                                   HTTP_X_WX_APPID='wxmpappid')
+        middleware(request)
+        self.assertIsNone(request.wechat.user)
+
+    def test_async(self):
+        user = MultiClientWeChatUser.objects.create(openid_wxmp='mp1')
+        middleware = WXCloudRunMiddleware(self.aget_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+
+        request = self.factory.get('/', **WECHAT_HEADERS)
+        async_to_sync(middleware)(request)
+        self.assertEqual(self.requests, [request])
+        self.assertEqual(async_to_sync(request.wechat.auser)(), user)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+企业微信通讯录本地镜像测试样例
+"""
+
+from django.test import TestCase
+
+from django_wechat.models import WeChatWorkDepartment, WeChatWorkUser, WeChatWorkTag
+from django_wechat.contacts import *
+
+
+class FakeUserSDK(object):
+    def __init__(self, users):
+        self.users = users
+
+    def iter_list(self):
+        return iter(self.users)
+
+
+class FakeDepartmentSDK(object):
+    def __init__(self, departments):
+        self.departments = departments
+
+    def list(self):
+        return {'department': self.departments}
+
+
+class SyncContactsTestCase(TestCase):
+    def test_sync_departments(self):
+        WeChatWorkDepartment.objects.create(id=99, name='removed')
+        sync_departments(FakeDepartmentSDK([{'id': 1, 'name': 'root', 'parentid': 0, 'order': 1},
+                                            {'id': 2, 'name': 'child', 'parentid': 1, 'order': 2}]))
+        self.assertEqual(list(WeChatWorkDepartment.objects.order_by('id').values_list('id', 'name')),
+                         [(1, 'root'), (2, 'child')])
+
+    def test_sync_users(self):
+        WeChatWorkUser.objects.create(userid='removed')
+        users = [{'userid': 'user_{}'.format(i), 'name': 'user', 'department': [1, 2], 'status': 1,
+                  'telephone': '123'} for i in range(5)]
+        count = sync_users(FakeUserSDK(users), batch_size=2)
+        self.assertEqual(count, 5)
+        self.assertFalse(WeChatWorkUser.objects.filter(userid='removed').exists())
+        user = WeChatWorkUser.objects.get(userid='user_3')
+        self.assertEqual(user.extra, {'telephone': '123'})
+        self.assertEqual(WeChatWorkUser.departments.through.objects.filter(wechatworkuser=user).count(), 2)
+
+
+class ContactEventTestCase(TestCase):
+    def test_create_update_delete_user(self):
+        apply_contact_event({'Event': 'change_contact', 'ChangeType': 'create_user', 'UserID': 'zhangsan',
+                             'Name': '张三', 'Department': '1,2', 'Mobile': '13800000000', 'Status': '1'})
+        user = WeChatWorkUser.objects.get(userid='zhangsan')
+        self.assertEqual(user.name, '张三')
+
+        apply_contact_event({'Event': 'change_contact', 'ChangeType': 'update_user', 'UserID': 'zhangsan',
+                             'NewUserID': 'zhangsan2', 'Position': '工程师'})
+        user = WeChatWorkUser.objects.get(userid='zhangsan2')
+        self.assertEqual((user.name, user.position), ('张三', '工程师'))
+
+        apply_contact_event({'Event': 'change_contact', 'ChangeType': 'delete_user', 'UserID': 'zhangsan2'})
+        self.assertFalse(WeChatWorkUser.objects.exists())
+
+    def test_party_and_tag(self):
+        apply_contact_event({'Event': 'change_contact', 'ChangeType': 'create_party', 'Id': '2', 'Name': '研发部',
+                             'ParentId': '1', 'Order': '1'})
+        self.assertEqual(WeChatWorkDepartment.objects.get(id=2).name, '研发部')
+        WeChatWorkUser.objects.create(userid='zhangsan')
+        apply_contact_event({'Event': 'change_contact', 'ChangeType': 'update_tag', 'TagId': '1',
+                             'AddUserItems': 'zhangsan', 'AddPartyItems': '2'})
+        tag = WeChatWorkTag.objects.get(tagid=1)
+        self.assertEqual(list(tag.users.values_list('userid', flat=True)), ['zhangsan'])
+        self.assertEqual(list(tag.departments.values_list('id', flat=True)), [2])
+
+    def test_ignore_other_event(self):
+        self.assertFalse(apply_contact_event({'MsgType': 'text', 'Content': 'hello'}))
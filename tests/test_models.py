@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+from django.apps import apps
+from django.db import connection, migrations, models
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from django_wechat.models import (
+    AbstractWeChatUser, AbstractUniqueUnionIDWeChatUser, WeChatUser, convert_blank_to_null, unique_unionid_operations,
+)
+
+
+class MultiClientWeChatUser(AbstractUniqueUnionIDWeChatUser):
+    OPENID_CLIENT_LABELS = ['wxweb', 'wxmp']
+
+    class Meta:
+        app_label = 'django_wechat'
+
+
+class ProfileWeChatUser(AbstractWeChatUser):
+    """
+    unionid不唯一、有其他不可为空字段的用户模型
+    """
+    OPENID_CLIENT_LABELS = ['wxmp']
+    nickname = models.CharField(max_length=32)
+
+    class Meta:
+        app_label = 'django_wechat'
+
+
+class WeChatUserModelTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # 测试模型不在迁移中，在测试事务开始前建表
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(MultiClientWeChatUser)
+            schema_editor.create_model(ProfileWeChatUser)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(MultiClientWeChatUser)
+            schema_editor.delete_model(ProfileWeChatUser)
+
+    def test_openid_fields(self):
+        for label in MultiClientWeChatUser.OPENID_CLIENT_LABELS:
+            field = MultiClientWeChatUser._meta.get_field('openid_' + label)
+            self.assertIsInstance(field, models.CharField)
+            self.assertTrue(field.unique)
+            self.assertTrue(field.null)
+        self.assertTrue(MultiClientWeChatUser._meta.get_field('unionid').unique)
+        self.assertEqual(MultiClientWeChatUser.get_openid_field_name('wxmp'), 'openid_wxmp')
+        with self.assertRaises(ValueError):
+            MultiClientWeChatUser.get_openid_field_name('wxapp')
+        # 没有设置应用标签时不生成字段
+        self.assertEqual([field.name for field in WeChatUser._meta.fields], ['id', 'unionid'])
+        # 默认的unionid字段不变
+        field = WeChatUser._meta.get_field('unionid')
+        self.assertFalse(field.unique or field.null)
+
+    def test_get_by_openid(self):
+        user = MultiClientWeChatUser.objects.create(unionid='u1', openid_wxweb='web1', openid_wxmp='mp1')
+        MultiClientWeChatUser.objects.create(unionid='u2', openid_wxweb='web2')
+
+        self.assertEqual(MultiClientWeChatUser.objects.get_by_openid('wxmp', 'mp1'), user)
+        with self.assertRaises(MultiClientWeChatUser.DoesNotExist):
+            MultiClientWeChatUser.objects.get_by_openid('wxmp', 'web1')
+
+    def test_bulk_get_by_openids(self):
+        user1 = MultiClientWeChatUser.objects.create(unionid='u1', openid_wxweb='web1')
+        user2 = MultiClientWeChatUser.objects.create(unionid='u2', openid_wxweb='web2')
+
+        with self.assertNumQueries(1):
+            users = MultiClientWeChatUser.objects.bulk_get_by_openids('wxweb', ['web1', 'web2', 'web3'])
+        self.assertEqual(users, {'web1': user1, 'web2': user2})
+
+    def test_bulk_upsert(self):
+        MultiClientWeChatUser.objects.create(unionid='u1', openid_wxweb='web1')
+        users = (
+            {'unionid': 'u1', 'openid_wxmp': 'mp1'},
+            {'unionid': 'u2', 'openid_wxweb': 'web2', 'nickname': '忽略'},
+            # 与上一条openid相同，合并为同一用户
+            {'openid_wxweb': 'web2', 'openid_wxmp': 'mp2'},
+            {'openid_wxmp': 'mp3'},
+            # 没有unionid和openid，忽略
+            {'unionid': ''},
+        )
+
+        self.assertEqual(MultiClientWeChatUser.objects.bulk_upsert(iter(users), batch_size=10), 3)
+        self.assertEqual(MultiClientWeChatUser.objects.count(), 3)
+        user1 = MultiClientWeChatUser.objects.get(unionid='u1')
+        self.assertEqual((user1.openid_wxweb, user1.openid_wxmp), ('web1', 'mp1'))
+        user2 = MultiClientWeChatUser.objects.get(unionid='u2')
+        self.assertEqual((user2.openid_wxweb, user2.openid_wxmp), ('web2', 'mp2'))
+        self.assertIsNone(MultiClientWeChatUser.objects.get_by_openid('wxmp', 'mp3').unionid)
+
+    def test_bulk_upsert_login_results(self):
+        MultiClientWeChatUser.objects.create(openid_wxmp='mp1')
+        results = ({'openid': 'mp{}'.format(i), 'session_key': 'key'} for i in range(5))
+
+        # 每批一条查询和一条写入
+        with self.assertNumQueries(6):
+            count = MultiClientWeChatUser.objects.bulk_upsert(results, client_label='wxmp', batch_size=2)
+        # mp1已存在且没有新字段，不计入
+        self.assertEqual(count, 4)
+        self.assertEqual(MultiClientWeChatUser.objects.count(), 5)
+
+    def test_bulk_upsert_backfill_unionid(self):
+        """
+        只有openid的用户补充unionid
+        """
+        user = MultiClientWeChatUser.objects.create(openid_wxmp='mp1')
+        MultiClientWeChatUser.objects.create(unionid='u2', openid_wxweb='web2')
+        users = [
+            {'unionid': 'u1', 'openid': 'mp1'},
+            # unionid和openid分属两个用户，跳过
+            {'unionid': 'u2', 'openid': 'mp1'},
+        ]
+
+        count = MultiClientWeChatUser.objects.bulk_upsert(users[:1], client_label='wxmp')
+        self.assertEqual(count, 1)
+        user.refresh_from_db()
+        self.assertEqual((user.unionid, user.openid_wxmp), ('u1', 'mp1'))
+        self.assertEqual(MultiClientWeChatUser.objects.count(), 2)
+
+        with self.assertLogs('django_wechat.models', 'WARNING'):
+            count = MultiClientWeChatUser.objects.bulk_upsert(users[1:], client_label='wxmp')
+        self.assertEqual(count, 0)
+
+    def test_blank_unionid(self):
+        MultiClientWeChatUser.objects.create(unionid='', openid_wxmp='mp1')
+        MultiClientWeChatUser.objects.create(unionid='', openid_wxmp='mp2')
+        self.assertEqual(MultiClientWeChatUser.objects.filter(unionid__isnull=True).count(), 2)
+
+    def test_convert_blank_to_null(self):
+        MultiClientWeChatUser.objects.bulk_create([MultiClientWeChatUser(unionid='', openid_wxmp='mp1')])
+        forwards = convert_blank_to_null('django_wechat.MultiClientWeChatUser', ('unionid', 'openid_wxweb'))
+        forwards(apps, connection.schema_editor())
+        self.assertIsNone(MultiClientWeChatUser.objects.get().unionid)
+
+    def test_bulk_upsert_partial_update(self):
+        """
+        已存在的用户只更新传入的字段，不写入其他字段
+        """
+        user = ProfileWeChatUser.objects.create(openid_wxmp='mp1', nickname='张三')
+        ProfileWeChatUser.objects.create(unionid='u2', openid_wxmp='mp2', nickname='李四')
+        users = [
+            {'unionid': 'u1', 'openid': 'mp1'},
+            {'unionid': 'u2', 'nickname': '王五'},
+            {'openid': 'mp3', 'nickname': '赵六'},
+        ]
+
+        with CaptureQueriesContext(connection) as queries:
+            count = ProfileWeChatUser.objects.bulk_upsert(users, client_label='wxmp')
+        self.assertEqual(count, 3)
+        sqls = [query['sql'] for query in queries.captured_queries]
+        self.assertFalse(any('ON CONFLICT' in sql for sql in sqls))
+        user.refresh_from_db()
+        self.assertEqual((user.unionid, user.nickname), ('u1', '张三'))
+        self.assertEqual(ProfileWeChatUser.objects.get(unionid='u2').nickname, '王五')
+        self.assertEqual(ProfileWeChatUser.objects.get(openid_wxmp='mp3').unionid, '')
+
+    def test_unique_unionid_operations(self):
+        operations = unique_unionid_operations('accounts.User')
+        self.assertEqual([type(operation) for operation in operations],
+                         [migrations.AlterField, migrations.RunPython, migrations.AlterField])
+        self.assertEqual(operations[0].model_name, 'user')
+        self.assertTrue(operations[0].field.null)
+        self.assertFalse(operations[0].field.unique)
+        self.assertTrue(operations[2].field.unique)
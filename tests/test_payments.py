@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from django_wechat.models import WeChatPayOrderNotification
+from django_wechat.payments import *
+from django_wechat.signals import wechatpay_order_notified
+
+
+PAYMENT_DATA = {
+    'appid': 'wxappid',
+    'mch_id': '1900000109',
+    'openid': 'o5UdX0hDXymhfKmk1whTVUlIwZqE',
+    'out_trade_no': 'qtorder_20200915182157105164',
+    'result_code': 'SUCCESS',
+    'return_code': 'SUCCESS',
+    'time_end': '20200915210540',
+    'total_fee': '1',
+    'trade_type': 'JSAPI',
+    'transaction_id': '4200000688202009159176613942',
+}
+
+
+class PaymentNotifyTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.notifications = []
+        wechatpay_order_notified.connect(self.receiver)
+
+    def tearDown(self):
+        wechatpay_order_notified.disconnect(self.receiver)
+
+    def receiver(self, sender, notification, **kwargs):
+        self.notifications.append(notification)
+
+    def test_record_notification(self):
+        self.assertTrue(record_notification(PAYMENT_DATA))
+        notification = WeChatPayOrderNotification.objects.get()
+        self.assertEqual(notification.status, WeChatPayOrderNotification.STATUS_PROCESSED)
+        self.assertEqual(notification.total_fee, 1)
+        self.assertTrue(is_processed(PAYMENT_DATA['transaction_id']))
+        state = cache.get(ORDER_STATE_CACHE_PREFIX + PAYMENT_DATA['out_trade_no'])
+        self.assertEqual(state['trade_state'], 'SUCCESS')
+
+    def test_repeated_notify(self):
+        """
+        重复通知只处理一次，缓存失效后也不会重复处理
+        """
+        save_notification(PAYMENT_DATA)
+        handle_payment_notify(None, data=PAYMENT_DATA)
+        cache.clear()
+        save_notification(dict(PAYMENT_DATA))
+        handle_payment_notify(None, data=dict(PAYMENT_DATA))
+        self.assertEqual(WeChatPayOrderNotification.objects.count(), 1)
+        self.assertEqual(len(self.notifications), 1)
+        self.assertEqual(self.notifications[0].out_trade_no, PAYMENT_DATA['out_trade_no'])
+
+    def test_failed_handler(self):
+        """
+        接收函数失败时保持已接收状态，重试时再次处理
+        """
+        def failing_receiver(sender, notification, **kwargs):
+            raise ValueError('fulfilment failed')
+
+        wechatpay_order_notified.connect(failing_receiver)
+        try:
+            self.assertFalse(record_notification(PAYMENT_DATA))
+        finally:
+            wechatpay_order_notified.disconnect(failing_receiver)
+        notification = WeChatPayOrderNotification.objects.get()
+        self.assertEqual(notification.status, WeChatPayOrderNotification.STATUS_RECEIVED)
+        self.assertFalse(is_processed(PAYMENT_DATA['transaction_id']))
+
+        self.assertEqual(process_received_notifications(older_than=0), 1)
+        notification.refresh_from_db()
+        self.assertEqual(notification.status, WeChatPayOrderNotification.STATUS_PROCESSED)
+        self.assertEqual(len(self.notifications), 2)
+        self.assertEqual(process_received_notifications(older_than=0), 0)
+
+    def test_processing_lock(self):
+        """
+        其他调用方正在处理时不重复处理
+        """
+        save_notification(PAYMENT_DATA)
+        cache.add(PROCESSING_LOCK_PREFIX + PAYMENT_DATA['transaction_id'], 1)
+        self.assertFalse(process_notification(PAYMENT_DATA['transaction_id']))
+        self.assertEqual(self.notifications, [])
+
+    def test_lookup_notified_orders(self):
+        record_notification(PAYMENT_DATA)
+        orders = lookup_notified_orders([PAYMENT_DATA['out_trade_no'], 'qtorder_not_exist'])
+        self.assertEqual(orders, {PAYMENT_DATA['out_trade_no']: {'total_fee': 1, 'trade_state': 'SUCCESS'}})
+
+    def test_iter_notified_orders(self):
+        record_notification(PAYMENT_DATA)
+        self.assertEqual(list(iter_notified_orders('20200915')),
+                         [{'out_trade_no': PAYMENT_DATA['out_trade_no'], 'total_fee': 1, 'trade_state': 'SUCCESS'}])
+        self.assertEqual(list(iter_notified_orders('20200916')), [])
+
+
+class FakeOrderQuery(object):
+    """
+    按调用顺序返回交易状态的假查询订单接口
+    """
+    def __init__(self, trade_states: dict, delay=0):
+        self.trade_states = trade_states
+        self.delay = delay
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, client_label, transaction_id=None, out_trade_no=None):
+        with self._lock:
+            self.calls.append(out_trade_no)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(self.delay)
+            trade_state = self.trade_states[out_trade_no].pop(0)
+            if isinstance(trade_state, Exception):
+                raise trade_state
+            return {'trade_state': trade_state, 'out_trade_no': out_trade_no, 'total_fee': '1'}
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+class OrderPollerTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def make_poller(self, query, **kwargs):
+        poller_settings = dict(POLLER_DEFAULTS, **dict({'MIN_INTERVAL': 0}, **kwargs))
+        return WeChatPayOrderPoller('qtclass_wxweb', query=query, poller_settings=poller_settings)
+
+    def test_poll_until_paid(self):
+        query = FakeOrderQuery({'order_1': ['NOTPAY', 'USERPAYING', 'SUCCESS']})
+        poller = self.make_poller(query, MIN_INTERVAL=2, BACKOFF=2)
+        poller.add('order_1')
+        now = time.time()
+        self.assertEqual(poller.poll_once(now), {})
+        self.assertEqual(poller.poll_once(now + 2)['order_1']['trade_state'], 'NOTPAY')
+        self.assertEqual(get_cached_order_state('order_1')['trade_state'], 'NOTPAY')
+        # 查询间隔增长为4秒
+        self.assertEqual(poller.poll_once(now + 5), {})
+        self.assertEqual(poller.poll_once(now + 6)['order_1']['trade_state'], 'USERPAYING')
+        self.assertEqual(get_cached_order_state('order_1')['trade_state'], 'USERPAYING')
+        self.assertEqual(poller.poll_once(now + 14)['order_1']['trade_state'], 'SUCCESS')
+        self.assertEqual(get_cached_order_state('order_1')['trade_state'], 'SUCCESS')
+        self.assertEqual(poller.pending, [])
+        self.assertEqual(len(query.calls), 3)
+
+    def test_stop_after_notify(self):
+        query = FakeOrderQuery({'order_1': ['NOTPAY', 'NOTPAY']})
+        poller = self.make_poller(query)
+        poller.add('order_1')
+        poller.poll_once(time.time())
+        cache_order_state('order_1', {'trade_state': 'SUCCESS'})
+        self.assertEqual(poller.poll_once(time.time() + 60)['order_1']['trade_state'], 'SUCCESS')
+        self.assertEqual(len(query.calls), 1)
+        self.assertEqual(poller.pending, [])
+
+    def test_keep_notified_state(self):
+        """
+        查询期间收到支付结果通知时，未支付的查询结果不覆盖最终状态
+        """
+        def query(client_label, out_trade_no):
+            cache_order_state(out_trade_no, {'trade_state': 'SUCCESS'})
+            return {'trade_state': 'NOTPAY'}
+
+        poller = self.make_poller(query)
+        poller.add('order_1')
+        self.assertEqual(poller.poll_once(time.time())['order_1']['trade_state'], 'SUCCESS')
+        self.assertEqual(get_cached_order_state('order_1')['trade_state'], 'SUCCESS')
+        self.assertEqual(poller.pending, [])
+
+    def test_query_error(self):
+        query = FakeOrderQuery({'order_1': [ValueError('SYSTEMERROR'), 'CLOSED']})
+        poller = self.make_poller(query, MIN_INTERVAL=1)
+        poller.add('order_1')
+        now = time.time()
+        self.assertEqual(poller.poll_once(now + 1), {})
+        self.assertEqual(poller.pending, ['order_1'])
+        self.assertEqual(poller.poll_once(now + 3)['order_1']['trade_state'], 'CLOSED')
+
+    def test_timeout(self):
+        query = FakeOrderQuery({'order_1': ['NOTPAY']})
+        poller = self.make_poller(query, TIMEOUT=10)
+        poller.add('order_1')
+        poller.poll_once(time.time() + 11)
+        self.assertEqual(poller.pending, [])
+
+    def test_bounded_concurrency(self):
+        query = FakeOrderQuery({'order_{}'.format(i): ['SUCCESS'] for i in range(6)}, delay=0.05)
+        poller = self.make_poller(query, MAX_WORKERS=2)
+        for i in range(6):
+            poller.add('order_{}'.format(i))
+        self.assertEqual(len(poller.poll_once(time.time())), 6)
+        self.assertEqual(query.max_running, 2)
+
+    def test_background_polling(self):
+        query = FakeOrderQuery({'order_1': ['SUCCESS']})
+        poller = self.make_poller(query)
+        poller.start()
+        try:
+            poller.add('order_1')
+            deadline = time.time() + 2
+            while get_cached_order_state('order_1') is None and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            poller.stop(timeout=1)
+        self.assertEqual(get_cached_order_state('order_1')['trade_state'], 'SUCCESS')
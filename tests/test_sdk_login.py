@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from django_wechat.sdk.login import *
+
+
+class FakeLoginAPI(object):
+    """
+    假微信登录接口，code只能使用一次
+    """
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.calls = []
+        self.used_codes = set()
+        self.access_token_count = 0
+        # 依次返回的临时性错误
+        self.transient_errors = []
+        self._lock = threading.Lock()
+
+    def new_token(self, openid):
+        self.access_token_count += 1
+        return {'access_token': 'access_token_{}'.format(self.access_token_count), 'expires_in': 7200,
+                'refresh_token': 'refresh_token', 'openid': openid, 'scope': 'snsapi_login'}
+
+    def __call__(self, method, url, session=None, params=None, **kwargs):
+        with self._lock:
+            self.calls.append((url, params))
+        time.sleep(self.delay)
+        api = url[len(WECHAT_LOGIN_API_ROOT_URL):]
+        if api in ('oauth2/access_token', 'jscode2session'):
+            code = params.get('code') or params.get('js_code')
+            with self._lock:
+                if self.transient_errors:
+                    return self.transient_errors.pop(0)
+                if code in self.used_codes:
+                    return {'errcode': 40163, 'errmsg': 'code been used'}
+                self.used_codes.add(code)
+            if api == 'jscode2session':
+                return {'openid': 'openid_' + code, 'session_key': 'session_key'}
+            return self.new_token('openid_' + code)
+        if api == 'oauth2/refresh_token':
+            return self.new_token('openid_code')
+        if api == 'userinfo':
+            if params['access_token'] == 'expired':
+                return {'errcode': 42001, 'errmsg': 'access_token expired'}
+            return {'openid': params['openid'], 'unionid': 'unionid', 'nickname': 'nickname'}
+
+
+@override_settings(WECHAT_APP_SECRETS={'qtclass_wxweb': {'appid': 'wxweb', 'app_secret': 'sec'},
+                                       'qtclass_wxmp': {'appid': 'wxmp', 'app_secret': 'sec'}},
+                   WECHAT_LOGIN_DEFAULT_CLIENT_LABELS={'web': 'qtclass_wxweb', 'mp': 'qtclass_wxmp'})
+class LoginTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        get_login_credential.cache_clear()
+        self.api = FakeLoginAPI()
+        patcher = mock.patch('django_wechat.sdk.login.request_json', self.api)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_credential(self):
+        credential = get_login_credential('mp')
+        self.assertEqual(credential.code_params('code'),
+                         {'appid': 'wxmp', 'secret': 'sec', 'grant_type': 'authorization_code', 'js_code': 'code'})
+        self.assertIs(get_login_credential('mp'), credential)
+
+    def test_repeated_code(self):
+        """
+        重复提交的code使用缓存结果
+        """
+        self.assertEqual(get_openid('code', 'web')['openid'], 'openid_code')
+        self.assertEqual(get_openid('code', 'web')['openid'], 'openid_code')
+        self.assertEqual(len(self.api.calls), 1)
+
+    def test_concurrent_code(self):
+        """
+        同时提交的code只请求一次微信
+        """
+        self.api.delay = 0.1
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(get_openid('code', 'mp'))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.api.calls), 1)
+        self.assertEqual([result['openid'] for result in results], ['openid_code'] * 5)
+
+    def test_code_error(self):
+        self.api.used_codes.add('code')
+        for _ in range(2):
+            with self.assertRaises(WeChatLoginException) as cm:
+                get_openid('code', 'web')
+            self.assertEqual(cm.exception.errcode, 40163)
+        self.assertEqual(len(self.api.calls), 1)
+
+    def test_transient_code_error(self):
+        """
+        临时性错误不缓存，code可以重试
+        """
+        self.api.transient_errors.append({'errcode': 45011, 'errmsg': 'api minute-quota reach limit'})
+        with self.assertRaises(WeChatLoginException) as cm:
+            get_openid('code', 'web')
+        self.assertEqual(cm.exception.errcode, 45011)
+        self.assertEqual(get_openid('code', 'web')['openid'], 'openid_code')
+        self.assertEqual(len(self.api.calls), 2)
+
+    def test_concurrent_code_error(self):
+        """
+        换取失败时等待的请求立即收到相同的异常
+        """
+        self.api.delay = 0.1
+        self.api.transient_errors.append({'errcode': -1, 'errmsg': 'system error'})
+        errors = []
+
+        def login():
+            try:
+                get_openid('code', 'mp')
+            except WeChatLoginException as e:
+                errors.append(e.errcode)
+
+        threads = [threading.Thread(target=login) for _ in range(3)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [-1] * 3)
+        self.assertLess(time.time() - start, get_login_settings()['WAIT_TIMEOUT'])
+        self.assertEqual(len(self.api.calls), 1)
+
+    def test_userinfo_cache(self):
+        get_openid('code', 'web')
+        self.assertEqual(get_unionid('openid_code')['unionid'], 'unionid')
+        get_unionid('openid_code')
+        self.assertEqual(len(self.api.calls), 2)
+        self.assertEqual(self.api.calls[1][1]['access_token'], 'access_token_1')
+
+    def test_userinfo_explicit_access_token(self):
+        """
+        传入access_token时同样使用缓存，只在缓存未命中或refresh时使用传入的access_token
+        """
+        get_openid('code', 'web')
+        get_unionid('openid_code', 'access_token_x')
+        self.assertEqual(self.api.calls[-1][1]['access_token'], 'access_token_x')
+        get_unionid('openid_code', 'access_token_y')
+        self.assertEqual(len(self.api.calls), 2)
+        get_userinfo('openid_code', access_token='access_token_y', refresh=True)
+        self.assertEqual(self.api.calls[-1][1]['access_token'], 'access_token_y')
+
+    def test_refresh_token(self):
+        """
+        access_token临近过期时用refresh_token续期
+        """
+        get_openid('code', 'web')
+        with override_settings(WECHAT_LOGIN_CACHE={'EARLY_RENEWAL': 7200}):
+            self.assertEqual(get_access_token('openid_code'), 'access_token_2')
+        self.assertEqual(self.api.calls[-1][1]['refresh_token'], 'refresh_token')
+        self.assertEqual(get_access_token('openid_code'), 'access_token_2')
+
+    def test_expired_access_token(self):
+        get_openid('code', 'web')
+        user_info = get_userinfo('openid_code', access_token='expired')
+        self.assertEqual(user_info['nickname'], 'nickname')
+        self.assertEqual(self.api.calls[-1][1]['access_token'], 'access_token_2')
+
+    def test_login_required(self):
+        with self.assertRaises(WeChatLoginException):
+            get_access_token('openid_unknown')
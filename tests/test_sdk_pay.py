@@ -1,16 +1,187 @@
 # -*- coding: utf-8 -*-
 
-from wechatpy.pay.utils import calculate_signature
+import io
+import os
+import gzip
+
+from wechatpy.pay.utils import calculate_signature, calculate_signature_hmac
 from django.test import TestCase
 from django.conf import settings
 
 from django_wechat.sdk.pay import *
+from django_wechat.sdk.sessions import get_session
+
+
+class WeChatPayClientTestCase(TestCase):
+    def setUp(self):
+        reset_wechatpay_clients()
+
+    def test_cached_client(self):
+        client = get_wechatpay_client('qtclass_wxweb')
+        self.assertIs(get_wechatpay_client('qtclass_wxweb'), client)
+        self.assertIs(get_wechatpay_client(appid=client.appid), client)
+        self.assertIs(client.order._client, client)
+
+    def test_shared_session(self):
+        client = get_wechatpay_client('qtclass_wxweb')
+        other = get_wechatpay_client(appid='wx_other_appid')
+        self.assertIsNot(other, client)
+        self.assertIs(client._http, get_session())
+        self.assertIs(other._http, client._http)
+        self.assertIsNotNone(client.timeout)
+
+
+BILL_FILE = os.path.join(os.path.dirname(__file__), 'data', 'wechatpay_bill_20200915.csv')
+
+
+class FakeBillResponse(object):
+    def __init__(self, content: bytes):
+        self.raw = io.BytesIO(content)
+        self.closed = False
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBillSession(object):
+    def __init__(self, content: bytes):
+        self.content = content
+        self.requests = []
+
+    def post(self, url, data=None, **kwargs):
+        self.requests.append((url, data, kwargs))
+        self.response = FakeBillResponse(self.content)
+        return self.response
+
+
+class BillTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        with open(BILL_FILE, 'rb') as f:
+            cls.content = f.read()
+        cls.local_orders = {
+            'qtorder_20200915182157105164': {'total_fee': 1, 'trade_state': 'SUCCESS'},
+            'qtorder_20200915182157105165': {'total_fee': 90},
+        }
+
+    def lookup(self, out_trade_nos):
+        self.lookups.append(out_trade_nos)
+        return {key: self.local_orders[key] for key in out_trade_nos if key in self.local_orders}
+
+    def setUp(self):
+        self.lookups = []
+
+    def test_parse_bill(self):
+        with open(BILL_FILE, 'rb') as f:
+            rows = list(parse_bill(iter_bill_lines(f)))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0]['商户订单号'], 'qtorder_20200915182157105164')
+        # 商品名称中的逗号
+        self.assertEqual(rows[1]['商品名称'], '课程,含教材')
+        self.assertEqual(rows[1]['订单金额'], '1.00')
+
+    def test_parse_gzip_bill(self):
+        rows = list(parse_bill(iter_bill_lines(io.BytesIO(gzip.compress(self.content)))))
+        self.assertEqual(len(rows), 4)
+
+    def test_bill_error(self):
+        error = b'<xml><return_code><![CDATA[FAIL]]></return_code><return_msg><![CDATA[No Bill Exist]]></return_msg></xml>'
+        with self.assertRaises(WeChatPaySdkException):
+            list(iter_bill_lines(io.BytesIO(error)))
+
+    def test_reconcile_bill(self):
+        with open(BILL_FILE, 'rb') as f:
+            mismatches = list(reconcile_bill(parse_bill(iter_bill_lines(f)), self.lookup, batch_size=2))
+        reasons = {mismatch['out_trade_no']: mismatch['reason'] for mismatch in mismatches}
+        self.assertEqual(reasons, {'qtorder_20200915182157105165': 'total_fee',
+                                   'qtorder_20200915182157105166': 'missing'})
+        # 退款记录不参与对账，3条成功记录分2批查询
+        self.assertEqual([len(batch) for batch in self.lookups], [2, 1])
+
+    def test_reconcile_missing_in_bill(self):
+        """
+        本地已支付但不在账单中的订单
+        """
+        local_orders = [{'out_trade_no': 'qtorder_20200915182157105164', 'total_fee': 1},
+                        {'out_trade_no': 'qtorder_not_billed', 'total_fee': 100}]
+        with open(BILL_FILE, 'rb') as f:
+            mismatches = list(reconcile_bill(parse_bill(iter_bill_lines(f)), self.lookup, local_orders=local_orders))
+        missing = [mismatch for mismatch in mismatches if mismatch['reason'] == 'missing_in_bill']
+        self.assertEqual(missing, [{'out_trade_no': 'qtorder_not_billed', 'reason': 'missing_in_bill',
+                                    'bill': None, 'local': local_orders[1]}])
+
+    def test_reconcile_blank_total_fee(self):
+        rows = [{'商户订单号': 'qtorder_20200915182157105164', '交易状态': 'SUCCESS', '订单金额': '',
+                 '应结订单金额': ' '}]
+        self.assertIsNone(normalize_bill_row(rows[0])['total_fee'])
+        mismatches = list(reconcile_bill(rows, self.lookup))
+        self.assertEqual([mismatch['reason'] for mismatch in mismatches], ['blank_total_fee'])
+
+    def test_download_bill(self):
+        reset_wechatpay_clients()
+        client = get_wechatpay_client('qtclass_wxweb')
+        session = FakeBillSession(gzip.compress(self.content))
+        client._http = session
+        try:
+            rows = download_bill('qtclass_wxweb', '20200915', tar_type='GZIP')
+            self.assertEqual(len(list(rows)), 4)
+        finally:
+            reset_wechatpay_clients()
+        url, data, kwargs = session.requests[0]
+        self.assertTrue(url.endswith('pay/downloadbill'))
+        self.assertIn(b'<tar_type><![CDATA[GZIP]]></tar_type>', data)
+        self.assertTrue(kwargs['stream'])
+        self.assertTrue(session.response.closed)
+
+
+class PaySignerTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.params = {
+            'appid': 'wxappid',
+            'mch_id': MCH_ID,
+            'nonce_str': '5d2b6c2a8db53831f7eda20af46e531c',
+            'body': '支付测试',
+            'total_fee': 1,
+            'attach': '',
+        }
+
+    def test_md5(self):
+        signer = PaySigner(MCH_API_KEY, 'MD5')
+        self.assertEqual(signer.sign(self.params), calculate_signature(self.params, MCH_API_KEY))
+        # sign不参与签名
+        self.assertEqual(signer.sign(dict(self.params, sign='x')), signer.sign(self.params))
+
+    def test_hmac_sha256(self):
+        signer = PaySigner(MCH_API_KEY, 'HMAC-SHA256')
+        self.assertEqual(signer.sign(self.params), calculate_signature_hmac(self.params, MCH_API_KEY))
+        # 预先计算的状态不受之前签名的影响
+        self.assertEqual(signer.sign(self.params), signer.sign(dict(self.params)))
+
+    def test_sign_many(self):
+        signer = PaySigner(MCH_API_KEY, 'HMAC-SHA256')
+        params_list = [dict(self.params, total_fee=fee) for fee in range(1, 4)]
+        self.assertEqual(signer.sign_many(params_list), [signer.sign(params) for params in params_list])
+
+    def test_invalid_sign_type(self):
+        with self.assertRaises(WeChatPaySdkException):
+            PaySigner(MCH_API_KEY, 'SHA1')
 
 
 class ParseUnifiedOrderResultTestCase(TestCase):
     def test_parse_wechat_unifiedorder_result_native(self):
         pass
 
+    def test_parse_wechat_unifiedorder_result_jsapi(self):
+        result = {'trade_type': 'JSAPI', 'appid': 'wxappid', 'nonce_str': 'abc', 'prepay_id': 'wx201410272009395522657a690389285100'}
+        data, content_type = parse_wechatpay_unifiedorder_result(result)
+        self.assertEqual(data['package'], 'prepay_id=' + result['prepay_id'])
+        self.assertEqual(data['paySign'], calculate_signature({key: value for key, value in data.items()
+                                                               if key != 'paySign'}, MCH_API_KEY))
+
 
 class QueryOrderTestCase(TestCase):
     @classmethod
@@ -70,3 +241,21 @@ class NotifyOrderTestCase(TestCase):
         data = parse_wechatpay_notify_data(self.xml_raw_data)
         self.assertTrue(data)
         print(data)
+
+    def test_parse_hmac_notify(self):
+        data = dict(self.raw_data, sign_type='HMAC-SHA256')
+        data.pop('sign')
+        xml = dict_to_xml(data, calculate_signature_hmac(data, MCH_API_KEY))
+        parsed = parse_wechatpay_notify_data(xml)
+        self.assertEqual(parsed['transaction_id'], data['transaction_id'])
+        self.assertEqual(parsed['total_fee'], 1)
+
+        # 签名方式和sign_type不一致
+        with self.assertRaises(WeChatPaySdkException):
+            parse_wechatpay_notify_data(dict_to_xml(data, calculate_signature(data, MCH_API_KEY)))
+
+    def test_parse_invalid_notify(self):
+        with self.assertRaises(WeChatPaySdkException):
+            parse_wechatpay_notify_data(self.xml_raw_data.replace(self.raw_data['sign'], 'invalid'))
+        with self.assertRaises(WeChatPaySdkException):
+            parse_wechatpay_notify_data('<xml><appid>')
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import base64
+import datetime
+import tempfile
+import threading
+from unittest import mock
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from django_wechat.sdk.pay_v3 import *
+
+
+API_V3_KEY = 'v' * 32
+MCH_ID = '1900000109'
+PLATFORM_SERIAL_NO = '5157F09EFDC096DE15EBE81A47057A7232F1B8E1'
+
+
+def gen_private_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def gen_certificate_pem(private_key) -> str:
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'Tenpay.com Root CA')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = x509.CertificateBuilder().subject_name(name).issuer_name(name) \
+        .public_key(private_key.public_key()).serial_number(x509.random_serial_number()) \
+        .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1)) \
+        .sign(private_key, hashes.SHA256())
+    return certificate.public_bytes(serialization.Encoding.PEM).decode()
+
+
+def encrypt_resource(plaintext: bytes, associated_data='') -> dict:
+    nonce = base64.b64encode(os.urandom(9)).decode()
+    ciphertext = AESGCM(API_V3_KEY.encode()).encrypt(nonce.encode(), plaintext, associated_data.encode() or None)
+    return {'algorithm': 'AEAD_AES_256_GCM', 'nonce': nonce, 'associated_data': associated_data,
+            'ciphertext': base64.b64encode(ciphertext).decode()}
+
+
+class FakeResponse(object):
+    def __init__(self, headers, text, status_code=200):
+        self.headers = headers
+        self.content = text.encode()
+        self.status_code = status_code
+
+
+class FakeWeChatPayServer(object):
+    """
+    用本地生成的平台私钥签名应答的假微信支付服务器
+    """
+    def __init__(self, platform_key, serial_no=PLATFORM_SERIAL_NO):
+        self.platform_key = platform_key
+        self.serial_no = serial_no
+        self.certificate_pem = gen_certificate_pem(platform_key)
+        self.requests = []
+
+    def signed_headers(self, body: str, timestamp=None):
+        timestamp = timestamp or str(int(time.time()))
+        nonce = 'fake_nonce'
+        signature = self.platform_key.sign('{}\n{}\n{}\n'.format(timestamp, nonce, body).encode(),
+                                           padding.PKCS1v15(), hashes.SHA256())
+        return {'Wechatpay-Serial': self.serial_no, 'Wechatpay-Signature': base64.b64encode(signature).decode(),
+                'Wechatpay-Timestamp': timestamp, 'Wechatpay-Nonce': nonce}
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        if url.endswith('/v3/certificates'):
+            body = json.dumps({'data': [{
+                'serial_no': self.serial_no,
+                'encrypt_certificate': encrypt_resource(self.certificate_pem.encode(), 'certificate'),
+            }]})
+        else:
+            body = json.dumps({'prepay_id': 'wx201410272009395522657a690389285100'})
+        return FakeResponse(self.signed_headers(body), body)
+
+
+class WeChatPayV3ClientTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.merchant_key = gen_private_key()
+        cls.merchant_key_pem = cls.merchant_key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+        cls.platform_key = gen_private_key()
+
+    def setUp(self):
+        cache.clear()
+        self.server = FakeWeChatPayServer(self.platform_key)
+        self.client = WeChatPayV3Client(MCH_ID, 'merchant_serial', self.merchant_key_pem, API_V3_KEY,
+                                        session=self.server)
+
+    def test_authorization(self):
+        authorization = self.client.build_authorization('POST', '/v3/pay/transactions/jsapi', '{}',
+                                                        timestamp='1554208460', nonce_str='593BEC0C930BF1AFEB40B4A08C8FB242')
+        self.assertTrue(authorization.startswith(AUTH_SCHEMA + ' mchid="1900000109"'))
+        signature = authorization.split('signature="')[1].split('"')[0]
+        message = 'POST\n/v3/pay/transactions/jsapi\n1554208460\n593BEC0C930BF1AFEB40B4A08C8FB242\n{}\n'
+        self.assertTrue(rsa_verify(self.merchant_key.public_key(), message, signature))
+
+    def test_request_api(self):
+        data = self.client.create_order('jsapi', {'appid': 'wxappid', 'out_trade_no': 'qtorder_1'})
+        self.assertEqual(data['prepay_id'], 'wx201410272009395522657a690389285100')
+        # 首次验签时下载平台证书
+        urls = [url for method, url, kwargs in self.server.requests]
+        self.assertEqual(urls[0], WECHATPAY_V3_API_ROOT_URL + '/v3/pay/transactions/jsapi')
+        self.assertEqual(urls[1], WECHATPAY_V3_API_ROOT_URL + '/v3/certificates')
+        body = json.loads(self.server.requests[0][2]['data'])
+        self.assertEqual(body['mchid'], MCH_ID)
+
+    def test_cached_certificates(self):
+        """
+        其他进程下载的平台证书从缓存读取
+        """
+        self.client.refresh_certificates()
+        client = WeChatPayV3Client(MCH_ID, 'merchant_serial', self.merchant_key_pem, API_V3_KEY, session=self.server)
+        client.get_certificate(PLATFORM_SERIAL_NO)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_parse_notify(self):
+        transaction = {'out_trade_no': 'qtorder_1', 'trade_state': 'SUCCESS', 'amount': {'total': 1}}
+        body = json.dumps({
+            'id': 'EV-2018022511223320873',
+            'event_type': 'TRANSACTION.SUCCESS',
+            'resource_type': 'encrypt-resource',
+            'resource': dict(encrypt_resource(json.dumps(transaction).encode(), 'transaction'),
+                             original_type='transaction'),
+        })
+        data = self.client.parse_notify(self.server.signed_headers(body), body.encode())
+        self.assertEqual(data['resource'], transaction)
+
+    def test_invalid_notify(self):
+        body = json.dumps({'resource': encrypt_resource(b'{}')})
+        headers = self.server.signed_headers(body)
+        with self.assertRaises(WeChatPayV3SdkException):
+            self.client.parse_notify(headers, body.replace('AEAD', 'aead'))
+        with self.assertRaises(WeChatPayV3SdkException):
+            self.client.parse_notify(self.server.signed_headers(body, timestamp='1554208460'), body)
+        with self.assertRaises(WeChatPayV3SdkException):
+            self.client.parse_notify(self.server.signed_headers(body, timestamp='not_a_timestamp'), body)
+
+    def test_invalid_resource(self):
+        resource = encrypt_resource(b'{}')
+        resource['associated_data'] = 'tampered'
+        with self.assertRaises(WeChatPayV3SdkException):
+            self.client.decrypt(resource)
+
+    def test_unknown_serial_no(self):
+        """
+        未知的平台证书序列号在最小间隔内只下载一次
+        """
+        self.client.refresh_certificates()
+        for _ in range(3):
+            with self.assertRaises(WeChatPayV3SdkException):
+                self.client.get_certificate('unknown')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_unknown_serial_no_cache(self):
+        """
+        未知的平台证书序列号在最小间隔内不重新读取缓存，缓存的证书没有变化时不重新解析
+        """
+        self.client.refresh_certificates()
+        client = WeChatPayV3Client(MCH_ID, 'merchant_serial', self.merchant_key_pem, API_V3_KEY, session=self.server)
+        client.get_certificate(PLATFORM_SERIAL_NO)
+        # 加载时间为证书的下载时间
+        self.assertEqual(client._certificates_loaded_at, self.client._certificates_downloaded_at)
+        certificates = client._certificates
+        # 本进程刚下载过，不再下载
+        client._certificates_downloaded_at = time.time()
+        with mock.patch('django_wechat.sdk.pay_v3.cache') as mock_cache:
+            for _ in range(3):
+                with self.assertRaises(WeChatPayV3SdkException):
+                    client.get_certificate('unknown')
+        mock_cache.get.assert_not_called()
+
+        # 超过最小间隔后重新读取缓存
+        client._certificates_checked_at -= CERTIFICATE_MIN_RELOAD_INTERVAL + 1
+        with self.assertRaises(WeChatPayV3SdkException):
+            client.get_certificate('unknown')
+        self.assertIs(client._certificates, certificates)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_concurrent_refresh(self):
+        """
+        等待锁的线程不重复刷新其他线程已经加载的证书
+        """
+        barrier = threading.Barrier(4)
+
+        def get_certificate():
+            barrier.wait()
+            client.get_certificate(PLATFORM_SERIAL_NO)
+
+        client = self.client
+        with mock.patch.object(client, '_set_certificates', wraps=client._set_certificates) as set_certificates:
+            threads = [threading.Thread(target=get_certificate) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(set_certificates.call_count, 1)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_client_cache_clear(self):
+        with tempfile.NamedTemporaryFile(suffix='.pem') as f:
+            f.write(self.merchant_key_pem)
+            f.flush()
+            secrets = {'mch_id': MCH_ID, 'mch_key': f.name, 'mch_serial_no': 'merchant_serial',
+                       'api_v3_key': API_V3_KEY}
+            get_wechatpay_v3_client.cache_clear()
+            with override_settings(WECHATPAY_SECRETS=secrets):
+                client = get_wechatpay_v3_client()
+                self.assertIs(get_wechatpay_v3_client(), client)
+            # 轮换商户证书后重新创建客户端
+            with override_settings(WECHATPAY_SECRETS=dict(secrets, mch_serial_no='rotated_serial')):
+                get_wechatpay_v3_client.cache_clear()
+                self.assertEqual(get_wechatpay_v3_client().serial_no, 'rotated_serial')
+            get_wechatpay_v3_client.cache_clear()
+
+    def test_jsapi_params(self):
+        params = self.client.jsapi_params('wxappid', 'wx201410272009395522657a690389285100')
+        message = '{appId}\n{timeStamp}\n{nonceStr}\n{package}\n'.format(**params)
+        self.assertTrue(rsa_verify(self.merchant_key.public_key(), message, params['paySign']))
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+from django.test import TestCase, override_settings
+
+from django_wechat.sdk.sessions import *
+
+
+class FakeResponse(object):
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeSession(object):
+    """
+    按顺序返回预设响应的假会话
+    """
+    def __init__(self, contents):
+        self.contents = list(contents)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, url, kwargs))
+        return FakeResponse(self.contents.pop(0))
+
+
+class SharedSessionTestCase(TestCase):
+    def tearDown(self):
+        reset_session()
+
+    def test_get_session_reused(self):
+        self.assertIs(get_session(), get_session())
+
+    @override_settings(WECHAT_HTTP={'POOL_MAXSIZE': 42})
+    def test_pool_size_from_settings(self):
+        reset_session()
+        adapter = get_session().get_adapter('https://qyapi.weixin.qq.com/')
+        self.assertEqual(adapter._pool_maxsize, 42)
+
+
+@override_settings(WECHAT_HTTP={'BACKOFF_FACTOR': 0, 'MAX_RETRIES': 2})
+class RequestJsonTestCase(TestCase):
+    def test_default_timeout(self):
+        session = FakeSession([b'{"errcode": 0}'])
+        request_json('GET', 'https://qyapi.weixin.qq.com/cgi-bin/gettoken', session=session)
+        self.assertEqual(session.calls[0][2]['timeout'], DEFAULTS['TIMEOUT'])
+
+    def test_retry_busy_errcode(self):
+        session = FakeSession([b'{"errcode": -1}', b'{"errcode": 0, "access_token": "token"}'])
+        data = request_json('GET', 'https://qyapi.weixin.qq.com/cgi-bin/gettoken', session=session)
+        self.assertEqual(data['access_token'], 'token')
+        self.assertEqual(len(session.calls), 2)
+
+    def test_no_retry_other_errcode(self):
+        session = FakeSession([b'{"errcode": 40013}', b'{"errcode": 0}'])
+        data = request_json('GET', 'https://qyapi.weixin.qq.com/cgi-bin/gettoken', session=session)
+        self.assertEqual(data['errcode'], 40013)
+        self.assertEqual(len(session.calls), 1)
+
+    def test_give_up_after_max_retries(self):
+        session = FakeSession([b'{"errcode": -1}'] * 3)
+        data = request_json('GET', 'https://qyapi.weixin.qq.com/cgi-bin/gettoken', session=session)
+        self.assertEqual(data['errcode'], -1)
+        self.assertEqual(len(session.calls), 3)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import time
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from django_wechat.sdk.tokens import AccessTokenManager
+from django_wechat.sdk.token_registry import *
+
+
+class FakeFetcher(object):
+    def __init__(self, name, expires_in=7200, error=None):
+        self.name = name
+        self.expires_in = expires_in
+        self.error = error
+        self.count = 0
+
+    def __call__(self):
+        if self.error is not None:
+            raise self.error
+        self.count += 1
+        return '{}_{}'.format(self.name, self.count), self.expires_in
+
+
+class TokenRegistryTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.fetchers = {name: FakeFetcher(name) for name in ('a', 'b', 'c')}
+        self.registry = TokenRegistry()
+        for name, fetcher in self.fetchers.items():
+            self.registry.register(name, AccessTokenManager('test_access_token_' + name, fetcher))
+
+    def test_load(self):
+        """
+        一次get_many读取所有应用
+        """
+        for manager in self.registry.managers.values():
+            manager.get()
+        registry = TokenRegistry()
+        for name, fetcher in self.fetchers.items():
+            registry.register(name, AccessTokenManager('test_access_token_' + name, fetcher))
+        with mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+            registry.load()
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual(registry.managers['b'].get(), 'b_1')
+        self.assertEqual(self.fetchers['b'].count, 1)
+
+    def test_refresh_due(self):
+        results = self.registry.refresh_due()
+        self.assertEqual(results, {'a': True, 'b': True, 'c': True})
+        self.assertEqual(self.registry.refresh_due(), {'a': False, 'b': False, 'c': False})
+        # 剩余有效期不足ahead秒时续期
+        self.assertEqual(self.registry.refresh_due(ahead=7200), {'a': True, 'b': True, 'c': True})
+        self.assertEqual(self.registry.managers['a'].get(), 'a_2')
+
+    def test_refresh_due_cache_reads(self):
+        """
+        所有应用都需要续期时也只读取一次缓存
+        """
+        with mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+            self.registry.refresh_due()
+        self.assertEqual(get_many.call_count, 1)
+
+    def test_refresh_error(self):
+        """
+        单个应用续期失败不影响其他应用
+        """
+        self.fetchers['b'].error = ValueError('errcode')
+        results = self.registry.refresh_due()
+        self.assertIsInstance(results['b'], ValueError)
+        self.assertTrue(results['a'])
+        self.assertTrue(results['c'])
+        self.assertEqual(self.registry.metrics()['b']['refresh_errors'], 1)
+
+    def test_metrics(self):
+        self.registry.refresh_due()
+        self.registry.managers['a'].get()
+        metrics = self.registry.metrics()['a']
+        self.assertEqual(metrics['refreshes'], 1)
+        self.assertEqual(metrics['hits'], 1)
+        self.assertGreater(metrics['expires_in'], 7000)
+
+    def test_background_refresh(self):
+        self.registry.start(interval=0.01)
+        try:
+            deadline = time.time() + 2
+            while self.fetchers['c'].count == 0 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            self.registry.stop(timeout=1)
+        self.assertEqual(self.fetchers['c'].count, 1)
+        self.assertEqual(self.registry.managers['c'].get(), 'c_1')
+
+
+class DefaultTokenRegistryTestCase(TestCase):
+    def tearDown(self):
+        get_token_registry.cache_clear()
+
+    @override_settings(WECHAT_APP_SECRETS={
+        'qtclass_wxmp': {'appid': 'wxmp', 'app_secret': 'sec'},
+        'qtclass_wxweb': {'appid': 'wxweb', 'app_secret': 'sec', 'access_token': False},
+    })
+    def test_configured_apps(self):
+        get_token_registry.cache_clear()
+        managers = get_token_registry().managers
+        self.assertIn('wechatwork:contact', managers)
+        self.assertEqual(managers['wechatwork:contact'].key, 'wechatwork_access_token_contact')
+        self.assertEqual(managers['wechat:qtclass_wxmp'].key, 'wechat_access_token_qtclass_wxmp')
+        self.assertNotIn('wechat:qtclass_wxweb', managers)
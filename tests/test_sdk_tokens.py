@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from django_wechat.sdk.tokens import *
+
+
+class CountingFetcher(object):
+    """
+    记录调用次数的假access_token接口
+    """
+    def __init__(self, expires_in=7200, delay=0):
+        self.expires_in = expires_in
+        self.delay = delay
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        time.sleep(self.delay)
+        with self._lock:
+            self.count += 1
+            return 'token_{}'.format(self.count), self.expires_in
+
+
+class AccessTokenManagerTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_local_copy(self):
+        fetcher = CountingFetcher()
+        manager = AccessTokenManager('test_access_token', fetcher)
+        self.assertEqual(manager.get(), 'token_1')
+        cache.clear()
+        self.assertEqual(manager.get(), 'token_1')
+        self.assertEqual(fetcher.count, 1)
+
+    def test_shared_cache(self):
+        fetcher = CountingFetcher()
+        AccessTokenManager('test_access_token', fetcher).get()
+        self.assertEqual(AccessTokenManager('test_access_token', fetcher).get(), 'token_1')
+        self.assertEqual(fetcher.count, 1)
+
+    def test_single_flight(self):
+        fetcher = CountingFetcher(delay=0.1)
+        manager = AccessTokenManager('test_access_token', fetcher)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(manager.get())) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(fetcher.count, 1)
+        self.assertEqual(set(results), {'token_1'})
+
+    @override_settings(WECHAT_ACCESS_TOKEN={'EARLY_RENEWAL': 7200})
+    def test_early_renewal(self):
+        fetcher = CountingFetcher(expires_in=7200)
+        manager = AccessTokenManager('test_access_token', fetcher)
+        manager.get()
+        # 已进入提前续期时间，续期后返回新的access_token
+        self.assertEqual(manager.get(), 'token_2')
+
+    def test_invalidate(self):
+        fetcher = CountingFetcher()
+        manager = AccessTokenManager('test_access_token', fetcher)
+        manager.get()
+        manager.invalidate('token_0')
+        self.assertEqual(manager.get(), 'token_1')
+        manager.invalidate('token_1')
+        self.assertEqual(manager.get(), 'token_2')
+
+    def test_get_token_manager(self):
+        fetcher = CountingFetcher()
+        self.assertIs(get_token_manager('test_access_token', fetcher), get_token_manager('test_access_token', fetcher))
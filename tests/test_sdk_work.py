@@ -6,7 +6,13 @@
 - 2020-07-07 全部通过测试
 """
 
-from django.test import TestCase
+import json
+import threading
+from unittest import mock
+
+import xmltodict
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from django.utils import timezone
 
 from django_wechat.sdk.work import *
@@ -65,7 +71,7 @@ class MsgDecryptTestCase(TestCase):
 
     def test_aes_decrypt(self):
         random_msg = aes_decrypt(msg_encrypt=self.msg_encrypt, encoding_aes_key=self.encoding_aes_key)
-        self.assertEqual(random_msg, self.random_msg)
+        self.assertEqual(random_msg, self.random_msg.encode())
 
     def test_decrypt_msg(self):
         data = decrypt_msg(self.raw_msg_encrypt, self.sign, self.timestamp, self.nonce, self.token, self.encoding_aes_key)
@@ -75,7 +81,7 @@ class MsgDecryptTestCase(TestCase):
 
     def test_gen_random_str(self):
         random_msg = gen_random_msg(self.data, random_str_16=self.nonce_16)
-        self.assertEqual(random_msg, self.random_msg)
+        self.assertEqual(random_msg, self.random_msg.encode())
 
     def test_aes_encrypt(self):
         msg_encrypt = aes_encrypt(self.random_msg, self.encoding_aes_key)
@@ -86,6 +92,52 @@ class MsgDecryptTestCase(TestCase):
         msg_encrypt = xmltodict.parse(xml_str)['xml']['Encrypt']
         self.assertEqual(msg_encrypt, self.msg_encrypt)
 
+    def test_callback_sdk_round_trip(self):
+        sdk = WeChatWorkCallbackSDK(self.token, self.encoding_aes_key)
+        self.assertEqual(bytes(sdk.cipher.decrypt(self.msg_encrypt)), self.random_msg.encode())
+        raw_msg_encrypt = sdk.encrypt(self.data)
+        data = xmltodict.parse(raw_msg_encrypt)['xml']
+        decrypted = sdk.decrypt(raw_msg_encrypt, data['MsgSignature'], data['TimeStamp'], data['Nonce'])
+        self.assertEqual(decrypted['Content'], 'hello')
+
+    def test_callback_sdk_replay_checks(self):
+        """
+        过期和重放的请求在解密前被拒绝
+        """
+        cache.clear()
+        sdk = WeChatWorkCallbackSDK(self.token, self.encoding_aes_key, replay_window=300)
+        with self.assertRaises(WeChatWorkCallbackStale):
+            sdk.decrypt(self.raw_msg_encrypt, self.sign, self.timestamp, self.nonce)
+        raw_msg_encrypt = sdk.encrypt(self.data)
+        data = xmltodict.parse(raw_msg_encrypt)['xml']
+        sdk.decrypt(raw_msg_encrypt, data['MsgSignature'], data['TimeStamp'], data['Nonce'])
+        # 处理完成前不记录nonce，处理失败时可以重试
+        sdk.decrypt(raw_msg_encrypt, data['MsgSignature'], data['TimeStamp'], data['Nonce'])
+        sdk.record_nonce(data['TimeStamp'], data['Nonce'])
+        with self.assertRaises(WeChatWorkCallbackReplayed):
+            sdk.decrypt(raw_msg_encrypt, data['MsgSignature'], data['TimeStamp'], data['Nonce'])
+        # 不同token的应用不共用nonce记录
+        other_sdk = WeChatWorkCallbackSDK('other_token', self.encoding_aes_key, replay_window=300)
+        other_sdk.check_nonce(data['TimeStamp'], data['Nonce'])
+        # 默认不校验时间窗口，兼容历史消息
+        sdk = WeChatWorkCallbackSDK(self.token, self.encoding_aes_key)
+        self.assertEqual(sdk.decrypt(self.raw_msg_encrypt, self.sign, self.timestamp, self.nonce)['Content'],
+                         'hello')
+
+    def test_non_ascii_round_trip(self):
+        """
+        msg_len按字节计算，中文内容和长度超过127字节的消息也能正确解析
+        """
+        data = dict(self.data, Content='你好，' * 50)
+        random_msg = gen_random_msg(data, random_str_16=self.nonce_16)
+        self.assertEqual(parse_random_msg(random_msg)['Content'], data['Content'])
+        raw_msg_encrypt = encrypt_msg(data=data, token=self.token, encoding_aes_key=self.encoding_aes_key,
+                                      timestamp=self.timestamp, nonce=self.nonce)
+        envelope = xmltodict.parse(raw_msg_encrypt)['xml']
+        decrypted = decrypt_msg(raw_msg_encrypt, envelope['MsgSignature'], self.timestamp, self.nonce,
+                                self.token, self.encoding_aes_key)
+        self.assertEqual(decrypted['Content'], data['Content'])
+
     def test_encrypt_msg(self):
         raw_msg_encrypt = encrypt_msg(data=self.data, token=self.token, encoding_aes_key=self.encoding_aes_key,
                                       timestamp=self.timestamp, nonce=self.nonce, random_str_16=self.nonce_16)
@@ -171,4 +223,110 @@ class TagSDKTestCase(TestCase):
         self.assertFalse('errcode' in response and response['errcode'] != 0)
 
 
-
+class FakeWeChatWorkSession(object):
+    """
+    模拟企业微信服务器的假会话，用于不依赖网络的测试
+    """
+    def __init__(self, existing_userids=(), invalid_userids=()):
+        self.existing_userids = set(existing_userids)
+        self.invalid_userids = set(invalid_userids)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def request(self, method, url, params=None, json=None, **kwargs):
+        api = url[len(WECHATWORK_API_ROOT_URL):]
+        with self._lock:
+            self.calls.append(api)
+            data = {'errcode': 0, 'errmsg': 'ok'}
+            if api == 'user/update':
+                if json['userid'] not in self.existing_userids:
+                    data = {'errcode': USER_NOT_FOUND_ERRCODE, 'errmsg': 'userid not found'}
+            elif api == 'user/create':
+                if json['userid'] in self.invalid_userids:
+                    data = {'errcode': 60104, 'errmsg': 'mobile existed'}
+                else:
+                    self.existing_userids.add(json['userid'])
+            elif api == 'user/batchdelete':
+                if self.invalid_userids & set(json['useridlist']):
+                    data = {'errcode': USER_NOT_FOUND_ERRCODE, 'errmsg': 'userid not found'}
+            elif api == 'user/delete':
+                if params['userid'] in self.invalid_userids:
+                    data = {'errcode': USER_NOT_FOUND_ERRCODE, 'errmsg': 'userid not found'}
+            elif api == 'department/list':
+                data['department'] = [{'id': 1, 'parentid': 0}, {'id': 2, 'parentid': 1}]
+            elif api == 'user/list':
+                userids = {'1': ['user_0', 'user_1'], '2': ['user_1', 'user_2']}[str(params['department_id'])]
+                data['userlist'] = [{'userid': userid, 'name': userid, 'mobile': '1'} for userid in userids]
+            elif api == 'user/list_id':
+                pages = {None: ('page_2', ['user_0', 'user_1']), 'page_2': ('', ['user_2'])}
+                next_cursor, userids = pages[json.get('cursor')]
+                data['next_cursor'] = next_cursor
+                data['dept_user'] = [{'userid': userid, 'department': 1} for userid in userids]
+        return FakeResponse(data)
+
+
+class FakeResponse(object):
+    def __init__(self, data):
+        self.content = json.dumps(data).encode()
+
+
+class BulkUserSDKTestCase(TestCase):
+    def setUp(self):
+        self.sdk = UserSDK()
+        self.sdk.token_manager._store('access_token', 7200)
+
+    def test_bulk_upsert(self):
+        self.sdk._session = FakeWeChatWorkSession(existing_userids=['user_0'], invalid_userids=['user_2'])
+        users = ({'userid': 'user_{}'.format(i), 'name': 'user', 'department': [1]} for i in range(4))
+        results = self.sdk.bulk_upsert(users, max_workers=2)
+        self.assertEqual(set(results['succeeded']), {'user_0', 'user_1', 'user_3'})
+        self.assertEqual(results['failed']['user_2'].errcode, 60104)
+        self.assertEqual(self.sdk._session.calls.count('user/create'), 3)
+
+    def test_bulk_delete(self):
+        self.sdk._session = FakeWeChatWorkSession(invalid_userids=['user_250'])
+        userids = ['user_{}'.format(i) for i in range(300)]
+        with self.assertLogs('django_wechat.sdk.work', 'WARNING'):
+            results = self.sdk.bulk_delete(userids)
+        self.assertEqual(len(results['succeeded']), 299)
+        self.assertEqual(list(results['failed']), ['user_250'])
+        # 第一批200个整批删除，第二批整批失败后逐个删除
+        self.assertEqual(self.sdk._session.calls.count('user/batchdelete'), 2)
+        self.assertEqual(self.sdk._session.calls.count('user/delete'), 100)
+
+    def test_bulk_delete_network_error(self):
+        """
+        非接口错误不再逐个删除，直接抛出
+        """
+        self.sdk._session = FakeWeChatWorkSession()
+        with mock.patch.object(self.sdk._session, 'request', side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                self.sdk.bulk_delete(['user_0', 'user_1'])
+
+    def test_bulk_settings(self):
+        self.sdk._session = FakeWeChatWorkSession()
+        with override_settings(WECHATWORK_BULK={'RATE': 50, 'BURST': 20}):
+            self.assertEqual(get_bulk_settings(), {'MAX_WORKERS': 8, 'RATE': 50, 'BURST': 20})
+            self.sdk.bulk_delete(['user_0'])
+        bucket = get_token_bucket(self.sdk._access_token_key, 50, 20)
+        self.assertEqual((bucket.rate, bucket.capacity), (50, 20))
+
+        # 之后传入的rate更新共享令牌桶
+        self.sdk.run_bulk(lambda item, bucket: {item: item}, ['user_0'], rate=10)
+        self.assertEqual((bucket.rate, bucket.capacity), (10, 100))
+
+
+class IterUserSDKTestCase(TestCase):
+    def setUp(self):
+        self.sdk = UserSDK()
+        self.sdk.token_manager._store('access_token', 7200)
+
+    def test_iter_list(self):
+        self.sdk._session = FakeWeChatWorkSession()
+        users = list(self.sdk.iter_list(fields=('userid', 'name')))
+        self.assertEqual(users, [{'userid': 'user_{}'.format(i), 'name': 'user_{}'.format(i)} for i in range(3)])
+
+    def test_iter_userids(self):
+        self.sdk._session = FakeWeChatWorkSession()
+        userids = [item['userid'] for item in self.sdk.iter_userids()]
+        self.assertEqual(userids, ['user_0', 'user_1', 'user_2'])
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+企业微信异步SDK测试样例，使用httpx.MockTransport模拟企业微信服务器
+"""
+
+import json
+import asyncio
+
+import httpx
+from django.core.cache import cache
+from django.test import TestCase
+
+from django_wechat.sdk.work_async import *
+from django_wechat.sdk.work import UserSDK
+
+
+class MockWeChatWork(object):
+    """
+    模拟企业微信服务器，记录gettoken调用次数
+    """
+    def __init__(self):
+        self.token_count = 0
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith('/gettoken'):
+            self.token_count += 1
+            data = {'errcode': 0, 'errmsg': 'ok', 'access_token': 'token', 'expires_in': 7200}
+        elif request.url.path.endswith('/user/get'):
+            data = {'errcode': 0, 'errmsg': 'ok', 'userid': request.url.params['userid']}
+        elif request.url.path.endswith('/user/get_active_stat'):
+            data = {'errcode': 0, 'errmsg': 'ok', 'active_cnt': 8}
+        else:
+            data = {'errcode': 60111, 'errmsg': 'userid not found'}
+        return httpx.Response(200, content=json.dumps(data).encode())
+
+
+class AsyncUserSDKTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.server = MockWeChatWork()
+        self.client = httpx.AsyncClient(transport=httpx.MockTransport(self.server))
+        self.sdk = AsyncUserSDK(client=self.client)
+        self.sdk.token_manager.invalidate()
+
+    async def test_concurrent_get(self):
+        userids = ['user_{}'.format(i) for i in range(50)]
+        users = await asyncio.gather(*[self.sdk.get(userid) for userid in userids])
+        self.assertEqual([user['userid'] for user in users], userids)
+        self.assertEqual(self.server.token_count, 1)
+
+    async def test_get_active_stat(self):
+        self.assertEqual(await self.sdk.get_active_stat(date='2020-10-04'), 8)
+
+    async def test_exception(self):
+        with self.assertRaises(WeChatWorkSdkException):
+            await self.sdk.delete('unknown')
+
+    def test_no_blocking_api(self):
+        """
+        异步SDK没有会阻塞事件循环的同步方法
+        """
+        self.assertFalse(hasattr(self.sdk, 'access_token'))
+        self.assertFalse(hasattr(self.sdk, 'run_bulk'))
+        self.assertEqual(self.sdk.token_manager.key, UserSDK().token_manager.key)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+from django.test import TestCase
+
+from django_wechat.sdk.xmlcodec import *
+
+
+# 企业微信官方文档中的文本消息和通讯录变更事件
+TEXT_MSG = """<xml><ToUserName><![CDATA[wx5823bf96d3bd56c7]]></ToUserName>
+<FromUserName><![CDATA[mycreate]]></FromUserName>
+<CreateTime>1409659813</CreateTime>
+<MsgType><![CDATA[text]]></MsgType>
+<Content><![CDATA[hello]]></Content>
+<MsgId>4561255354251345929</MsgId>
+<AgentID>218</AgentID>
+</xml>"""
+
+CONTACT_EVENT = """<xml>
+    <ToUserName><![CDATA[toUser]]></ToUserName>
+    <FromUserName><![CDATA[sys]]></FromUserName>
+    <CreateTime>1403610513</CreateTime>
+    <MsgType><![CDATA[event]]></MsgType>
+    <Event><![CDATA[change_contact]]></Event>
+    <ChangeType>create_user</ChangeType>
+    <UserID><![CDATA[zhangsan]]></UserID>
+    <Name><![CDATA[张三]]></Name>
+    <Department><![CDATA[1,2,3]]></Department>
+    <Position><![CDATA[产品经理]]></Position>
+    <Avatar><![CDATA[]]></Avatar>
+    <ExtAttr>
+        <Item>
+            <Name><![CDATA[爱好]]></Name>
+            <Type>0</Type>
+            <Text><Value><![CDATA[旅游]]></Value></Text>
+        </Item>
+        <Item>
+            <Name><![CDATA[卡号]]></Name>
+            <Type>0</Type>
+            <Text><Value><![CDATA[1234567234]]></Value></Text>
+        </Item>
+    </ExtAttr>
+</xml>"""
+
+
+class XMLCodecTestCase(TestCase):
+    def test_parse_same_as_xmltodict(self):
+        fast, fallback = FastXMLCodec(), XmltodictCodec()
+        for xml in (TEXT_MSG, CONTACT_EVENT, CONTACT_EVENT.encode()):
+            self.assertEqual(fast.parse(xml), json_like(fallback.parse(xml)))
+
+    def test_dumps(self):
+        xml = FastXMLCodec().dumps({'ToUserName': 'wx5823bf96d3bd56c7', 'CreateTime': 1409659813,
+                                    'Content': 'a]]>b'})
+        self.assertEqual(xml, '<xml><ToUserName><![CDATA[wx5823bf96d3bd56c7]]></ToUserName>\n'
+                              '<CreateTime>1409659813</CreateTime>\n'
+                              '<Content><![CDATA[a]]]]><![CDATA[>b]]></Content>\n</xml>')
+        self.assertEqual(FastXMLCodec().parse(xml)['Content'], 'a]]>b')
+
+    def test_get_xml_codec(self):
+        self.assertIsInstance(get_xml_codec(), FastXMLCodec)
+
+
+def json_like(value):
+    """
+    把xmltodict返回的有序字典转成普通字典以便比较
+    """
+    if isinstance(value, dict):
+        return {key: json_like(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [json_like(item) for item in value]
+    return value
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import importlib
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.dispatch import Signal
+from django.test import TestCase, override_settings
+
+from django_wechat.sdk.work import *
+from django_wechat.signals import wechatwork_contact_event
+from django_wechat.callbacks import CallbackDeduplicator, ThreadPoolDispatcher, get_deduplicator
+from django_wechat.models import WeChatPayOrderNotification
+from django_wechat.sdk.pay import MCH_API_KEY
+from wechatpy.pay.utils import calculate_signature, dict_to_xml
+
+
+CONTACT_EVENT = {
+    'ToUserName': CORPID,
+    'FromUserName': 'sys',
+    'CreateTime': '1403610513',
+    'MsgType': 'event',
+    'Event': 'change_contact',
+    'ChangeType': 'create_user',
+    'UserID': 'zhangsan',
+    'Name': '张三',
+}
+
+
+@override_settings(ROOT_URLCONF='django_wechat.urls',
+                   WECHATWORK_CALLBACK_DISPATCHER='django_wechat.callbacks.SyncDispatcher')
+class ContactCallbackViewTestCase(TestCase):
+    def setUp(self):
+        self.sdk = WeChatWorkCallbackSDK(CONTACT_TOKEN, CONTACT_ENCODING_AES_KEY)
+        self.url = '/wechatwork/contact/callback/'
+        self.events = []
+        wechatwork_contact_event.connect(self.receiver)
+        cache.clear()
+        get_deduplicator.cache_clear()
+
+    def tearDown(self):
+        wechatwork_contact_event.disconnect(self.receiver)
+
+    def receiver(self, sender, event, **kwargs):
+        self.events.append(event)
+
+    def post_event(self, event, sign=None, xml=None):
+        if xml is None:
+            xml = self.sdk.encrypt(event)
+        envelope = get_xml_codec().parse(xml)
+        params = {'msg_signature': sign or envelope['MsgSignature'], 'timestamp': envelope['TimeStamp'],
+                  'nonce': envelope['Nonce']}
+        return self.client.post(self.url + '?' + '&'.join('{}={}'.format(*item) for item in params.items()),
+                                data=xml, content_type='text/xml')
+
+    def verify_url(self, echostr):
+        timestamp, nonce = str(int(time.time())), '263014780'
+        sign = cal_encrypt_sign(CONTACT_TOKEN, timestamp, nonce, echostr)
+        return self.client.get(self.url, {'msg_signature': sign, 'timestamp': timestamp, 'nonce': nonce,
+                                          'echostr': echostr})
+
+    def test_verify_url(self):
+        echostr = self.sdk.cipher.encrypt(gen_random_msg_bytes(b'1616140317555161061', CORPID))
+        response = self.verify_url(echostr)
+        self.assertEqual(response.content, b'1616140317555161061')
+
+    def test_verify_url_other_corp(self):
+        echostr = self.sdk.cipher.encrypt(gen_random_msg_bytes(b'1616140317555161061', 'wwothercorp'))
+        response = self.verify_url(echostr)
+        self.assertEqual(response.status_code, 403)
+
+    def test_verify_url_malformed(self):
+        response = self.verify_url('not-base64!')
+        self.assertEqual(response.status_code, 400)
+        response = self.verify_url(self.sdk.cipher.encrypt(b'short'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_event(self):
+        response = self.post_event(CONTACT_EVENT)
+        self.assertEqual(response.content, b'success')
+        self.assertEqual(self.events[0]['UserID'], 'zhangsan')
+
+    def test_duplicate_event(self):
+        self.post_event(CONTACT_EVENT)
+        response = self.post_event(CONTACT_EVENT)
+        self.assertEqual(response.content, b'success')
+        self.assertEqual(len(self.events), 1)
+        self.post_event(dict(CONTACT_EVENT, CreateTime='1403610514'))
+        self.assertEqual(len(self.events), 2)
+
+    def test_dispatch_failed(self):
+        """
+        分发失败的事件不记为已处理，企业微信重试时再次分发
+        """
+        xml = self.sdk.encrypt(CONTACT_EVENT)
+        with mock.patch('django_wechat.views.get_dispatcher') as get_dispatcher:
+            get_dispatcher.return_value.dispatch.side_effect = RuntimeError('executor shut down')
+            response = self.post_event(CONTACT_EVENT, xml=xml)
+        self.assertEqual(response.status_code, 500)
+        # 重试使用相同的timestamp和nonce
+        response = self.post_event(CONTACT_EVENT, xml=xml)
+        self.assertEqual(response.content, b'success')
+        self.assertEqual(len(self.events), 1)
+
+    def test_invalid_signature(self):
+        response = self.post_event(CONTACT_EVENT, sign='invalid')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(self.events)
+
+    def test_replayed_request(self):
+        xml = self.sdk.encrypt(CONTACT_EVENT)
+        self.post_event(CONTACT_EVENT, xml=xml)
+        response = self.post_event(CONTACT_EVENT, xml=xml)
+        self.assertEqual(response.content, b'success')
+        self.assertEqual(len(self.events), 1)
+
+    def test_stale_request(self):
+        xml = encrypt_msg(CONTACT_EVENT, CONTACT_TOKEN, CONTACT_ENCODING_AES_KEY, timestamp='1409659813')
+        response = self.post_event(CONTACT_EVENT, xml=xml)
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(self.events)
+
+
+@override_settings(ROOT_URLCONF='django_wechat.urls',
+                   WECHATWORK_CALLBACK_DISPATCHER='django_wechat.callbacks.SyncDispatcher')
+class WeChatPayNotifyViewTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.url = '/wechatpay/notify/'
+        self.data = {
+            'appid': 'wxappid',
+            'mch_id': '1900000109',
+            'nonce_str': '5d2b6c2a8db53831f7eda20af46e531c',
+            'openid': 'o5UdX0hDXymhfKmk1whTVUlIwZqE',
+            'out_trade_no': 'qtorder_20200915182157105164',
+            'result_code': 'SUCCESS',
+            'return_code': 'SUCCESS',
+            'time_end': '20200915210540',
+            'total_fee': '1',
+            'trade_type': 'JSAPI',
+            'transaction_id': '4200000688202009159176613942',
+        }
+
+    def post_notify(self, sign=None):
+        xml = dict_to_xml(self.data, sign or calculate_signature(self.data, MCH_API_KEY))
+        return self.client.post(self.url, data=xml, content_type='text/xml')
+
+    def test_notify(self):
+        response = self.post_notify()
+        self.assertIn(b'SUCCESS', response.content)
+        notification = WeChatPayOrderNotification.objects.get()
+        self.assertEqual(notification.transaction_id, self.data['transaction_id'])
+
+    def test_repeated_notify(self):
+        self.post_notify()
+        response = self.post_notify()
+        self.assertIn(b'SUCCESS', response.content)
+        self.assertEqual(WeChatPayOrderNotification.objects.count(), 1)
+
+    def test_saved_before_ack(self):
+        """
+        应答前已保存通知，分发器没有处理也不会丢失
+        """
+        with mock.patch('django_wechat.views.get_dispatcher') as get_dispatcher:
+            response = self.post_notify()
+        self.assertIn(b'SUCCESS', response.content)
+        get_dispatcher.return_value.dispatch.assert_called_once()
+        notification = WeChatPayOrderNotification.objects.get()
+        self.assertEqual(notification.status, WeChatPayOrderNotification.STATUS_RECEIVED)
+
+    def test_save_failed(self):
+        with mock.patch('django_wechat.views.save_notification', side_effect=DatabaseError):
+            response = self.post_notify()
+        self.assertEqual(response.status_code, 500)
+        self.assertIn(b'FAIL', response.content)
+
+    def test_invalid_signature(self):
+        response = self.post_notify(sign='invalid')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WeChatPayOrderNotification.objects.exists())
+
+
+class UrlsImportTestCase(TestCase):
+    def test_without_wechatwork_secrets(self):
+        """
+        只使用微信支付的项目没有WECHATWORK_SECRETS时也能加载URL
+        """
+        modules = ('django_wechat.urls', 'django_wechat.views', 'django_wechat.sdk.work')
+        with override_settings(), mock.patch.dict(sys.modules):
+            del settings.WECHATWORK_SECRETS
+            for name in modules:
+                sys.modules.pop(name, None)
+            urls = importlib.import_module('django_wechat.urls')
+            self.assertNotIn('django_wechat.sdk.work', sys.modules)
+        self.assertEqual([pattern.name for pattern in urls.urlpatterns],
+                         ['wechatwork_contact_callback', 'wechatpay_notify'])
+
+
+class ThreadPoolDispatcherTestCase(TestCase):
+    def test_ordering_key(self):
+        """
+        同一顺序键的事件按分发顺序处理
+        """
+        signal = Signal()
+        handled = []
+
+        def receiver(sender, index, **kwargs):
+            # 先分发的事件处理得更慢
+            time.sleep(0.002 * (10 - index))
+            handled.append(index)
+
+        signal.connect(receiver, weak=False)
+        dispatcher = ThreadPoolDispatcher(max_workers=4)
+        futures = [dispatcher.dispatch(signal, ordering_key='contact', index=index) for index in range(10)]
+        for future in futures:
+            future.result()
+        self.assertEqual(handled, list(range(10)))
+        self.assertIs(dispatcher.get_ordered_executor('contact'), dispatcher.get_ordered_executor('contact'))
+
+
+class CallbackDeduplicatorTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_shared_cache(self):
+        """
+        其他进程处理过的消息也判断为重复
+        """
+        self.assertFalse(CallbackDeduplicator().is_duplicate({'MsgId': '1'}))
+        self.assertTrue(CallbackDeduplicator().is_duplicate({'MsgId': '1'}))
+
+    def test_event_key(self):
+        """
+        同一秒内同一成员的两次变更不是重复事件
+        """
+        deduplicator = CallbackDeduplicator()
+        self.assertFalse(deduplicator.is_duplicate(dict(CONTACT_EVENT, ChangeType='update_user', Name='张三')))
+        self.assertFalse(deduplicator.is_duplicate(dict(CONTACT_EVENT, ChangeType='update_user', Name='张三丰')))
+        self.assertTrue(deduplicator.is_duplicate(dict(CONTACT_EVENT, ChangeType='update_user', Name='张三丰')))
+
+    def test_forget(self):
+        deduplicator = CallbackDeduplicator()
+        deduplicator.is_duplicate(CONTACT_EVENT)
+        deduplicator.forget(CONTACT_EVENT)
+        self.assertFalse(deduplicator.is_duplicate(CONTACT_EVENT))
+
+    def test_cache_error(self):
+        """
+        缓存不可用时不在进程内记为已处理
+        """
+        deduplicator = CallbackDeduplicator()
+        with mock.patch('django_wechat.callbacks.cache.add', side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                deduplicator.is_duplicate(CONTACT_EVENT)
+        self.assertEqual(len(deduplicator._seen), 0)
+        self.assertFalse(deduplicator.is_duplicate(CONTACT_EVENT))
+
+    def test_lru(self):
+        deduplicator = CallbackDeduplicator(max_size=2)
+        for msgid in ('1', '2', '3'):
+            deduplicator.is_duplicate({'MsgId': msgid})
+        self.assertEqual(len(deduplicator._seen), 2)
+
+
+def gen_random_msg_bytes(msg: bytes, receive_id: str) -> bytes:
+    return b'0' * 16 + MSG_LEN_STRUCT.pack(len(msg)) + msg + receive_id.encode()